@@ -0,0 +1,89 @@
+import argparse
+import copy
+import time
+import torch
+import torch.nn as nn
+from peft import get_peft_model, LoraConfig
+from model.fused import fuse_lora
+
+parser = argparse.ArgumentParser(description='benchmark fused lora')
+parser.add_argument('--batch_size', default=32, type=int)
+parser.add_argument('--rank', default=8, type=int)
+parser.add_argument('--num_iters', default=20, type=int)
+parser.add_argument('--num_threads', default=None, type=int)
+args = vars(parser.parse_args())
+
+
+class Block(nn.Module):
+    def __init__(self, layer):
+        super().__init__()
+        self.layer = layer
+
+    def forward(self, x):
+        return self.layer(x)
+
+
+def make_cases():
+    cases = {'linear': (nn.Sequential(*[nn.Linear(768, 768) for _ in range(4)]),
+                        torch.randn(args['batch_size'], 128, 768)),
+             'conv2d': (nn.Sequential(*[nn.Conv2d(64, 64, 3, padding=1) for _ in range(4)]),
+                        torch.randn(args['batch_size'], 64, 32, 32))}
+    return cases
+
+
+def make_lora(model, fused):
+    target_modules = [k for k, v in model.named_modules() if isinstance(v, (nn.Linear, nn.Conv2d))]
+    peft_config = LoraConfig(r=args['rank'], lora_alpha=args['rank'], lora_dropout=0.0,
+                             target_modules=target_modules, init_lora_weights=False)
+    model = get_peft_model(Block(model), peft_config)
+    if fused:
+        fuse_lora(model)
+    return model
+
+
+def run(model, x):
+    saved = [0]
+
+    def pack(tensor):
+        saved[0] += tensor.numel() * tensor.element_size() if not isinstance(tensor, nn.Parameter) else 0
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        y = model(x)
+    y.square().mean().backward()
+    grad = {k: v.grad.clone() for k, v in model.named_parameters() if v.requires_grad}
+    model.zero_grad()
+    return y.detach(), grad, saved[0]
+
+
+def benchmark(model, x):
+    for _ in range(2):
+        model(x).square().mean().backward()
+    start_time = time.time()
+    for _ in range(args['num_iters']):
+        model(x).square().mean().backward()
+        model.zero_grad()
+    elapsed = (time.time() - start_time) / args['num_iters']
+    return elapsed
+
+
+def main():
+    if args['num_threads'] is not None:
+        torch.set_num_threads(args['num_threads'])
+    torch.manual_seed(0)
+    for name, (base, x) in make_cases().items():
+        peft_model = make_lora(copy.deepcopy(base), False)
+        fused_model = make_lora(copy.deepcopy(base), True)
+        fused_model.load_state_dict(peft_model.state_dict())
+        y, grad, saved = run(peft_model, x)
+        y_fused, grad_fused, saved_fused = run(fused_model, x)
+        error = max([(y - y_fused).abs().max().item()] + [(grad[k] - grad_fused[k]).abs().max().item() for k in grad])
+        time_peft, time_fused = benchmark(peft_model, x), benchmark(fused_model, x)
+        print('{}: max error {:.2e}, saved activations {:.1f}MB -> {:.1f}MB, forward+backward {:.1f}ms -> {:.1f}ms '
+              '({:.2f}x)'.format(name, error, saved / 2 ** 20, saved_fused / 2 ** 20, time_peft * 1e3,
+                                 time_fused * 1e3, time_peft / time_fused))
+    return
+
+
+if __name__ == "__main__":
+    main()
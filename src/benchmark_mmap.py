@@ -0,0 +1,70 @@
+import argparse
+import torch
+import torch.multiprocessing as mp
+from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoModelForSequenceClassification
+from model.mapped import map_pretrained
+from module import read_memory
+
+parser = argparse.ArgumentParser(description='benchmark memory-mapped loading')
+parser.add_argument('--model_name_or_path', default='gpt2', type=str)
+parser.add_argument('--task_name', default='clm', type=str)
+parser.add_argument('--cache_dir', default=None, type=str)
+parser.add_argument('--num_processes', default=4, type=int)
+args = vars(parser.parse_args())
+
+
+def load(mode):
+    if args['task_name'] == 'clm':
+        model_class = AutoModelForCausalLM
+    elif args['task_name'] == 's2s':
+        model_class = AutoModelForSeq2SeqLM
+    elif args['task_name'] == 'sc':
+        model_class = AutoModelForSequenceClassification
+    else:
+        raise ValueError('Not valid task name')
+    if mode == 'mmap':
+        model = model_class.from_pretrained(args['model_name_or_path'], cache_dir=args['cache_dir'],
+                                            low_cpu_mem_usage=True, use_safetensors=True)
+        map_pretrained(model, args['cache_dir'])
+    else:
+        model = model_class.from_pretrained(args['model_name_or_path'], cache_dir=args['cache_dir'])
+    return model
+
+
+def run(mode, barrier, queue):
+    # pss splits shared pages between the processes mapping them, so its sum is the footprint on the node
+    base = read_memory('/proc/self/smaps_rollup', ['Rss', 'Pss', 'Anonymous'])
+    model = load(mode)
+    model.requires_grad_(False)
+    # every weight is read once, as a forward pass would
+    for param in model.parameters():
+        param.sum()
+    # all processes hold their model while memory is read
+    barrier.wait()
+    memory = read_memory('/proc/self/smaps_rollup', ['Rss', 'Pss', 'Anonymous'])
+    queue.put({k: memory[k] - base[k] for k in memory})
+    barrier.wait()
+    return
+
+
+def main():
+    ctx = mp.get_context('spawn')
+    for mode in ['default', 'mmap']:
+        barrier = ctx.Barrier(args['num_processes'])
+        queue = ctx.Queue()
+        process = [ctx.Process(target=run, args=(mode, barrier, queue)) for _ in range(args['num_processes'])]
+        for p in process:
+            p.start()
+        memory = [queue.get() for _ in range(args['num_processes'])]
+        for p in process:
+            p.join()
+        rss = sum(m['Rss'] for m in memory) / len(memory)
+        anonymous = sum(m['Anonymous'] for m in memory) / len(memory)
+        pss = sum(m['Pss'] for m in memory)
+        print('{}: {} processes, RSS {:.1f}MB per process ({:.1f}MB private), PSS {:.1f}MB in total'.format(
+            mode, args['num_processes'], rss, anonymous, pss))
+    return
+
+
+if __name__ == "__main__":
+    main()
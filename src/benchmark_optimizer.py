@@ -0,0 +1,104 @@
+import argparse
+import time
+import torch
+from transformers import AutoModelForCausalLM
+from model.adam8bit import AdamW8bit
+from model.galore import GaLoreAdamW, make_galore_parameters
+from module import read_memory, run_process
+
+parser = argparse.ArgumentParser(description='benchmark memory saving optimizers')
+parser.add_argument('--model_name_or_path', default='gpt2', type=str)
+parser.add_argument('--optimizer_name', default=['AdamW', 'AdamW8bit-stochastic', 'AdamW8bit-nearest', 'GaLoreAdamW'],
+                    nargs='+')
+parser.add_argument('--batch_size', default=8, type=int)
+parser.add_argument('--seq_length', default=64, type=int)
+parser.add_argument('--num_steps', default=200, type=int)
+parser.add_argument('--lr', default=5e-5, type=float)
+parser.add_argument('--rank', default=128, type=int)
+parser.add_argument('--update_proj_gap', default=200, type=int)
+parser.add_argument('--num_threads', default=None, type=int)
+args = vars(parser.parse_args())
+
+
+def make_input(vocab_size, i):
+    # a fixed pool of batches, so the loss curves of the optimizers are comparable
+    generator = torch.Generator().manual_seed(i % 16)
+    input_ids = torch.randint(vocab_size, (args['batch_size'], args['seq_length']), generator=generator)
+    input = {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids), 'labels': input_ids}
+    return input
+
+
+def make_optimizer(model, optimizer_name):
+    parameters = model.parameters()
+    if optimizer_name == 'AdamW':
+        optimizer = torch.optim.AdamW(parameters, lr=args['lr'], weight_decay=5e-4)
+    elif optimizer_name.startswith('AdamW8bit'):
+        optimizer = AdamW8bit(parameters, lr=args['lr'], weight_decay=5e-4, rounding=optimizer_name.split('-')[1])
+    elif optimizer_name == 'GaLoreAdamW':
+        optimizer = GaLoreAdamW(make_galore_parameters(model), lr=args['lr'], weight_decay=5e-4, rank=args['rank'],
+                                update_proj_gap=args['update_proj_gap'])
+    else:
+        raise ValueError('Not valid optimizer name')
+    return optimizer
+
+
+def run(optimizer_name):
+    if args['num_threads'] is not None:
+        torch.set_num_threads(args['num_threads'])
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_pretrained(args['model_name_or_path'])
+    optimizer = make_optimizer(model, optimizer_name)
+    model.train(True)
+    elapsed = []
+    loss = []
+    for i in range(args['num_steps']):
+        input = make_input(model.config.vocab_size, i)
+        start_time = time.time()
+        output = model(**input)
+        output['loss'].backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        elapsed.append(time.time() - start_time)
+        loss.append(output['loss'].item())
+    memory = sum(v.numel() * v.element_size() for state in optimizer.state.values() for v in state.values()
+                 if torch.is_tensor(v))
+    # round trip of the optimizer states, as resume does
+    state_dict = optimizer.state_dict()
+    optimizer_ = make_optimizer(model, optimizer_name)
+    optimizer_.load_state_dict(state_dict)
+    exact = all(equal(optimizer.state[p][k], optimizer_.state[p][k]) for p in optimizer.state
+                for k in optimizer.state[p])
+    step_time = sum(elapsed[1:]) / max(len(elapsed) - 1, 1)
+    result = {'memory': memory / 2 ** 20, 'rss': read_memory(), 'time': step_time, 'loss': loss, 'exact': exact}
+    return result
+
+
+def equal(x, y):
+    # GaLoreAdamW keeps its step count as a number
+    if torch.is_tensor(x):
+        return torch.is_tensor(y) and x.dtype == y.dtype and torch.equal(x, y)
+    return x == y
+
+
+def final_loss(loss):
+    # the loss is averaged over the last pass through the pool of batches
+    loss = loss[-16:]
+    return sum(loss) / len(loss)
+
+
+def main():
+    result = {}
+    for optimizer_name in args['optimizer_name']:
+        result[optimizer_name] = run_process(run, optimizer_name)
+        r = result[optimizer_name]
+        loss = final_loss(r['loss'])
+        base_loss = final_loss(result[args['optimizer_name'][0]]['loss'])
+        print('{}: optimizer states {:.1f}MB, RSS {:.1f}MB ({:.1f}MB private), step {:.1f}ms, final loss {:.4f} '
+              '({:+.4f}), state dict round trip {}'.format(optimizer_name, r['memory'], r['rss']['VmRSS'],
+                                                          r['rss']['RssAnon'], r['time'] * 1e3, loss,
+                                                          loss - base_loss, 'exact' if r['exact'] else 'changed'))
+    return
+
+
+if __name__ == "__main__":
+    main()
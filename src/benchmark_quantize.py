@@ -0,0 +1,75 @@
+import argparse
+import time
+import torch
+from transformers import AutoModelForCausalLM
+from peft import get_peft_model
+from config import cfg
+from model.model import make_config_clm
+from model.quantize import quantize_model
+from module import read_memory, run_process
+
+parser = argparse.ArgumentParser(description='benchmark quantized base weights')
+parser.add_argument('--model_name_or_path', default='gpt2', type=str)
+parser.add_argument('--ft_name', default=['lora', 'adalora', 'ia3', 'promptune', 'prefixtune', 'ptune'], nargs='+')
+parser.add_argument('--quantize_mode', default=['none', 'int8', 'nf4'], nargs='+')
+parser.add_argument('--batch_size', default=8, type=int)
+parser.add_argument('--seq_length', default=64, type=int)
+parser.add_argument('--num_steps', default=20, type=int)
+parser.add_argument('--lr', default=1e-3, type=float)
+parser.add_argument('--num_threads', default=None, type=int)
+args = vars(parser.parse_args())
+
+
+def make_input(vocab_size):
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(vocab_size, (args['batch_size'], args['seq_length']), generator=generator)
+    input = {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids), 'labels': input_ids}
+    return input
+
+
+def run(ft_name, quantize_mode):
+    if args['num_threads'] is not None:
+        torch.set_num_threads(args['num_threads'])
+    torch.manual_seed(0)
+    cfg['ft_name'] = ft_name
+    cfg['tokenizer_name_or_path'] = args['model_name_or_path']
+    model = AutoModelForCausalLM.from_pretrained(args['model_name_or_path'])
+    if quantize_mode != 'none':
+        quantize_model(model, quantize_mode)
+    model = get_peft_model(model, make_config_clm())
+    memory = sum(v.numel() * v.element_size() for v in list(model.parameters()) + list(model.buffers()))
+    optimizer = torch.optim.AdamW([v for v in model.parameters() if v.requires_grad], lr=args['lr'])
+    input = make_input(model.config.vocab_size)
+    model.train(True)
+    elapsed = []
+    for i in range(args['num_steps']):
+        start_time = time.time()
+        output = model(**input)
+        output['loss'].backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        elapsed.append(time.time() - start_time)
+    model.train(False)
+    with torch.no_grad():
+        loss = model(**input)['loss'].item()
+    # steps after the first one, which includes one-off allocations
+    step_time = sum(elapsed[1:]) / max(len(elapsed) - 1, 1)
+    result = {'memory': memory / 2 ** 20, 'rss': read_memory(), 'time': step_time, 'loss': loss}
+    return result
+
+
+def main():
+    for ft_name in args['ft_name']:
+        result = {}
+        for quantize_mode in args['quantize_mode']:
+            result[quantize_mode] = run_process(run, ft_name, quantize_mode)
+            r = result[quantize_mode]
+            delta = r['loss'] - result[args['quantize_mode'][0]]['loss']
+            print('{} {}: weights {:.1f}MB, RSS {:.1f}MB ({:.1f}MB private), step {:.1f}ms, final loss {:.4f} '
+                  '({:+.4f})'.format(ft_name, quantize_mode, r['memory'], r['rss']['VmRSS'], r['rss']['RssAnon'],
+                                     r['time'] * 1e3, r['loss'], delta))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import os
+import time
+import torch
+import torch.backends.cudnn as cudnn
+from config import cfg, process_args
+from experiment import Experiment
+from dataset import make_eval_data_loader
+from metric import make_metric, make_logger
+from model import cache_prompt, make_engine, get_lora_factors, truncate_lora_factors, make_lora_adapter, \
+    save_lora_adapter, count_adapter_parameters
+from module import save, to_device, process_control, save_blob, release_blob, clean_blob, list_files
+from peft import PeftModel
+
+cudnn.benchmark = True
+parser = argparse.ArgumentParser(description='cfg')
+for k in cfg:
+    exec('parser.add_argument(\'--{0}\', default=cfg[\'{0}\'], type=type(cfg[\'{0}\']))'.format(k))
+parser.add_argument('--control_name', default=None, type=str)
+args = vars(parser.parse_args())
+process_args(args)
+
+num_verify_batches = 4
+
+
+def main():
+    process_control()
+    seeds = list(range(cfg['init_seed'], cfg['init_seed'] + cfg['num_experiments']))
+    experiment = Experiment()
+    for i in range(cfg['num_experiments']):
+        model_tag_list = [str(seeds[i]), cfg['control_name']]
+        cfg['model_tag'] = '_'.join([x for x in model_tag_list if x])
+        print('Experiment: {}'.format(cfg['model_tag']))
+        runExperiment(experiment)
+    return
+
+
+def runExperiment(experiment):
+    cfg['seed'] = int(cfg['model_tag'].split('_')[0])
+    torch.manual_seed(cfg['seed'])
+    torch.cuda.manual_seed(cfg['seed'])
+    if cfg['ft_name'] not in ['lora', 'adalora']:
+        raise ValueError('Not valid ft name for compaction')
+    if cfg['ft_name'] == 'lora' and cfg['rank_error'] <= 0 and cfg['rank_budget'] <= 0:
+        raise ValueError('Not valid rank reduction')
+    model_path = os.path.join('output', 'model')
+    result_path = os.path.join('output', 'result')
+    model_tag_path = os.path.join(model_path, cfg['model_tag'])
+    best_path = os.path.join(model_tag_path, 'best')
+    blob_path = os.path.join(model_tag_path, 'blob')
+    # the trained adapter is left as it is, the compact one is written next to it for test_peft --test_adapter
+    full_path = os.path.join(best_path, 'adapter')
+    adapter_path = os.path.join(best_path, 'adapter_compact')
+    model, tokenizer = experiment.make_model()
+    dataset = experiment.make_dataset()
+    data_loader = make_eval_data_loader(dataset['test'], tokenizer, cfg['model_name'])
+    metric = make_metric({'train': ['Loss'], 'test': ['Loss']}, tokenizer)
+    full_logger = make_logger(os.path.join('output', 'runs', 'compact_full_{}'.format(cfg['model_tag'])))
+    compact_logger = make_logger(os.path.join('output', 'runs', 'compact_{}'.format(cfg['model_tag'])))
+    model = PeftModel.from_pretrained(model, full_path).to(cfg['device'])
+    output = make_output(data_loader, model)
+    full_time = test(data_loader, model, metric, full_logger)
+    factors = get_lora_factors(model)
+    num_params = sum(v.numel() for k, v in model.named_parameters() if 'lora_' in k)
+    if cfg['rank_error'] > 0 or cfg['rank_budget'] > 0:
+        factors = truncate_lora_factors(factors, cfg['rank_error'], cfg['rank_budget'])
+    lora_config, state_dict = make_lora_adapter(model, factors)
+    release_blob(adapter_path)
+    save_lora_adapter(adapter_path, lora_config, state_dict)
+    save_blob(best_path, blob_path)
+    clean_blob(blob_path)
+    model, _ = experiment.make_model()
+    model = PeftModel.from_pretrained(model, adapter_path).to(cfg['device'])
+    output_compact = make_output(data_loader, model)
+    compact_time = test(data_loader, model, metric, compact_logger)
+    error = max((output[i] - output_compact[i]).abs().max().item() for i in range(len(output)))
+    rank = [A.size(0) for B, A in factors.values()]
+    pivot_name = 'test/{}'.format(metric.pivot_name)
+    print('Compaction: rank {}-{} (mean {:.1f}), adapter parameters {} -> {} ({:.1f}KB -> {:.1f}KB), '
+          'max logit error {:.2e}, {} {:.4f} -> {:.4f}, eval time {:.1f}s -> {:.1f}s'.format(
+           min(rank), max(rank), sum(rank) / len(rank), num_params, count_adapter_parameters(factors),
+           get_size(full_path) / 2 ** 10, get_size(adapter_path) / 2 ** 10, error, metric.pivot_name,
+           full_logger.mean[pivot_name], compact_logger.mean[pivot_name], full_time, compact_time))
+    result = {'cfg': cfg, 'rank': rank, 'error': error, 'time': {'full': full_time, 'compact': compact_time},
+              'size': {'full': get_size(full_path), 'compact': get_size(adapter_path)},
+              'logger_state_dict': {'full': full_logger.state_dict(), 'compact': compact_logger.state_dict()}}
+    save(result, os.path.join(result_path, 'compact_{}'.format(cfg['model_tag'])))
+    return
+
+
+def get_size(path):
+    return sum(os.path.getsize(os.path.join(path, file)) for file in list_files(path))
+
+
+def make_output(data_loader, model):
+    output = []
+    with torch.no_grad():
+        model.train(False)
+        for i, input in enumerate(data_loader):
+            if i == num_verify_batches:
+                break
+            input = {'input_ids': input['input_ids'], 'attention_mask': input['attention_mask'],
+                     'labels': input['labels']}
+            input = to_device(input, cfg['device'])
+            output.append(model(**input)['logits'].float().cpu())
+    return output
+
+
+def test(data_loader, model, metric, logger):
+    start_time = time.time()
+    with torch.no_grad(), cache_prompt(model):
+        model.train(False)
+        engine = make_engine(model, metric, logger)
+        engine.run(data_loader)
+        evaluation = metric.evaluate('test', 'full')
+        logger.append(evaluation, 'test')
+        print(logger.write('test', engine.metric_name['test']))
+    elapsed = time.time() - start_time
+    return elapsed
+
+
+if __name__ == "__main__":
+    main()
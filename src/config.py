@@ -15,6 +15,11 @@ def process_args(args):
         cfg['control'] = make_control(cfg['control'], args['control_name'])
     if cfg['control'] is not None:
         cfg['control_name'] = make_control_name(cfg['control'])
+        # settings that change what is trained are kept apart from the baseline runs of the same control
+        if cfg['quantize_mode'] != 'none':
+            cfg['control_name'] = '_'.join([cfg['control_name'], 'quantize-{}'.format(cfg['quantize_mode'])])
+        if cfg['num_top_layers'] > 0:
+            cfg['control_name'] = '_'.join([cfg['control_name'], 'top-{}'.format(cfg['num_top_layers'])])
     return
 
 
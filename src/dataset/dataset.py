@@ -203,6 +203,21 @@ def make_data_loader(dataset, tokenizer, tag, batch_size=None, shuffle=None, sam
     return data_loader
 
 
+def make_eval_data_loader(dataset, tokenizer, tag, indices=None):
+    indices = list(range(len(dataset))) if indices is None else list(indices)
+    if cfg['collate_mode'] == 'transformer':
+        # longest prompts first, so batches carry little padding and the largest batch is seen first
+        attention_mask = dataset['attention_mask']
+        length = [sum(attention_mask[i]) for i in indices]
+        order = sorted(range(len(indices)), key=lambda i: -length[i])
+        indices = [indices[i] for i in order]
+    data_loader = DataLoader(dataset=dataset, batch_size=cfg[tag]['batch_size']['eval'], sampler=indices,
+                             pin_memory=cfg['pin_memory'], num_workers=cfg['num_workers'],
+                             collate_fn=make_data_collate(cfg['collate_mode'], tokenizer),
+                             worker_init_fn=np.random.seed(cfg['seed']))
+    return data_loader
+
+
 def collate(input):
     for k in input:
         input[k] = torch.stack(input[k], 0)
@@ -236,6 +251,9 @@ def process_dataset(dataset, tokenizer):
                 desc="Running tokenizer on dataset",
             )
             cfg['max_new_tokens'] = 10
+            # every label is one candidate sequence for scoring instead of generation
+            classes = dataset['train'].features['label'].names
+            cfg['label_space'] = tokenizer(classes, max_length=3, padding="max_length", truncation=True)['input_ids']
         elif cfg['data_name'] == 'ptb':
             max_length = cfg[cfg['model_name']]['max_length']
 
@@ -0,0 +1,86 @@
+import torch
+from config import cfg
+from dataset import make_dataset, process_dataset
+from model import make_model
+from model.mapped import map_pretrained
+
+# the train and test splits of these datasets are drawn with the seed of the experiment
+seed_data_name = ['fpb', 'dolly']
+module_container = ['_modules', '_parameters', '_buffers', '_forward_hooks', '_forward_pre_hooks']
+
+
+class Experiment:
+    def __init__(self):
+        # one context is shared by the seeds of a run, the pretrained model is loaded and the dataset tokenized once
+        self.model = None
+        self.tokenizer = None
+        self.base = None
+        self.dataset = None
+        self.dataset_seed = None
+
+    def make_model(self):
+        if cfg['task_name'] not in ['s2s', 'sc', 'clm']:
+            model, self.tokenizer = make_model(cfg['model_name'])
+            return model, self.tokenizer
+        if self.model is None:
+            self.model, self.tokenizer = make_model(cfg['model_name'])
+            self.base = snapshot(self.model)
+        else:
+            restore(self.model, self.base)
+        if cfg['task_name'] == 'sc':
+            init_head(self.model)
+        return self.model, self.tokenizer
+
+    def make_dataset(self):
+        seed = cfg['seed'] if cfg['data_name'] in seed_data_name else None
+        if self.dataset is None or self.dataset_seed != seed:
+            dataset = make_dataset(cfg['data_name'], cfg['subset_name'])
+            self.dataset = process_dataset(dataset, self.tokenizer)
+            self.dataset_seed = seed
+        return self.dataset
+
+
+def snapshot(model):
+    # adapters are injected into the pretrained model in place, so the class, module tree, hooks and attributes of
+    # every module are recorded next to a copy of its weights, weights mapped from the checkpoint are mapped again
+    # instead of being copied
+    mapped = set(map_pretrained(model, cfg['cache_model_path'])) if cfg['mmap_model'] == 1 else set()
+    mapped_ptr = set(v.data_ptr() for k, v in model.named_parameters() if k in mapped)
+    module = {}
+    for m in model.modules():
+        module[m] = {'class': type(m), 'container': {k: dict(m.__dict__[k]) for k in module_container},
+                     'attr': {k: v for k, v in m.__dict__.items() if k not in module_container}}
+    requires_grad = {k: v.requires_grad for k, v in model.named_parameters()}
+    state_dict = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()
+                  if v.data_ptr() not in mapped_ptr}
+    base = {'module': module, 'requires_grad': requires_grad, 'state_dict': state_dict, 'mapped': mapped}
+    return base
+
+
+def restore(model, base):
+    for m, m_base in base['module'].items():
+        m.__class__ = m_base['class']
+        for k in module_container:
+            m.__dict__[k].clear()
+            m.__dict__[k].update(m_base['container'][k])
+        for k in set(m.__dict__) - set(module_container) - set(m_base['attr']):
+            del m.__dict__[k]
+        m.__dict__.update(m_base['attr'])
+    if len(base['mapped']) > 0:
+        model.to('cpu')
+        map_pretrained(model, cfg['cache_model_path'])
+    model.load_state_dict(base['state_dict'], strict=len(base['mapped']) == 0)
+    for k, v in model.named_parameters():
+        v.requires_grad_(base['requires_grad'][k])
+    return
+
+
+def init_head(model):
+    # the classification head is not pretrained, it is drawn from the seed of the experiment alone, so a model tag
+    # gets the same head wherever it falls in the seeds of a run
+    torch.manual_seed(cfg['seed'])
+    with torch.no_grad():
+        for k, v in model.named_modules():
+            if k.split('.')[0] in ['classifier', 'score']:
+                model._init_weights(v)
+    return
@@ -15,7 +15,6 @@ parser.add_argument('--resume_mode', default=0, type=int)
 parser.add_argument('--mode', default=None, type=str)
 parser.add_argument('--split_round', default=65535, type=int)
 parser.add_argument('--task_name', default=None, type=str)
-args = vars(parser.parse_args())
 
 
 def make_controls(script_name, init_seeds, world_size, num_experiment, resume_mode, control_name):
@@ -28,26 +27,7 @@ def make_controls(script_name, init_seeds, world_size, num_experiment, resume_mo
     return controls
 
 
-def main():
-    run = args['run']
-    init_gpu = args['init_gpu']
-    num_gpu = args['num_gpu']
-    world_size = args['world_size']
-    round = args['round']
-    experiment_step = args['experiment_step']
-    init_seed = args['init_seed']
-    num_experiment = args['num_experiment']
-    resume_mode = args['resume_mode']
-    mode = args['mode']
-    split_round = args['split_round']
-    task_name = args['task_name']
-    gpu_ids = [','.join(str(i) for i in list(range(x, x + world_size))) for x in
-               list(range(init_gpu, init_gpu + num_gpu, world_size))]
-    init_seeds = [list(range(init_seed, init_seed + num_experiment, experiment_step))]
-    world_size = [[world_size]]
-    num_experiment = [[experiment_step]]
-    resume_mode = [[resume_mode]]
-    filename = '{}_{}_{}'.format(run, mode, task_name)
+def make_control_name(run, mode, task_name):
     if task_name == 's2s':
         data_names = ['fpb-sa', 'wikisql', 'samsum', 'e2enlg', 'webnlg-2017', 'dart']
         model_names = ['bart-base']
@@ -67,15 +47,19 @@ def main():
         model_names = ['sdiffusion']
     else:
         raise ValueError('Not valid task name')
-    offload_gpu = False
     if mode == 'full':
         if task_name == 'ic':
             batch_size = ['256']
         else:
             batch_size = ['32']
-        script_name = [['{}_model.py'.format(run)]]
+        script_name = '{}_model.py'.format(run)
         control_name = [[data_names, model_names, [task_name], ['full'], batch_size]]
-        controls = make_controls(script_name, init_seeds, world_size, num_experiment, resume_mode, control_name)
+    elif mode == 'full_optimizer':
+        # memory saving optimizers replace AdamW of the transformer tasks, compared against modes full and peft
+        ft_name = ['full-AdamW8bit', 'full-GaLoreAdamW'] if task_name != 'ic' else []
+        batch_size = ['32']
+        script_name = '{}_model.py'.format(run)
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
     elif mode == 'peft':
         if task_name == 'ic':
             ft_name = ['lora']
@@ -86,23 +70,79 @@ def main():
                 batch_size = ['8']
             else:
                 batch_size = ['32']
-        script_name = [['{}_peft.py'.format(run)]]
+        script_name = '{}_peft.py'.format(run)
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
+    elif mode == 'cola':
+        ft_name = ['cola-lowrank-1', 'cola-linear-1', 'cola-mlp-1']
+        if task_name == 'ic':
+            batch_size = ['256']
+        elif model_names[0] == 'llama-2':
+            batch_size = ['8']
+        else:
+            batch_size = ['32']
+        script_name = '{}_cola.py'.format(run)
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
+    elif mode == 'cola_step':
+        ft_name = ['cola-lowrank-1', 'cola-lowrank-2', 'cola-lowrank-4', 'cola-lowrank-8']
+        batch_size = ['8', '64']
+        script_name = '{}_cola.py'.format(run)
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
+    elif mode == 'cola_dist':
+        # one base model with an adapter per split, only for data sets with a split column
+        data_names = [x for x in data_names if x in ['dolly-15k']]
+        ft_name = ['cola-lowrank-1-0-1', 'cola-linear-1-0-1', 'cola-mlp-1-0-1']
+        batch_size = ['8'] if model_names[0] == 'llama-2' else ['32']
+        script_name = '{}_cola.py'.format(run)
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
+    elif mode == 'cola_merge':
+        # the adapter is folded into the base model and restarted every epoch
+        ft_name = ['cola-lowrank-1-1', 'cola-linear-1-1']
+        if task_name == 'ic':
+            batch_size = ['256']
+        elif model_names[0] == 'llama-2':
+            batch_size = ['8']
+        else:
+            batch_size = ['32']
+        script_name = '{}_cola.py'.format(run)
         control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
-        controls = make_controls(script_name, init_seeds, world_size, num_experiment, resume_mode, control_name)
     elif mode == 'full_dreambooth':
         ft_name = ['full']
         batch_size = ['1']
-        script_name = [['{}_model_dreambooth.py'.format(run)]]
+        script_name = '{}_model_dreambooth.py'.format(run)
         control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
-        controls = make_controls(script_name, init_seeds, world_size, num_experiment, resume_mode, control_name)
     elif mode == 'peft_dreambooth':
         ft_name = ['lora']
         batch_size = ['1']
-        script_name = [['{}_peft_dreambooth.py'.format(run)]]
+        script_name = '{}_peft_dreambooth.py'.format(run)
         control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
-        controls = make_controls(script_name, init_seeds, world_size, num_experiment, resume_mode, control_name)
     else:
         raise ValueError('Not valid mode')
+    return script_name, control_name
+
+
+def main():
+    run = args['run']
+    init_gpu = args['init_gpu']
+    num_gpu = args['num_gpu']
+    world_size = args['world_size']
+    round = args['round']
+    experiment_step = args['experiment_step']
+    init_seed = args['init_seed']
+    num_experiment = args['num_experiment']
+    resume_mode = args['resume_mode']
+    mode = args['mode']
+    split_round = args['split_round']
+    task_name = args['task_name']
+    gpu_ids = [','.join(str(i) for i in list(range(x, x + world_size))) for x in
+               list(range(init_gpu, init_gpu + num_gpu, world_size))]
+    init_seeds = [list(range(init_seed, init_seed + num_experiment, experiment_step))]
+    world_size = [[world_size]]
+    num_experiment = [[experiment_step]]
+    resume_mode = [[resume_mode]]
+    filename = '{}_{}_{}'.format(run, mode, task_name)
+    script_name, control_name = make_control_name(run, mode, task_name)
+    controls = make_controls([[script_name]], init_seeds, world_size, num_experiment, resume_mode, control_name)
+    offload_gpu = False
     s = '#!/bin/bash\n'
     j = 1
     k = 1
@@ -140,4 +180,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # parsed here, so sweep.py can import the tables of the modes
+    args = vars(parser.parse_args())
     main()
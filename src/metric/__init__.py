@@ -1,2 +1,3 @@
 from .metric import *
-from .logger import *
\ No newline at end of file
+from .logger import *
+from .policy import *
@@ -1,3 +1,4 @@
+import torch
 from collections import defaultdict
 from collections.abc import Iterable
 from torch.utils.tensorboard import SummaryWriter
@@ -16,8 +17,16 @@ class Logger:
         self.iterator = defaultdict(int)
 
     def save(self, flush):
+        # every name gets one entry per save, nan where it was not logged, so histories of runs evaluated on
+        # different epochs still line up by epoch
+        num_saves = max([len(v) for v in self.history.values()], default=0)
         for name in self.mean:
+            missing = make_missing(self.mean[name])
+            self.history[name].extend([missing] * (num_saves - len(self.history[name])))
             self.history[name].append(self.mean[name])
+        for name in self.history:
+            if len(self.history[name]) == num_saves:
+                self.history[name].append(make_missing(self.history[name][-1]))
         if flush:
             self.flush()
         return
@@ -93,6 +102,41 @@ class Logger:
                 'iterator': self.iterator}
 
 
+class Accumulator:
+    def __init__(self):
+        self.sum = {}
+        self.counter = defaultdict(int)
+
+    def reset(self):
+        self.sum = {}
+        self.counter = defaultdict(int)
+        return
+
+    def append(self, result, n=1):
+        # keep weighted sums on device, nothing is synchronized until flush
+        for k in result:
+            value = result[k].detach().float() * n
+            self.sum[k] = value if k not in self.sum else self.sum[k] + value
+            self.counter[k] += n
+        return
+
+    def flush(self, logger, tag):
+        if len(self.sum) == 0:
+            return
+        names = list(self.sum.keys())
+        value = torch.stack([self.sum[k] for k in names]).cpu().tolist()
+        for k, v in zip(names, value):
+            logger.append({k: v / self.counter[k]}, tag, n=self.counter[k])
+        self.reset()
+        return
+
+
+def make_missing(value):
+    if isinstance(value, list):
+        return [float('nan') for _ in range(len(value))]
+    return float('nan')
+
+
 def make_logger(path):
     logger = Logger(path)
     return logger
@@ -23,6 +23,8 @@ def make_metric(metric_name, tokenizer):
             pivot_name = 'ROUGE'
             for k in metric_name:
                 metric_name[k].extend(['Accuracy'])
+            if cfg['data_name'] in ['fpb'] and cfg['generate_mode'] == 'score':
+                metric_name['test'].extend(['LabelAccuracy'])
             metric_name['test'].extend(['ROUGE'])
         else:
             raise ValueError('Not valid data name')
@@ -54,12 +56,12 @@ def make_metric(metric_name, tokenizer):
 
 
 def Loss(output):
-    loss = output.item()
+    loss = output.detach()
     return loss
 
 
 def Perplexity(output):
-    ppl = output.exp().item()
+    ppl = output.detach().exp()
     return ppl
 
 
@@ -67,16 +69,20 @@ def Accuracy(output, target, topk=1):
     with torch.no_grad():
         if target.dtype != torch.int64:
             target = (target.topk(1, -1, True, True)[1]).view(-1)
-        batch_size = torch.numel(target)
-        pred_k = output.topk(topk, -1, True, True)[1]
+        # padding of the labels is not a prediction
+        batch_size = (target != -100).sum().clamp(min=1)
+        if output.dtype == torch.int64:
+            pred_k = output.unsqueeze(-1)
+        else:
+            pred_k = output.topk(topk, -1, True, True)[1]
         correct_k = pred_k.eq(target.unsqueeze(-1).expand_as(pred_k)).float().sum()
-        acc = (correct_k * (100.0 / batch_size)).item()
+        acc = correct_k * (100.0 / batch_size)
     return acc
 
 
 def RMSE(output, target):
     with torch.no_grad():
-        rmse = F.mse_loss(output, target).sqrt().item()
+        rmse = F.mse_loss(output, target).sqrt()
     return rmse
 
 
@@ -144,6 +150,10 @@ class Metric:
                     metric[split][m] = {'mode': 'batch',
                                         'metric': (
                                             lambda input, output: recur(Accuracy, output['target'], input['target']))}
+                elif m == 'LabelAccuracy':
+                    metric[split][m] = {'mode': 'batch',
+                                        'metric': (
+                                            lambda input, output: recur(Accuracy, output['score'], input['label']))}
                 elif m == 'RMSE':
                     metric[split][m] = {'mode': 'batch',
                                         'metric': (
@@ -162,19 +172,21 @@ class Metric:
                 self.metric[split][metric_name]['metric'].add(input, output)
         return
 
-    def evaluate(self, split, mode, input=None, output=None, metric_name=None):
+    def evaluate(self, split, mode, input=None, output=None, metric_name=None, sync=True):
         metric_name = self.metric_name if metric_name is None else metric_name
         evaluation = {}
         for metric_name_ in metric_name[split]:
             if self.metric[split][metric_name_]['mode'] == mode:
                 evaluation[metric_name_] = self.metric[split][metric_name_]['metric'](input, output)
+        if mode == 'batch' and sync:
+            evaluation = recur(lambda x: x.item(), evaluation)
         return evaluation
 
-    def compare(self, val):
+    def compare(self, val, margin=0):
         if self.pivot_direction == 'down':
-            compared = self.pivot > val
+            compared = self.pivot > val - margin
         elif self.pivot_direction == 'up':
-            compared = self.pivot < val
+            compared = self.pivot < val + margin
         else:
             raise ValueError('Not valid pivot direction')
         return compared
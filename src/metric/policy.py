@@ -0,0 +1,89 @@
+import math
+import numpy as np
+from config import cfg
+
+# worst-case standard deviation of a per-example score, in the units the pivot metric is reported in
+pivot_scale = {'ROUGE': 0.5, 'GLUE': 0.5, 'Accuracy': 50., 'Loss': 0.5}
+
+
+class Policy:
+    def __init__(self, interval, unit, ci, z=1.96):
+        self.interval = interval
+        self.unit = unit
+        self.ci = ci
+        self.z = z
+        self.indices = None
+        self.num_samples = None
+
+    def is_eval(self, epoch):
+        if epoch in [cfg[cfg['model_name']]['num_epochs'], cfg['stop_epoch']]:
+            return True
+        if self.unit == 'epoch':
+            evaluated = epoch % self.interval == 0
+        elif self.unit == 'step':
+            # checkpoints are per epoch, so a step interval is honoured at the first epoch boundary after it
+            num_steps = cfg['num_steps']['train']
+            evaluated = (epoch * num_steps) // self.interval > ((epoch - 1) * num_steps) // self.interval
+        else:
+            raise ValueError('Not valid eval unit')
+        return evaluated
+
+    def is_full(self, epoch):
+        return self.indices is None or epoch in [cfg[cfg['model_name']]['num_epochs'], cfg['stop_epoch']]
+
+    def make_size(self, num_samples):
+        # sample size for a normal confidence interval of half-width ci (relative to the worst-case spread),
+        # with finite population correction
+        size = (self.z / (2 * self.ci)) ** 2
+        size = size / (1 + (size - 1) / num_samples)
+        return min(int(math.ceil(size)), num_samples)
+
+    def make_subset(self, dataset):
+        if self.ci <= 0:
+            self.indices = None
+            return self.indices
+        strata = make_strata(dataset)
+        self.num_samples = len(strata)
+        size = self.make_size(len(strata))
+        if size >= len(strata):
+            self.indices = None
+            return self.indices
+        rng = np.random.default_rng(cfg['seed'])
+        indices = []
+        for s in np.unique(strata):
+            index = np.nonzero(strata == s)[0]
+            size_s = int(round(size * len(index) / len(strata)))
+            indices.append(rng.choice(index, min(max(size_s, 1), len(index)), replace=False))
+        self.indices = np.sort(np.concatenate(indices)).tolist()
+        return self.indices
+
+    def margin(self, metric):
+        # half-width of the subsample confidence interval in metric units, with the finite population correction of
+        # make_size
+        size = len(self.indices)
+        correction = math.sqrt((self.num_samples - size) / max(self.num_samples - 1, 1))
+        margin = self.z * pivot_scale[metric.pivot_name] / math.sqrt(size) * correction
+        return margin
+
+
+def make_strata(dataset, num_bins=4):
+    if cfg['task_name'] in ['ic']:
+        strata = np.asarray(dataset.target)
+    elif 'split' in dataset.column_names:
+        strata = np.asarray(dataset['split'])
+    elif cfg['task_name'] in ['sc'] and cfg['subset_name'] not in ['stsb']:
+        strata = np.asarray(dataset['labels'])
+    else:
+        if cfg['task_name'] in ['sc']:
+            value = np.asarray(dataset['labels'], dtype=np.float32)
+        else:
+            value = np.asarray([sum(x) for x in dataset['attention_mask']], dtype=np.float32)
+        edges = np.quantile(value, np.linspace(0, 1, num_bins + 1)[1:-1])
+        strata = np.digitize(value, edges)
+    return strata
+
+
+def make_policy(dataset):
+    policy = Policy(cfg['eval_interval'], cfg['eval_unit'], cfg['eval_ci'])
+    policy.make_subset(dataset)
+    return policy
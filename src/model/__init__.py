@@ -1,7 +1,17 @@
 from .model import *
 from .huggingface import *
+from .engine import *
 from .linear import *
 from .mlp import *
 from .cnn import *
 from .resnet import *
-from .wresnet import *
\ No newline at end of file
+from .wresnet import *
+from .gather import *
+from .prompt import *
+from .chunk import *
+from .prefix import *
+from .quantize import *
+from .merge import *
+from .compact import *
+from .flat import *
+from .galore import *
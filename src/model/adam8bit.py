@@ -0,0 +1,132 @@
+import math
+import torch
+import torch.optim as optim
+
+
+def make_dynamic_codebook(signed):
+    # dynamic tree quantization, each decade between 1e-6 and 1 gets twice the levels of the one below it, so small
+    # moments keep their relative precision
+    data = [0., 1.]
+    for i in range(7):
+        num_levels = 2 ** i if signed else 2 ** (i + 1)
+        boundary = torch.linspace(0.1, 1, num_levels + 1)
+        mean = ((boundary[:-1] + boundary[1:]) / 2 * 10 ** (i - 6)).tolist()
+        data.extend(mean)
+        if signed:
+            data.extend([-x for x in mean])
+    codebook = torch.tensor(sorted(data))
+    return codebook
+
+
+class AdamW8bit(optim.Optimizer):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2, block_size=256,
+                 rounding='stochastic', min_8bit_size=4096, chunk_size=2 ** 20):
+        if rounding not in ['stochastic', 'nearest']:
+            raise ValueError('Not valid rounding')
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+        self.block_size = block_size
+        self.rounding = rounding
+        self.min_8bit_size = min_8bit_size
+        # blocks are updated a chunk at a time, so at most one chunk of the moments is held in full precision
+        self.chunk_size = chunk_size // block_size * block_size
+        self.codebook = {'exp_avg': make_dynamic_codebook(True), 'exp_avg_sq': make_dynamic_codebook(False)}
+
+    def quantize(self, x, key):
+        # every block is scaled by its absmax and each element is mapped to a level of the codebook, stochastic
+        # rounding picks one of the two neighbouring levels with the probability that keeps the expectation
+        codebook = self.codebook[key].to(x.device)
+        x = x.view(-1, self.block_size)
+        absmax = x.abs().amax(dim=1, keepdim=True).clamp(min=1e-12)
+        x = (x / absmax).clamp(codebook[0], codebook[-1])
+        if self.rounding == 'stochastic':
+            lower = (torch.searchsorted(codebook, x, right=True) - 1).clamp(0, len(codebook) - 2)
+            low, high = codebook[lower], codebook[lower + 1]
+            prob = (x - low) / (high - low)
+            code = lower + (torch.rand_like(x) < prob).long()
+        else:
+            code = torch.bucketize(x, (codebook[1:] + codebook[:-1]) / 2)
+        if key == 'exp_avg_sq':
+            # a second moment rounded to zero would divide the first one by eps alone
+            code = torch.where(x > 0, code.clamp(min=1), code)
+        return code.to(torch.uint8).view(-1), absmax.view(-1)
+
+    def dequantize(self, code, absmax, key):
+        codebook = self.codebook[key].to(code.device)
+        x = codebook[code.long()].view(-1, self.block_size) * absmax.view(-1, 1)
+        return x.view(-1)
+
+    def init_state(self, p):
+        state = self.state[p]
+        state['step'] = torch.tensor(0.)
+        if p.numel() < self.min_8bit_size:
+            # small tensors such as biases and norms keep full precision moments
+            state['exp_avg'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+            state['exp_avg_sq'] = torch.zeros_like(p, memory_format=torch.preserve_format)
+        else:
+            numel = math.ceil(p.numel() / self.block_size) * self.block_size
+            for key in ['exp_avg', 'exp_avg_sq']:
+                state['{}_code'.format(key)], state['{}_absmax'.format(key)] = \
+                    self.quantize(torch.zeros(numel, device=p.device), key)
+        return
+
+    def load_state_dict(self, state_dict):
+        # states are cast to the dtype of their parameter on loading, the codes and scales are put back as saved
+        super().load_state_dict(state_dict)
+        params = [p for group in self.param_groups for p in group['params']]
+        index = [i for group in state_dict['param_groups'] for i in group['params']]
+        for p, i in zip(params, index):
+            for key, value in state_dict['state'].get(i, {}).items():
+                if key.endswith('_code') or key.endswith('_absmax'):
+                    self.state[p][key] = value.to(p.device, copy=True)
+        return
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise ValueError('Not valid sparse gradient')
+                state = self.state[p]
+                if len(state) == 0:
+                    self.init_state(p)
+                state['step'] += 1
+                step = state['step'].item()
+                step_size = group['lr'] / (1 - beta1 ** step)
+                bias_correction2_sqrt = math.sqrt(1 - beta2 ** step)
+                p.mul_(1 - group['lr'] * group['weight_decay'])
+                if 'exp_avg' in state:
+                    exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                    exp_avg.lerp_(p.grad, 1 - beta1)
+                    exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+                    denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt).add_(group['eps'])
+                    p.addcdiv_(exp_avg, denom, value=-step_size)
+                    continue
+                param, grad = p.view(-1), p.grad.reshape(-1)
+                num_blocks = self.chunk_size // self.block_size
+                for i in range(0, param.numel(), self.chunk_size):
+                    param_i, grad_i = param[i:i + self.chunk_size], grad[i:i + self.chunk_size]
+                    block = slice(i // self.block_size, i // self.block_size + num_blocks)
+                    index = slice(i, i + num_blocks * self.block_size)
+                    moment = []
+                    for key in ['exp_avg', 'exp_avg_sq']:
+                        code, absmax = state['{}_code'.format(key)], state['{}_absmax'.format(key)]
+                        moment.append(self.dequantize(code[index], absmax[block], key))
+                    exp_avg, exp_avg_sq = moment
+                    size = param_i.numel()
+                    exp_avg[:size].lerp_(grad_i.float(), 1 - beta1)
+                    exp_avg_sq[:size].mul_(beta2).addcmul_(grad_i.float(), grad_i.float(), value=1 - beta2)
+                    denom = (exp_avg_sq[:size].sqrt() / bias_correction2_sqrt).add_(group['eps'])
+                    param_i.add_((exp_avg[:size] / denom * -step_size).to(p.dtype))
+                    for key, x in zip(['exp_avg', 'exp_avg_sq'], moment):
+                        code, absmax = self.quantize(x, key)
+                        state['{}_code'.format(key)][index] = code
+                        state['{}_absmax'.format(key)][block] = absmax
+        return loss
@@ -0,0 +1,89 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from config import cfg
+from .continuous import unwrap
+
+
+class HiddenHead(nn.Module):
+    def forward(self, x):
+        return x
+
+
+def head_forward(head, bias, hidden):
+    logits = head(hidden).float()
+    if bias is not None:
+        logits = logits + bias[0].float()
+    return logits
+
+
+def chunk_loss(head, bias, hidden, target):
+    logits = head_forward(head, bias, hidden)
+    loss = F.cross_entropy(logits, target, reduction='sum')
+    pred = logits.detach().argmax(dim=-1)
+    return loss, pred
+
+
+def chunked_lm_forward(model, input, chunk_size):
+    # the model returns its last hidden states, the LM head and cross-entropy only run at labeled positions, a chunk
+    # at a time, and the logits of a chunk are recomputed in backward instead of being kept
+    net = unwrap(model)
+    head = net.get_output_embeddings()
+    head_name = next(k for k, v in net.named_modules() if v is head)
+    parent_name, _, child_name = head_name.rpartition('.')
+    parent = net.get_submodule(parent_name) if parent_name else net
+    bias = getattr(net, 'final_logits_bias', None)
+    labels = input['labels']
+    kwargs = {k: input[k] for k in input if k != 'labels'}
+    if net.config.is_encoder_decoder:
+        kwargs['decoder_input_ids'] = net.prepare_decoder_input_ids_from_labels(labels=labels)
+    setattr(parent, child_name, HiddenHead())
+    if bias is not None:
+        net.final_logits_bias = bias.new_zeros(1, head.weight.size(1))
+    try:
+        output = model(**kwargs)
+    finally:
+        setattr(parent, child_name, head)
+        if bias is not None:
+            net.final_logits_bias = bias
+    # prompt learning prepends virtual tokens to decoder-only inputs
+    hidden_ = output['logits'][:, -labels.size(1):]
+    # a prediction is kept at the position that makes it, as the logits of the unchunked forward are
+    pred = torch.full_like(labels, -1)
+    if net.config.is_encoder_decoder:
+        hidden, target, pred_ = hidden_, labels, pred
+    else:
+        hidden, target, pred_ = hidden_[:, :-1], labels[:, 1:], pred[:, :-1]
+    mask = target != -100
+    hidden, target = hidden[mask], target[mask]
+    loss, pred_chunk = [], []
+    for i in range(0, target.size(0), chunk_size):
+        if torch.is_grad_enabled():
+            loss_i, pred_i = checkpoint(chunk_loss, head, bias, hidden[i:i + chunk_size], target[i:i + chunk_size],
+                                        use_reentrant=False)
+        else:
+            loss_i, pred_i = chunk_loss(head, bias, hidden[i:i + chunk_size], target[i:i + chunk_size])
+        loss.append(loss_i)
+        pred_chunk.append(pred_i)
+    if len(loss) > 0:
+        loss = torch.stack(loss).sum() / target.size(0)
+        pred_[mask] = torch.cat(pred_chunk)
+    else:
+        loss = hidden.sum() * 0
+    # Accuracy counts the labeled positions, the last one of a decoder-only row predicts no label and is filled in
+    missing = (labels != -100) & (pred == -1)
+    if missing.any():
+        with torch.no_grad():
+            pred[missing] = head_forward(head, bias, hidden_[missing]).argmax(dim=-1)
+    # predictions at the label positions stand in for the logits, Accuracy takes either
+    output = {'loss': loss, 'logits': pred}
+    return output
+
+
+def lm_forward(model, input):
+    if cfg['loss_chunk_size'] > 0 and cfg['task_name'] in ['s2s', 'clm']:
+        output = chunked_lm_forward(model, input, cfg['loss_chunk_size'])
+    else:
+        output = model(**input)
+    return output
@@ -0,0 +1,491 @@
+import copy
+import math
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+from transformers.pytorch_utils import Conv1D
+from peft.utils import TRANSFORMERS_MODELS_TO_LORA_TARGET_MODULES_MAPPING
+from config import cfg
+
+
+class LowRank(nn.Module):
+    def __init__(self, in_features, out_features, rank):
+        super().__init__()
+        self.A = nn.Linear(in_features, rank, bias=False)
+        self.B = nn.Linear(rank, out_features, bias=False)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.kaiming_uniform_(self.A.weight, a=math.sqrt(5))
+        nn.init.zeros_(self.B.weight)
+        return
+
+    def delta_weight(self):
+        return self.B.weight @ self.A.weight
+
+    def forward(self, x):
+        x = self.B(self.A(x))
+        return x
+
+
+class Linear(nn.Module):
+    def __init__(self, in_features, out_features):
+        super().__init__()
+        self.linear = nn.Linear(in_features, out_features, bias=False)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.zeros_(self.linear.weight)
+        return
+
+    def delta_weight(self):
+        return self.linear.weight
+
+    def forward(self, x):
+        x = self.linear(x)
+        return x
+
+
+class MLP(nn.Module):
+    def __init__(self, in_features, out_features, hidden_size):
+        super().__init__()
+        self.blocks = nn.Sequential(nn.Linear(in_features, hidden_size), nn.ReLU())
+        self.linear = nn.Linear(hidden_size, out_features)
+        nn.init.zeros_(self.linear.weight)
+        nn.init.zeros_(self.linear.bias)
+
+    def forward(self, x):
+        x = self.linear(self.blocks(x))
+        return x
+
+
+class ColALayer(nn.Module):
+    def __init__(self, base, aux):
+        super().__init__()
+        self.base = base
+        self.aux = aux
+        self.split = None
+        self.active = True
+        self.input = []
+        self.grad = []
+        self.route = []
+
+    def hook(self, grad):
+        self.grad.append(grad.detach())
+        return
+
+    def forward(self, x, *args, **kwargs):
+        y = self.base(x, *args, **kwargs)
+        # the local adapter copy is frozen, backward only passes through it to the input and leaves the gradient
+        # of its output in the hook for the workers. A freshly reset adapter is zero, so it is skipped and the
+        # gradient is taken at the base output, which is the same
+        if self.active:
+            delta = self.route_forward(x.float()).to(y.dtype)
+        else:
+            delta = None
+        if self.training and torch.is_grad_enabled():
+            self.input.append(x.detach())
+            if self.split is not None:
+                self.route.append(self.split.view(-1, *[1] * (x.dim() - 2)).expand(x.size()[:-1]))
+            if delta is None:
+                if not y.requires_grad:
+                    y.requires_grad_(True)
+                y.register_hook(self.hook)
+            else:
+                if not delta.requires_grad:
+                    delta.requires_grad_(True)
+                delta.register_hook(self.hook)
+        if delta is not None:
+            y = y + delta
+        return y
+
+    def route_forward(self, x):
+        if self.split is None:
+            return self.aux[0](x)
+        # every example goes through the adapter of its own split
+        delta = None
+        for i in torch.unique(self.split).tolist():
+            index = self.split == i
+            delta_i = self.aux[i](x[index])
+            if delta is None:
+                delta = x.new_zeros(*x.size()[:-1], delta_i.size(-1))
+            delta[index] = delta_i
+        return delta
+
+    def pop(self):
+        # hooks fire in reverse call order
+        input, grad, route = self.input, self.grad[::-1], self.route
+        self.input, self.grad, self.route = [], [], []
+        if len(grad) != len(input):
+            return None
+        x = torch.cat([x_.reshape(-1, x_.size(-1)) for x_ in input], dim=0)
+        g = torch.cat([g_.reshape(-1, g_.size(-1)) for g_ in grad], dim=0)
+        # padded positions carry no gradient, so they are not worth copying to the workers
+        mask = g.abs().sum(dim=-1) > 0
+        x, g = x[mask].to('cpu', torch.float32), g[mask].to('cpu', torch.float32)
+        s = torch.cat([s_.reshape(-1) for s_ in route], dim=0)[mask].cpu() if len(route) > 0 else None
+        return x, g, s
+
+
+class ColA(nn.Module):
+    def __init__(self, model, target_modules, aux_name, interval, num_workers, num_adapters=1):
+        super().__init__()
+        self.model = model
+        self.aux_name = aux_name
+        self.num_adapters = num_adapters
+        self.interval = interval
+        self.num_workers = num_workers
+        for param in self.model.parameters():
+            param.requires_grad_(False)
+        if cfg['task_name'] == 'sc':
+            # the classification head is randomly initialized, it is trained in place with the main optimizer
+            for k, v in self.model.named_parameters():
+                if 'classifier' in k or 'score' in k:
+                    v.requires_grad_(True)
+        # the shared adapters live in CPU shared memory and are not registered, so model.to() leaves them in place
+        self.shared = {}
+        self.layer = {}
+        for name in [k for k, v in self.model.named_modules() if is_target(k, v, target_modules)]:
+            base = self.model.get_submodule(name)
+            in_features, out_features = make_features(base)
+            self.shared[name] = nn.ModuleList([make_aux_model(aux_name, in_features, out_features)
+                                               for _ in range(num_adapters)]).share_memory()
+            aux = copy.deepcopy(self.shared[name]).requires_grad_(False)
+            layer = ColALayer(base, aux)
+            parent_name, _, child_name = name.rpartition('.')
+            parent = self.model.get_submodule(parent_name) if parent_name else self.model
+            setattr(parent, child_name, layer)
+            self.layer[name] = layer
+        self.buffer = {name: [] for name in self.layer}
+        self.merged = {name: None for name in self.layer}
+        self.num_steps = 0
+        self.worker = []
+        self.pending = False
+        self.fresh = False
+
+    def set_split(self, split):
+        for name in self.layer:
+            self.layer[name].split = split if self.num_adapters > 1 else None
+        return
+
+    def forward(self, **input):
+        self.set_split(input.pop('split', None))
+        return self.model(**input)
+
+    def generate(self, **input):
+        self.set_split(input.pop('split', None))
+        return self.model.generate(**input)
+
+    def parameters_to_optimize(self):
+        # the shared adapters are stepped by the workers, they are listed so the scheduler drives their learning rate
+        parameters = [param for param in self.model.parameters() if param.requires_grad]
+        for name in self.shared:
+            parameters.extend(self.shared[name].parameters())
+        return parameters
+
+    def print_trainable_parameters(self):
+        num_trainable = sum(param.numel() for param in self.parameters_to_optimize())
+        num_all = sum(param.numel() for param in self.model.parameters() if not is_aux(param, self.layer)) + \
+                  sum(param.numel() for name in self.shared for param in self.shared[name].parameters())
+        print('trainable params: {} || all params: {} || trainable%: {}'.format(num_trainable, num_all,
+                                                                                100 * num_trainable / num_all))
+        return
+
+    def start(self):
+        # fork, so the workers inherit cfg and the shared adapters without pickling them
+        context = mp.get_context('fork')
+        name = list(self.shared.keys())
+        num_workers = max(min(self.num_workers, len(name)), 1)
+        for i in range(num_workers):
+            shared_i = {k: self.shared[k] for k in name[i::num_workers]}
+            queue_in, queue_out = context.Queue(), context.Queue()
+            process = context.Process(target=run_worker, args=(shared_i, queue_in, queue_out, cfg['model_name'],
+                                                               num_workers), daemon=True)
+            process.start()
+            self.worker.append({'name': list(shared_i.keys()), 'queue_in': queue_in, 'queue_out': queue_out,
+                                'process': process})
+        return
+
+    def close(self):
+        for worker in self.worker:
+            worker['queue_in'].put(None)
+        for worker in self.worker:
+            worker['process'].join()
+        self.worker = []
+        return
+
+    def wait(self):
+        if self.pending:
+            for worker in self.worker:
+                worker['queue_out'].get()
+            self.pending = False
+            self.fresh = False
+        return
+
+    def sync(self):
+        with torch.no_grad():
+            for name in self.layer:
+                for param, shared_param in zip(self.layer[name].aux.parameters(), self.shared[name].parameters()):
+                    param.copy_(shared_param)
+                self.layer[name].active = not self.fresh
+        return
+
+    def dispatch(self, lr):
+        # adapters in use lag the workers by one interval, the base model only blocks if the workers fall behind
+        self.wait()
+        self.sync()
+        num_steps = self.num_steps % self.interval if self.num_steps % self.interval > 0 else self.interval
+        for worker in self.worker:
+            data = {}
+            for name in worker['name']:
+                if len(self.buffer[name]) > 0:
+                    data[name] = (torch.cat([x[0] for x in self.buffer[name]], dim=0),
+                                  torch.cat([x[1] for x in self.buffer[name]], dim=0),
+                                  torch.cat([x[2] for x in self.buffer[name]], dim=0)
+                                  if self.buffer[name][0][2] is not None else None)
+            worker['queue_in'].put({'mode': 'update', 'lr': lr, 'num_steps': num_steps, 'data': data})
+        self.buffer = {name: [] for name in self.layer}
+        self.pending = True
+        return
+
+    def step(self, lr):
+        for name in self.layer:
+            pair = self.layer[name].pop()
+            if pair is not None:
+                self.buffer[name].append(pair)
+        self.num_steps += 1
+        if self.num_steps % self.interval == 0:
+            self.dispatch(lr)
+        return
+
+    def flush(self, lr):
+        if any(len(self.buffer[name]) > 0 for name in self.buffer):
+            self.dispatch(lr)
+        self.wait()
+        self.sync()
+        return
+
+    def cola_state_dict(self):
+        # one state dict per adapter, each with the optimizer state the workers keep for it
+        head = {k: v.detach().cpu().clone() for k, v in self.model.named_parameters() if v.requires_grad}
+        optimizer_state_dict = self.optimizer_state_dict()
+        state_dict = []
+        for i in range(self.num_adapters):
+            aux = {name: {k: v.detach().clone() for k, v in self.shared[name][i].state_dict().items()}
+                   for name in self.shared}
+            state_dict.append({'aux': aux, 'head': head, 'optimizer_state_dict': optimizer_state_dict[i],
+                               'merged': self.merged})
+        return state_dict
+
+    def load_cola_state_dict(self, state_dict):
+        # the base model is freshly loaded, so the merged delta is folded in again
+        if state_dict[0].get('merged') is not None:
+            with torch.no_grad():
+                for name in self.layer:
+                    if state_dict[0]['merged'][name] is not None:
+                        self.add_delta_weight(name, merged_delta_weight(state_dict[0]['merged'][name]))
+            self.merged = state_dict[0]['merged']
+        for i in range(self.num_adapters):
+            for name in self.shared:
+                self.shared[name][i].load_state_dict(state_dict[i]['aux'][name])
+        with torch.no_grad():
+            for k, v in self.model.named_parameters():
+                if k in state_dict[0]['head']:
+                    v.copy_(state_dict[0]['head'][k])
+        self.sync()
+        if len(self.worker) > 0:
+            self.load_optimizer_state_dict([x['optimizer_state_dict'] for x in state_dict])
+        return
+
+    def optimizer_state_dict(self):
+        if len(self.worker) == 0:
+            return [None for _ in range(self.num_adapters)]
+        for worker in self.worker:
+            worker['queue_in'].put({'mode': 'state_dict'})
+        state_dict = [worker['queue_out'].get() for worker in self.worker]
+        return [[state_dict_w[i] for state_dict_w in state_dict] for i in range(self.num_adapters)]
+
+    def load_optimizer_state_dict(self, state_dict):
+        for w, worker in enumerate(self.worker):
+            state_dict_w = [state_dict_i[w] for state_dict_i in state_dict]
+            worker['queue_in'].put({'mode': 'load_state_dict', 'state_dict': state_dict_w})
+        for worker in self.worker:
+            worker['queue_out'].get()
+        return
+
+    def add_delta_weight(self, name, delta_weight):
+        base = self.layer[name].base
+        delta_weight = delta_weight.t() if isinstance(base, Conv1D) else delta_weight
+        base.weight.add_(delta_weight.to(base.weight.device, base.weight.dtype))
+        return
+
+    def merge(self):
+        # fold the adapter into the base weights and restart it from scratch with a fresh optimizer
+        if self.aux_name not in ['lowrank', 'linear']:
+            raise ValueError('Not valid aux model name for merge')
+        if self.num_adapters > 1:
+            raise ValueError('Not valid number of adapters for merge')
+        self.wait()
+        with torch.no_grad():
+            for name in self.layer:
+                aux = self.shared[name][0]
+                self.add_delta_weight(name, aux.delta_weight())
+                self.merged[name] = merge_delta(self.merged[name], aux)
+                aux.reset_parameters()
+        # until the workers land an update, the adapter is zero and the forward runs at base model cost
+        self.fresh = True
+        self.sync()
+        for worker in self.worker:
+            worker['queue_in'].put({'mode': 'reset'})
+        for worker in self.worker:
+            worker['queue_out'].get()
+        return
+
+    def merge_and_unload(self):
+        if self.aux_name not in ['lowrank', 'linear']:
+            raise ValueError('Not valid aux model name for merge')
+        if self.num_adapters > 1:
+            raise ValueError('Not valid number of adapters for merge')
+        with torch.no_grad():
+            for name in self.layer:
+                base = self.layer[name].base
+                self.add_delta_weight(name, self.shared[name][0].delta_weight())
+                parent_name, _, child_name = name.rpartition('.')
+                parent = self.model.get_submodule(parent_name) if parent_name else self.model
+                setattr(parent, child_name, base)
+        return self.model
+
+
+def run_worker(shared, queue_in, queue_out, tag, num_workers):
+    from .model import make_optimizer
+    torch.set_num_threads(max(torch.get_num_threads() // num_workers, 1))
+    num_adapters = len(next(iter(shared.values())))
+
+    def make_worker_optimizer():
+        return [make_optimizer([param for name in shared for param in shared[name][i].parameters()], tag)
+                for i in range(num_adapters)]
+
+    optimizer = make_worker_optimizer()
+    while True:
+        message = queue_in.get()
+        if message is None:
+            break
+        if message['mode'] == 'update':
+            for optimizer_i in optimizer:
+                for param_group in optimizer_i.param_groups:
+                    param_group['lr'] = message['lr']
+                optimizer_i.zero_grad()
+            for name in message['data']:
+                x, g, s = message['data'][name]
+                # d(loss)/d(aux) = sum(g * d(aux(x))/d(aux)), averaged over the steps of the interval
+                if s is None:
+                    loss = (shared[name][0](x) * g).sum() / message['num_steps']
+                else:
+                    # rescale by the share of each split, so every adapter sees the mean loss over its own examples
+                    loss = 0
+                    for i in torch.unique(s).tolist():
+                        index = s == i
+                        loss = loss + (shared[name][i](x[index]) * g[index]).sum() * (len(s) / index.sum())
+                    loss = loss / message['num_steps']
+                loss.backward()
+            # adapters without examples in this interval have no gradient and are skipped by their optimizer
+            for optimizer_i in optimizer:
+                optimizer_i.step()
+            queue_out.put(None)
+        elif message['mode'] == 'state_dict':
+            queue_out.put([optimizer_i.state_dict() for optimizer_i in optimizer])
+        elif message['mode'] == 'load_state_dict':
+            for optimizer_i, state_dict_i in zip(optimizer, message['state_dict']):
+                optimizer_i.load_state_dict(state_dict_i)
+            queue_out.put(None)
+        elif message['mode'] == 'reset':
+            optimizer = make_worker_optimizer()
+            queue_out.put(None)
+        else:
+            raise ValueError('Not valid worker mode')
+    return
+
+
+def merge_delta(merged, aux):
+    # low-rank deltas are kept as stacked factors, B_1 A_1 + B_2 A_2 = [B_1, B_2] [A_1; A_2], until dense is smaller
+    if isinstance(aux, LowRank):
+        A, B = aux.A.weight.detach().clone(), aux.B.weight.detach().clone()
+        if merged is None:
+            return {'A': A, 'B': B}
+        if 'weight' not in merged:
+            A, B = torch.cat([merged['A'], A], dim=0), torch.cat([merged['B'], B], dim=1)
+            if A.size(0) * (A.size(1) + B.size(0)) < A.size(1) * B.size(0):
+                return {'A': A, 'B': B}
+            return {'weight': B @ A}
+        return {'weight': merged['weight'] + B @ A}
+    delta_weight = aux.delta_weight().detach().clone()
+    if merged is None:
+        return {'weight': delta_weight}
+    return {'weight': merged_delta_weight(merged) + delta_weight}
+
+
+def merged_delta_weight(merged):
+    if 'weight' in merged:
+        return merged['weight']
+    return merged['B'] @ merged['A']
+
+
+def is_target(name, module, target_modules):
+    if target_modules is None:
+        return isinstance(module, nn.Linear)
+    return isinstance(module, (nn.Linear, Conv1D)) and \
+        any(name == target or name.endswith('.{}'.format(target)) for target in target_modules)
+
+
+def is_aux(param, layer):
+    return any(param is aux_param for name in layer for aux_param in layer[name].aux.parameters())
+
+
+def make_features(base):
+    if isinstance(base, nn.Linear):
+        return base.in_features, base.out_features
+    elif isinstance(base, Conv1D):
+        return base.weight.size(0), base.weight.size(1)
+    else:
+        raise ValueError('Not valid base module')
+
+
+def make_aux_model(aux_name, in_features, out_features):
+    if aux_name == 'lowrank':
+        aux = LowRank(in_features, out_features, cfg['cola']['rank'])
+    elif aux_name == 'linear':
+        aux = Linear(in_features, out_features)
+    elif aux_name == 'mlp':
+        aux = MLP(in_features, out_features, cfg['cola']['hidden_size'])
+    else:
+        raise ValueError('Not valid aux model name')
+    return aux
+
+
+def make_target_modules(model):
+    if cfg['task_name'] in ['s2s', 'sc', 'clm']:
+        target_modules = TRANSFORMERS_MODELS_TO_LORA_TARGET_MODULES_MAPPING[model.config.model_type]
+    elif cfg['task_name'] == 't2i':
+        target_modules = cfg[cfg['model_name']]['UNET_TO_COLA_TARGET_MODULES_MAPPING']
+    elif cfg['task_name'] == 'ic':
+        target_modules = None
+    else:
+        raise ValueError('Not valid task name')
+    return target_modules
+
+
+def make_cola(model):
+    target_modules = make_target_modules(model)
+    if cfg['quantize_mode'] != 'none' and cfg['cola']['merge'] > 0:
+        raise ValueError('Not valid merge for quantized model')
+    if cfg['cola']['dist'] == 1:
+        if 'num_split' not in cfg:
+            raise ValueError('Not valid data name for dist')
+        if cfg['cola']['merge'] > 0:
+            raise ValueError('Not valid merge for dist')
+        num_adapters = cfg['num_split']
+    else:
+        num_adapters = 1
+    model = ColA(model, target_modules, cfg['cola']['model_name'], cfg['cola']['interval'],
+                 cfg['cola']['num_workers'], num_adapters)
+    return model
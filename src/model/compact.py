@@ -0,0 +1,110 @@
+import os
+import torch
+from peft import LoraConfig, get_peft_model_state_dict
+from peft.tuners.lora import LoraLayer
+from peft.tuners.adalora import AdaLoraLayer
+from safetensors.torch import save_file
+
+
+def get_lora_factors(model):
+    # the delta of every adapted module as B @ A, with the scaling folded into A and pruned ranks dropped
+    adapter_name = model.active_adapter
+    factors = {}
+    for name, module in model.base_model.model.named_modules():
+        if not isinstance(module, LoraLayer) or adapter_name not in module.lora_A:
+            continue
+        with torch.no_grad():
+            if isinstance(module, AdaLoraLayer):
+                E = module.lora_E[adapter_name]
+                keep = E.view(-1) != 0
+                scaling = module.scaling[adapter_name] / (module.ranknum[adapter_name].item() + 1e-5)
+                A = (module.lora_A[adapter_name] * E)[keep] * scaling
+                B = module.lora_B[adapter_name][:, keep]
+            else:
+                A = module.lora_A[adapter_name].weight * module.scaling[adapter_name]
+                B = module.lora_B[adapter_name].weight
+        factors[name] = (B.detach().clone(), A.detach().clone())
+    return factors
+
+
+def svd_lora_factors(B, A):
+    # B @ A = (Q_B U) S (Q_A V)^T with the SVD of the small r x r core, the full delta is never formed
+    B_, A_ = B.reshape(B.size(0), -1).float(), A.reshape(A.size(0), -1).float()
+    Q_B, R_B = torch.linalg.qr(B_)
+    Q_A, R_A = torch.linalg.qr(A_.t())
+    U, S, Vh = torch.linalg.svd(R_B @ R_A.t())
+    return Q_B @ U, S, Q_A @ Vh.t()
+
+
+def truncate_lora_factors(factors, rank_error=0., rank_budget=0.):
+    # per-module ranks either keep the relative Frobenius error of every delta within rank_error, or keep the
+    # singular directions with the most relative energy per parameter within rank_budget of the adapter size
+    svd = {}
+    for name, (B, A) in factors.items():
+        if A.size(0) > 0:
+            svd[name] = svd_lora_factors(B, A)
+    rank = {name: 0 for name in factors}
+    if rank_error > 0:
+        for name, (U, S, V) in svd.items():
+            tail = S.pow(2).flip(0).cumsum(0).flip(0).sqrt() / S.norm().clamp(min=1e-12)
+            rank[name] = int((tail > rank_error).sum().item())
+    elif rank_budget > 0:
+        budget = rank_budget * sum(B.numel() + A.numel() for B, A in factors.values())
+        candidate = []
+        for name, (U, S, V) in svd.items():
+            energy = S.pow(2) / S.pow(2).sum().clamp(min=1e-12)
+            cost = factors[name][0].size(0) + factors[name][1][0].numel()
+            candidate.extend((energy[i].item() / cost, name, cost) for i in range(len(S)))
+        # singular values are sorted, so the picks of a module are always its leading directions
+        for _, name, cost in sorted(candidate, key=lambda x: -x[0]):
+            if cost > budget:
+                continue
+            rank[name] += 1
+            budget -= cost
+    else:
+        raise ValueError('Not valid rank reduction')
+    truncated = {}
+    for name, (B, A) in factors.items():
+        k = rank[name]
+        if k == 0:
+            truncated[name] = (B[:, :0], A[:0])
+            continue
+        U, S, V = svd[name]
+        scale = S[:k].sqrt()
+        B_ = (U[:, :k] * scale).to(B.dtype).view(B.size(0), k, *B.size()[2:])
+        A_ = (V[:, :k] * scale).t().to(A.dtype).reshape(k, *A.size()[1:])
+        truncated[name] = (B_, A_)
+    return truncated
+
+
+def make_lora_adapter(model, factors):
+    # a plain LoRA adapter with the rank of each module, alpha equals rank so the scaling is one
+    peft_config = model.peft_config[model.active_adapter]
+    factors = {k: v for k, v in factors.items() if v[1].size(0) > 0}
+    if len(factors) == 0:
+        raise ValueError('Not valid rank for adapter')
+    rank = {k: v[1].size(0) for k, v in factors.items()}
+    lora_config = LoraConfig(task_type=peft_config.task_type, target_modules=list(rank), r=max(rank.values()),
+                             lora_alpha=max(rank.values()), rank_pattern=rank, alpha_pattern=rank,
+                             lora_dropout=peft_config.lora_dropout, fan_in_fan_out=peft_config.fan_in_fan_out,
+                             bias=peft_config.bias, modules_to_save=peft_config.modules_to_save,
+                             base_model_name_or_path=peft_config.base_model_name_or_path)
+    # trained heads and biases are carried over as saved, the adapter weights are replaced
+    state_dict = get_peft_model_state_dict(model)
+    state_dict = {k: v for k, v in state_dict.items() if not {'lora_A', 'lora_B', 'lora_E'} & set(k.split('.'))}
+    for name, (B, A) in factors.items():
+        state_dict['base_model.model.{}.lora_A.weight'.format(name)] = A.contiguous()
+        state_dict['base_model.model.{}.lora_B.weight'.format(name)] = B.contiguous()
+    return lora_config, state_dict
+
+
+def save_lora_adapter(path, lora_config, state_dict):
+    os.makedirs(path, exist_ok=True)
+    lora_config.save_pretrained(path)
+    state_dict = {k: v.detach().cpu().contiguous() for k, v in state_dict.items()}
+    save_file(state_dict, os.path.join(path, 'adapter_model.safetensors'), metadata={'format': 'pt'})
+    return
+
+
+def count_adapter_parameters(factors):
+    return sum(B.numel() + A.numel() for B, A in factors.values())
@@ -0,0 +1,308 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from peft import PeftModel
+from config import cfg
+
+
+class PositionOverride(nn.Module):
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+        self.position_ids = None
+
+    def forward(self, input, *args, **kwargs):
+        # learned decoder positions follow the cache length shared by the whole batch, while every slot has its own
+        position = F.embedding(self.position_ids + self.base.offset, self.base.weight)
+        return position
+
+
+class ContinuousGenerator:
+    def __init__(self, model, num_slots, max_new_tokens, eos_token_id, no_repeat_ngram_size=0):
+        self.model = model
+        self.net = unwrap(model)
+        self.num_slots = num_slots
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+        self.no_repeat_ngram_size = no_repeat_ngram_size
+        self.encoder_decoder = self.net.config.is_encoder_decoder
+        generation_config = self.net.generation_config
+        self.forced_bos_token_id = getattr(generation_config, 'forced_bos_token_id', None)
+        self.forced_eos_token_id = getattr(generation_config, 'forced_eos_token_id', None)
+        self.decoder_start_token_id = getattr(generation_config, 'decoder_start_token_id', None)
+        if self.decoder_start_token_id is None:
+            self.decoder_start_token_id = getattr(self.net.config, 'decoder_start_token_id', None)
+        self.position = None
+        if self.encoder_decoder:
+            decoder = self.net.get_decoder()
+            if hasattr(decoder, 'embed_positions') and hasattr(decoder.embed_positions, 'offset'):
+                self.position = PositionOverride(decoder.embed_positions)
+
+    def route(self, split):
+        if split is not None:
+            self.model.set_split(split)
+        return
+
+    def prefill(self, prompt):
+        device = next(self.net.parameters()).device
+        length = max(x[0].size(0) for x in prompt)
+        input_ids = torch.full((len(prompt), length), cfg['pad_token_id'], dtype=torch.long, device=device)
+        attention_mask = torch.zeros((len(prompt), length), dtype=torch.long, device=device)
+        split = torch.tensor([x[1] for x in prompt], device=device) if prompt[0][1] is not None else None
+        self.route(split)
+        state = {'split': split}
+        if self.encoder_decoder:
+            for i in range(len(prompt)):
+                input_ids[i, :prompt[i][0].size(0)] = prompt[i][0]
+                attention_mask[i, :prompt[i][0].size(0)] = 1
+            encoder_hidden = self.net.get_encoder()(input_ids=input_ids, attention_mask=attention_mask)[0]
+            token = torch.full((len(prompt),), self.decoder_start_token_id, dtype=torch.long, device=device)
+            output = self.decode(token, torch.ones_like(token)[:, None], torch.zeros_like(token), None,
+                                 encoder_hidden, attention_mask)
+            state.update({'mask': torch.ones_like(token)[:, None], 'position': torch.ones_like(token),
+                          'encoder_hidden': encoder_hidden, 'encoder_mask': attention_mask})
+            history = [[self.decoder_start_token_id] for _ in range(len(prompt))]
+        else:
+            # decoder-only prompts are left padded, every row counts its positions from its first token
+            for i in range(len(prompt)):
+                input_ids[i, length - prompt[i][0].size(0):] = prompt[i][0]
+                attention_mask[i, length - prompt[i][0].size(0):] = 1
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+            output = self.net(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                              use_cache=True)
+            state.update({'mask': attention_mask, 'position': attention_mask.sum(-1)})
+            history = [x[0].tolist() for x in prompt]
+        state['past'] = to_legacy_cache(output['past_key_values'])
+        logits = output['logits'][:, -1].float()
+        return state, logits, history
+
+    def decode(self, token, mask, position, past, encoder_hidden=None, encoder_mask=None):
+        past = from_legacy_cache(past) if past is not None else None
+        if token.dim() == 1:
+            token, position = token[:, None], position[:, None]
+        if self.encoder_decoder:
+            if self.position is not None:
+                self.position.position_ids = position
+            output = self.net(encoder_outputs=(encoder_hidden,), attention_mask=encoder_mask,
+                              decoder_input_ids=token, decoder_attention_mask=mask, past_key_values=past,
+                              use_cache=True)
+        else:
+            output = self.net(input_ids=token, attention_mask=mask, position_ids=position, past_key_values=past,
+                              use_cache=True)
+        return output
+
+    def select(self, logits, history, generated):
+        for i in range(logits.size(0)):
+            if len(generated[i]) == 0 and self.forced_bos_token_id is not None and self.encoder_decoder:
+                logits[i] = -float('inf')
+                logits[i, self.forced_bos_token_id] = 0
+            elif len(generated[i]) == self.max_new_tokens - 1 and self.forced_eos_token_id is not None and \
+                    self.encoder_decoder:
+                logits[i] = -float('inf')
+                logits[i, self.forced_eos_token_id] = 0
+            elif self.no_repeat_ngram_size > 0:
+                banned = banned_ngram_tokens(history[i], self.no_repeat_ngram_size)
+                if len(banned) > 0:
+                    logits[i, banned] = -float('inf')
+        token = logits.argmax(-1)
+        return token
+
+    def __call__(self, prompt):
+        # prompt is a list of (input_ids without padding, split), the output has max_new_tokens columns per prompt
+        if self.position is not None:
+            decoder = self.net.get_decoder()
+            embed_positions = decoder.embed_positions
+            decoder.embed_positions = self.position
+        try:
+            output = self.run(prompt)
+        finally:
+            if self.position is not None:
+                decoder.embed_positions = embed_positions
+        output = [F.pad(torch.tensor(x, dtype=torch.long), (0, self.max_new_tokens - len(x)),
+                        value=cfg['pad_token_id']) for x in output]
+        return output
+
+    def run(self, prompt):
+        output = [None for _ in range(len(prompt))]
+        queue = list(range(len(prompt)))
+        state, logits, slot, history, generated = None, None, [], [], []
+        while len(queue) > 0 or len(slot) > 0:
+            # admit the next prompts into the free slots
+            if len(queue) > 0 and len(slot) < self.num_slots:
+                admitted = queue[:self.num_slots - len(slot)]
+                queue = queue[len(admitted):]
+                state_, logits_, history_ = self.prefill([prompt[i] for i in admitted])
+                state = state_ if state is None else merge_state(state, state_)
+                logits = logits_ if logits is None else torch.cat([logits, logits_], dim=0)
+                slot.extend(admitted)
+                history.extend(history_)
+                generated.extend([[] for _ in range(len(admitted))])
+            token = self.select(logits, history, generated)
+            token_ = token.tolist()
+            keep = []
+            for i in range(len(slot)):
+                history[i].append(token_[i])
+                generated[i].append(token_[i])
+                if token_[i] == self.eos_token_id or len(generated[i]) >= self.max_new_tokens:
+                    output[slot[i]] = generated[i]
+                else:
+                    keep.append(i)
+            # evict the finished sequences, their slots are refilled on the next step
+            if len(keep) < len(slot):
+                slot = [slot[i] for i in keep]
+                history = [history[i] for i in keep]
+                generated = [generated[i] for i in keep]
+                if len(keep) == 0:
+                    state, logits = None, None
+                    continue
+                keep = torch.tensor(keep, device=token.device)
+                state = select_state(state, keep)
+                token = token[keep]
+            self.route(state['split'])
+            state['mask'] = torch.cat([state['mask'], torch.ones_like(state['mask'][:, :1])], dim=-1)
+            decode_output = self.decode(token, state['mask'], state['position'], state['past'],
+                                        state.get('encoder_hidden'), state.get('encoder_mask'))
+            state['past'] = to_legacy_cache(decode_output['past_key_values'])
+            state['position'] = state['position'] + 1
+            logits = decode_output['logits'][:, -1].float()
+        return output
+
+
+def unwrap(model):
+    if isinstance(model, PeftModel):
+        return model.get_base_model()
+    if hasattr(model, 'set_split'):
+        return model.model
+    return model
+
+
+def to_legacy_cache(past):
+    if isinstance(past, (tuple, list)):
+        return [list(x) for x in past]
+    if hasattr(past, 'to_legacy_cache'):
+        return [list(x) for x in past.to_legacy_cache()]
+    if hasattr(past, 'self_attention_cache'):
+        return [[s.keys, s.values, c.keys, c.values] for s, c in
+                zip(past.self_attention_cache.layers, past.cross_attention_cache.layers)]
+    return [[x.keys, x.values] for x in past.layers]
+
+
+def from_legacy_cache(past):
+    try:
+        from transformers import DynamicCache, EncoderDecoderCache
+    except ImportError:
+        return tuple(tuple(x) for x in past)
+    cache_class = EncoderDecoderCache if len(past[0]) == 4 else DynamicCache
+    if hasattr(cache_class, 'from_legacy_cache'):
+        return cache_class.from_legacy_cache(tuple(tuple(x) for x in past))
+    return cache_class([tuple(x) for x in past])
+
+
+def merge_state(state, state_):
+    # self-attention caches are aligned on the right by left padding, encoder states on the left by right padding
+    length = max(state['mask'].size(1), state_['mask'].size(1))
+    past = []
+    for layer, layer_ in zip(state['past'], state_['past']):
+        layer_merged = []
+        for j in range(len(layer)):
+            if j < 2:
+                x, x_ = pad_left(layer[j], length, 2), pad_left(layer_[j], length, 2)
+            else:
+                cross_length = max(layer[j].size(2), layer_[j].size(2))
+                x, x_ = pad_right(layer[j], cross_length, 2), pad_right(layer_[j], cross_length, 2)
+            layer_merged.append(torch.cat([x, x_], dim=0))
+        past.append(layer_merged)
+    merged = {'past': past, 'position': torch.cat([state['position'], state_['position']], dim=0),
+              'mask': torch.cat([pad_left(state['mask'], length, 1), pad_left(state_['mask'], length, 1)], dim=0)}
+    if state['split'] is not None:
+        merged['split'] = torch.cat([state['split'], state_['split']], dim=0)
+    else:
+        merged['split'] = None
+    if 'encoder_hidden' in state:
+        length = max(state['encoder_mask'].size(1), state_['encoder_mask'].size(1))
+        merged['encoder_hidden'] = torch.cat([pad_right(state['encoder_hidden'], length, 1),
+                                              pad_right(state_['encoder_hidden'], length, 1)], dim=0)
+        merged['encoder_mask'] = torch.cat([pad_right(state['encoder_mask'], length, 1),
+                                            pad_right(state_['encoder_mask'], length, 1)], dim=0)
+    return merged
+
+
+def select_state(state, index):
+    state = {k: index_select(state[k], index) for k in state}
+    # drop the columns that only hold padding of evicted rows
+    start = int(state['mask'].any(dim=0).nonzero()[0])
+    state['mask'] = state['mask'][:, start:]
+    state['past'] = [[x[:, :, start:] if j < 2 else x for j, x in enumerate(layer)] for layer in state['past']]
+    if 'encoder_hidden' in state:
+        end = int(state['encoder_mask'].any(dim=0).nonzero()[-1]) + 1
+        state['encoder_mask'] = state['encoder_mask'][:, :end]
+        state['encoder_hidden'] = state['encoder_hidden'][:, :end]
+        state['past'] = [[x[:, :, :end] if j >= 2 else x for j, x in enumerate(layer)] for layer in state['past']]
+    return state
+
+
+def index_select(x, index):
+    if x is None:
+        return None
+    if isinstance(x, list):
+        return [index_select(x_, index) for x_ in x]
+    return x[index]
+
+
+def pad_left(x, length, dim):
+    if x.size(dim) == length:
+        return x
+    pad = [0, 0] * (x.dim() - dim - 1) + [length - x.size(dim), 0]
+    return F.pad(x, pad)
+
+
+def pad_right(x, length, dim):
+    if x.size(dim) == length:
+        return x
+    pad = [0, 0] * (x.dim() - dim - 1) + [0, length - x.size(dim)]
+    return F.pad(x, pad)
+
+
+def banned_ngram_tokens(history, ngram_size):
+    if len(history) + 1 < ngram_size:
+        return []
+    prefix = tuple(history[len(history) - ngram_size + 1:])
+    banned = []
+    for i in range(len(history) - ngram_size + 1):
+        if tuple(history[i:i + ngram_size - 1]) == prefix:
+            banned.append(history[i + ngram_size - 1])
+    return banned
+
+
+def is_prompt_learning(model):
+    return isinstance(model, PeftModel) and model.peft_config[model.active_adapter].is_prompt_learning
+
+
+def is_greedy(model):
+    generation_config = unwrap(model).generation_config
+    return (generation_config.num_beams or 1) == 1 and not generation_config.do_sample
+
+
+def is_continuous(model):
+    # prompt learning methods feed virtual tokens through the cache, which the slots do not track, and the slots
+    # decode greedily, so a model that searches beams or samples by default, such as bart-base, keeps the batch path
+    return not is_prompt_learning(model) and is_greedy(model)
+
+
+def make_decoding(model):
+    if cfg['task_name'] == 's2s':
+        eos_token_id = unwrap(model).config.eos_token_id
+        no_repeat_ngram_size = getattr(unwrap(model).generation_config, 'no_repeat_ngram_size', 0) or 0
+    elif cfg['task_name'] == 'clm':
+        eos_token_id = cfg['pad_token_id']
+        no_repeat_ngram_size = 2
+    else:
+        raise ValueError('Not valid task name')
+    return eos_token_id, no_repeat_ngram_size
+
+
+def make_continuous_generator(model):
+    eos_token_id, no_repeat_ngram_size = make_decoding(model)
+    generator = ContinuousGenerator(model, cfg[cfg['model_name']]['batch_size']['eval'], cfg['max_new_tokens'],
+                                    eos_token_id, no_repeat_ngram_size)
+    return generator
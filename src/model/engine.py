@@ -0,0 +1,206 @@
+import torch
+import torch.nn.functional as F
+import dataset
+from config import cfg
+from module import to_device
+from .continuous import unwrap, is_prompt_learning, is_continuous, make_continuous_generator
+from .lookup import make_lookup_generator
+from .chunk import lm_forward
+
+
+class Engine:
+    def __init__(self, model, metric, logger, split='test', tag=None):
+        self.model = model
+        self.metric = metric
+        self.logger = logger
+        self.split = split
+        self.tag = split if tag is None else tag
+        self.generation = cfg['task_name'] == 's2s' or (cfg['task_name'] == 'clm' and cfg['data_name'] in ['dolly'])
+        # the teacher-forced forward only feeds batch metrics, generation metrics do not need the logits
+        self.forward_mode = cfg['eval_forward'] == 1 or not self.generation
+        # label scoring replaces generation by one teacher-forced forward over the label space
+        self.scoring = self.generation and cfg['generate_mode'] == 'score'
+        if self.scoring and 'label_space' not in cfg:
+            raise ValueError('Not valid data name for score mode')
+        self.metric_name = {split: [m for m in metric.metric_name[split] if self.forward_mode or
+                                    metric.metric[split][m]['mode'] == 'full' or
+                                    (self.scoring and m == 'LabelAccuracy')]}
+        self.batch_mode = any(metric.metric[split][m]['mode'] == 'batch' for m in self.metric_name[split])
+        self.full_mode = any(metric.metric[split][m]['mode'] == 'full' for m in self.metric_name[split])
+        # continuous batching and prompt lookup generate after the forward pass, from the prompts of all batches, both
+        # verify against greedy decoding and leave models that search beams or sample on the batch path
+        self.continuous = self.generation and cfg['generate_mode'] in ['continuous', 'lookup'] and \
+                          is_continuous(model)
+        self.generator = make_generator(model, cfg['generate_mode']) if self.continuous else None
+        self.buffer = []
+        self.prompt = []
+
+    def trim(self, input):
+        length = int(input['attention_mask'].sum(dim=-1).max())
+        index = slice(-length, None) if cfg['padding_side'] == 'left' else slice(0, length)
+        input = {k: input[k][:, index] if k in ['input_ids', 'attention_mask'] else input[k] for k in input}
+        return input
+
+    def forward(self, input):
+        if cfg['task_name'] == 's2s':
+            output = lm_forward(self.model, self.trim(input))
+        elif cfg['task_name'] == 'sc':
+            output = self.model(**self.trim(input))
+        else:
+            output = lm_forward(self.model, input)
+        return output
+
+    def generate(self, input):
+        input = self.trim(input)
+        # multi-adapter models route every row by its split
+        kwargs = {'split': input['split']} if 'split' in input else {}
+        if cfg['task_name'] == 's2s':
+            output = self.model.generate(input_ids=input['input_ids'], attention_mask=input['attention_mask'],
+                                         max_new_tokens=cfg['max_new_tokens'], **kwargs)
+        elif cfg['task_name'] == 'clm':
+            output = self.model.generate(input_ids=input['input_ids'], attention_mask=input['attention_mask'],
+                                         max_new_tokens=cfg['max_new_tokens'], eos_token_id=cfg['pad_token_id'],
+                                         no_repeat_ngram_size=2, **kwargs)
+        else:
+            raise ValueError('Not valid task name')
+        return output
+
+    def score(self, input):
+        input = self.trim(input)
+        label_space = torch.tensor(cfg['label_space'], device=input['input_ids'].device)
+        num_labels = label_space.size(0)
+        batch_size = input['input_ids'].size(0)
+        split = input['split'].repeat_interleave(num_labels) if 'split' in input else None
+        if hasattr(self.model, 'set_split'):
+            self.model.set_split(split)
+        labels = label_space.repeat(batch_size, 1)
+        labels = labels.masked_fill(labels == cfg['pad_token_id'], -100)
+        if is_prompt_learning(self.model):
+            # virtual tokens enter with the encoder input, so every candidate repeats the whole input
+            output = self.model(input_ids=input['input_ids'].repeat_interleave(num_labels, dim=0),
+                                attention_mask=input['attention_mask'].repeat_interleave(num_labels, dim=0),
+                                labels=labels)
+        else:
+            # the encoder runs once per input and its states are shared by all candidates
+            net = unwrap(self.model)
+            encoder_hidden = net.get_encoder()(input_ids=input['input_ids'],
+                                               attention_mask=input['attention_mask'])[0]
+            output = net(encoder_outputs=(encoder_hidden.repeat_interleave(num_labels, dim=0),),
+                         attention_mask=input['attention_mask'].repeat_interleave(num_labels, dim=0), labels=labels)
+        log_prob = F.log_softmax(output['logits'].float(), dim=-1)
+        mask = labels != -100
+        log_prob = log_prob.gather(-1, labels.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+        score = (log_prob * mask).sum(dim=-1).view(batch_size, num_labels)
+        target = input['labels'].masked_fill(input['labels'] == -100, cfg['pad_token_id'])
+        target = target[:, :label_space.size(1)]
+        label = (target.unsqueeze(1) == label_space.unsqueeze(0)).all(dim=-1).float().argmax(dim=-1)
+        generate = label_space[score.argmax(dim=-1)]
+        return score, label, generate
+
+    def step(self, input):
+        if cfg['task_name'] in ['s2s', 'sc', 'clm']:
+            input_size = input['labels'].size(0)
+            split = input['split'] if getattr(self.model, 'num_adapters', 1) > 1 else None
+            input = {'input_ids': input['input_ids'], 'attention_mask': input['attention_mask'],
+                     'labels': input['labels']}
+            if split is not None:
+                input['split'] = split
+            input = to_device(input, cfg['device'])
+            input_ = {'target': input['labels']}
+            output_ = {}
+            if self.forward_mode:
+                output = self.forward(input)
+                output_ = {'target': output['logits'], 'loss': output['loss']}
+            if self.scoring:
+                output_['score'], input_['label'], output_['generate'] = self.score(input)
+            elif self.generation and not self.continuous:
+                output_['generate'] = self.generate(input)
+        else:
+            input = dataset.collate(input)
+            input_size = input['data'].size(0)
+            input = to_device(input, cfg['device'])
+            output = self.model(**input)
+            input_ = {'target': input['target']}
+            output_ = {'target': output['target'], 'loss': output['loss']}
+        return input_size, input_, output_
+
+    def add(self, index, input_, output_):
+        key = 'generate' if 'generate' in output_ else 'target'
+        input_target = input_['target'].cpu()
+        output_target = output_[key].cpu()
+        for i in range(len(index)):
+            self.buffer.append((index[i], input_target[i], output_target[i]))
+        return
+
+    def enqueue(self, index, input):
+        split = input['split'] if getattr(self.model, 'num_adapters', 1) > 1 else None
+        attention_mask = input['attention_mask'].bool()
+        for i in range(len(index)):
+            split_i = int(split[i]) if split is not None else None
+            self.prompt.append((index[i], input['input_ids'][i][attention_mask[i]], split_i, input['labels'][i]))
+        return
+
+    def generate_continuous(self):
+        output = self.generator([(x[1], x[2]) for x in self.prompt])
+        for x, output_i in zip(self.prompt, output):
+            self.buffer.append((x[0], x[3], output_i))
+        self.prompt = []
+        return
+
+    def flush(self, batch_size):
+        # replay the buffered rows to the full metrics in dataset order
+        self.buffer = sorted(self.buffer, key=lambda x: x[0])
+        key = 'generate' if self.generation else 'target'
+        for i in range(0, len(self.buffer), batch_size):
+            rows = self.buffer[i:i + batch_size]
+            input_ = {'target': stack([x[1] for x in rows], -100)}
+            output_ = {key: stack([x[2] for x in rows], cfg['pad_token_id'] if self.generation else 0)}
+            self.metric.add(self.split, input_, output_)
+        self.buffer = []
+        return
+
+    def run(self, data_loader):
+        index = list(iter(data_loader.sampler))
+        start = 0
+        for i, input in enumerate(data_loader):
+            input_size, input_, output_ = self.step(input)
+            if self.batch_mode:
+                evaluation = self.metric.evaluate(self.split, 'batch', input_, output_, self.metric_name)
+                self.logger.append(evaluation, self.tag, input_size)
+            if self.continuous:
+                self.enqueue(index[start:start + input_size], input)
+            elif self.full_mode:
+                self.add(index[start:start + input_size], input_, output_)
+            start += input_size
+        if self.continuous:
+            self.generate_continuous()
+        if self.full_mode:
+            self.flush(data_loader.batch_size)
+        return
+
+
+def stack(rows, padding_value):
+    length = max(x.size(0) for x in rows) if rows[0].dim() > 0 else None
+    if length is None or all(x.size(0) == length for x in rows):
+        return torch.stack(rows, 0)
+    # decoder-only generations keep the prompt on the left, so pad on the side the tokenizer pads
+    if cfg['padding_side'] == 'left':
+        rows = [F.pad(x, (length - x.size(0), 0), value=padding_value) for x in rows]
+    else:
+        rows = [F.pad(x, (0, length - x.size(0)), value=padding_value) for x in rows]
+    return torch.stack(rows, 0)
+
+
+def make_generator(model, generate_mode):
+    if generate_mode == 'continuous':
+        generator = make_continuous_generator(model)
+    elif generate_mode == 'lookup':
+        generator = make_lookup_generator(model)
+    else:
+        raise ValueError('Not valid generate mode')
+    return generator
+
+
+def make_engine(model, metric, logger, split='test', tag=None):
+    engine = Engine(model, metric, logger, split, tag)
+    return engine
@@ -0,0 +1,35 @@
+import torch
+import torch.nn as nn
+from config import cfg
+
+
+def make_flat_parameters(parameters):
+    # trainable parameters and their gradients become views of one flat buffer per device and dtype, so the optimizer
+    # updates, clips and checkpoints a single tensor, and the gradient buffer is the bucket a data parallel sync reduces
+    group = {}
+    visited = set()
+    for param in parameters:
+        if not param.requires_grad or id(param) in visited:
+            continue
+        visited.add(id(param))
+        group.setdefault((param.device, param.dtype), []).append(param)
+    if not cfg['flat_param']:
+        return [param for params in group.values() for param in params]
+    flat_parameters = []
+    for (device, dtype), params in group.items():
+        numel = sum(param.numel() for param in params)
+        data = torch.empty(numel, device=device, dtype=dtype)
+        grad = torch.zeros(numel, device=device, dtype=dtype)
+        offset = 0
+        for param in params:
+            size = param.numel()
+            data[offset:offset + size].copy_(param.data.reshape(-1))
+            param.data = data[offset:offset + size].view(param.size())
+            # autograd accumulates into an existing gradient in place, so the gradients have to stay as they are,
+            # the optimizer zeroes them with set_to_none=False
+            param.grad = grad[offset:offset + size].view(param.size())
+            offset += size
+        flat_param = nn.Parameter(data)
+        flat_param.grad = grad
+        flat_parameters.append(flat_param)
+    return flat_parameters
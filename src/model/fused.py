@@ -0,0 +1,117 @@
+import types
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers.pytorch_utils import Conv1D
+from .quantize import is_quantized
+
+
+class LoRALinearFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, bias, A, B, scaling):
+        h = F.linear(x, A)
+        y = F.linear(x, weight, bias) + F.linear(h, B) * scaling
+        # only the input and its rank-r projection are kept, the weights are saved by reference
+        ctx.save_for_backward(x, h, weight, A, B)
+        ctx.scaling = scaling
+        return y
+
+    @staticmethod
+    def backward(ctx, grad_y):
+        x, h, weight, A, B = ctx.saved_tensors
+        grad_x = grad_weight = grad_bias = grad_A = grad_B = None
+        grad_y_ = grad_y.reshape(-1, grad_y.size(-1))
+        x_ = x.reshape(-1, x.size(-1))
+        grad_h = grad_y_.matmul(B) * ctx.scaling
+        if ctx.needs_input_grad[0]:
+            grad_x = (grad_y_.matmul(weight) + grad_h.matmul(A)).view_as(x)
+        if ctx.needs_input_grad[1]:
+            grad_weight = grad_y_.t().matmul(x_)
+        if ctx.needs_input_grad[2]:
+            grad_bias = grad_y_.sum(0)
+        if ctx.needs_input_grad[3]:
+            grad_A = grad_h.t().matmul(x_)
+        if ctx.needs_input_grad[4]:
+            grad_B = grad_y_.t().matmul(h.reshape(-1, h.size(-1))) * ctx.scaling
+        return grad_x, grad_weight, grad_bias, grad_A, grad_B, None
+
+
+class LoRAConv2dFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, bias, A, B, scaling, conv, conv_A):
+        h = F.conv2d(x, A, None, *conv_A)
+        y = F.conv2d(x, weight, bias, *conv) + F.conv2d(h, B) * scaling
+        ctx.save_for_backward(x, h, weight, A, B)
+        ctx.scaling, ctx.conv, ctx.conv_A = scaling, conv, conv_A
+        return y
+
+    @staticmethod
+    def backward(ctx, grad_y):
+        x, h, weight, A, B = ctx.saved_tensors
+        grad_x = grad_weight = grad_bias = grad_A = grad_B = None
+        # lora_B is a 1x1 convolution, its input gradient is the transposed projection
+        grad_h = F.conv2d(grad_y, B.transpose(0, 1)) * ctx.scaling
+        if ctx.needs_input_grad[0]:
+            grad_x = torch.nn.grad.conv2d_input(x.size(), weight, grad_y, *ctx.conv) + \
+                     torch.nn.grad.conv2d_input(x.size(), A, grad_h, *ctx.conv_A)
+        if ctx.needs_input_grad[1]:
+            grad_weight = torch.nn.grad.conv2d_weight(x, weight.size(), grad_y, *ctx.conv)
+        if ctx.needs_input_grad[2]:
+            grad_bias = grad_y.sum((0, 2, 3))
+        if ctx.needs_input_grad[3]:
+            grad_A = torch.nn.grad.conv2d_weight(x, A.size(), grad_h, *ctx.conv_A)
+        if ctx.needs_input_grad[4]:
+            grad_B = (torch.einsum('nohw,nrhw->or', grad_y, h) * ctx.scaling)[..., None, None]
+        return grad_x, grad_weight, grad_bias, grad_A, grad_B, None, None, None
+
+
+def get_base_layer(module):
+    return module.get_base_layer() if hasattr(module, 'get_base_layer') else module
+
+
+def get_active_adapter(module, x, args, kwargs):
+    # anything beyond a single plain LoRA adapter without dropout is left to PEFT
+    if len(args) > 0 or len(kwargs) > 0 or module.disable_adapters or module.merged:
+        return None
+    active_adapters = getattr(module, 'active_adapters', [module.active_adapter])
+    if len(active_adapters) != 1 or active_adapters[0] not in module.lora_A:
+        return None
+    adapter_name = active_adapters[0]
+    base = get_base_layer(module)
+    lora_A, lora_B = module.lora_A[adapter_name], module.lora_B[adapter_name]
+    if getattr(module, 'use_dora', {}).get(adapter_name, False) or lora_B.bias is not None:
+        return None
+    if module.training and not isinstance(module.lora_dropout[adapter_name], nn.Identity):
+        return None
+    if is_quantized(base) or not (x.dtype == lora_A.weight.dtype == base.weight.dtype):
+        return None
+    if isinstance(base, nn.Conv2d) and (base.groups != 1 or lora_B.groups != 1):
+        return None
+    return adapter_name
+
+
+def fused_forward(self, x, *args, **kwargs):
+    adapter_name = get_active_adapter(self, x, args, kwargs)
+    if adapter_name is None:
+        return type(self).forward(self, x, *args, **kwargs)
+    base = get_base_layer(self)
+    lora_A, lora_B = self.lora_A[adapter_name], self.lora_B[adapter_name]
+    scaling = self.scaling[adapter_name]
+    if isinstance(base, nn.Conv2d):
+        conv = (base.stride, base.padding, base.dilation, base.groups)
+        conv_A = (lora_A.stride, lora_A.padding, lora_A.dilation, lora_A.groups)
+        y = LoRAConv2dFunction.apply(x, base.weight, base.bias, lora_A.weight, lora_B.weight, scaling, conv, conv_A)
+    else:
+        weight = base.weight.t() if isinstance(base, Conv1D) else base.weight
+        y = LoRALinearFunction.apply(x, weight, base.bias, lora_A.weight, lora_B.weight, scaling)
+    return y
+
+
+def fuse_lora(model):
+    # the PEFT modules and parameters stay in place, so saving and merging are unchanged
+    num_fused = 0
+    for module in model.modules():
+        if hasattr(module, 'lora_A') and isinstance(get_base_layer(module), (nn.Linear, Conv1D, nn.Conv2d)):
+            module.forward = types.MethodType(fused_forward, module)
+            num_fused += 1
+    return num_fused
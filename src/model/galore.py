@@ -0,0 +1,88 @@
+import math
+import torch
+import torch.optim as optim
+from .quantize import find_quantize_modules
+
+
+class GaLoreAdamW(optim.Optimizer):
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2, rank=128,
+                 update_proj_gap=200, scale=0.25):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, rank=rank,
+                        update_proj_gap=update_proj_gap, scale=scale)
+        super().__init__(params, defaults)
+
+    def is_projected(self, p, group):
+        return group['rank'] > 0 and p.dim() == 2 and min(p.size()) > group['rank']
+
+    def load_state_dict(self, state_dict):
+        # states are cast to the dtype of their parameter on loading, the projectors and moments are put back as saved
+        super().load_state_dict(state_dict)
+        params = [p for group in self.param_groups for p in group['params']]
+        index = [i for group in state_dict['param_groups'] for i in group['params']]
+        for p, i in zip(params, index):
+            for key, value in state_dict['state'].get(i, {}).items():
+                if torch.is_tensor(value):
+                    self.state[p][key] = value.to(p.device, copy=True)
+        return
+
+    def project(self, grad, state, group):
+        # the gradient is projected onto the top singular vectors of its shorter side, which are refreshed from the
+        # current gradient every update_proj_gap steps, so the moments only cover rank x max(m, n) entries
+        left = grad.size(0) <= grad.size(1)
+        if (state['step'] - 1) % group['update_proj_gap'] == 0:
+            U, S, Vh = torch.linalg.svd(grad.float(), full_matrices=False)
+            state['projector'] = U[:, :group['rank']] if left else Vh[:group['rank']].t()
+        projector = state['projector']
+        grad = projector.t() @ grad if left else grad @ projector
+        return grad
+
+    def project_back(self, update, state, size):
+        projector = state['projector']
+        left = size[0] <= size[1]
+        update = projector @ update if left else update @ projector.t()
+        return update
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise ValueError('Not valid sparse gradient')
+                state = self.state[p]
+                if len(state) == 0:
+                    # the step is kept on the host, so it is read without a sync per parameter
+                    state['step'] = 0
+                state['step'] += 1
+                step = state['step']
+                projected = self.is_projected(p, group)
+                grad = self.project(p.grad.float(), state, group) if projected else p.grad
+                if 'exp_avg' not in state:
+                    state['exp_avg'] = torch.zeros_like(grad, memory_format=torch.preserve_format)
+                    state['exp_avg_sq'] = torch.zeros_like(grad, memory_format=torch.preserve_format)
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                exp_avg.lerp_(grad, 1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                step_size = group['lr'] / (1 - beta1 ** step)
+                denom = (exp_avg_sq.sqrt() / math.sqrt(1 - beta2 ** step)).add_(group['eps'])
+                update = exp_avg / denom
+                p.mul_(1 - group['lr'] * group['weight_decay'])
+                if projected:
+                    update = self.project_back(update, state, p.size()) * group['scale']
+                p.add_(update.to(p.dtype), alpha=-step_size)
+        return loss
+
+
+def make_galore_parameters(model):
+    # only the weights of the linear layers in the backbone are projected, embeddings, heads, biases and norms are
+    # updated by plain AdamW, and every parameter keeps its own storage since projection works per weight matrix
+    projected = [module.weight for module in find_quantize_modules(model) if module.weight.requires_grad]
+    projected_id = set(id(p) for p in projected)
+    other = [p for p in model.parameters() if p.requires_grad and id(p) not in projected_id]
+    return [{'params': projected}, {'params': other, 'rank': 0}]
@@ -0,0 +1,160 @@
+import copy
+import os
+import torch
+import torch.nn as nn
+from collections import OrderedDict
+from peft import PeftConfig, PeftType
+from peft.utils import load_peft_weights, TRANSFORMERS_MODELS_TO_LORA_TARGET_MODULES_MAPPING
+from config import cfg
+from .cola import is_target, make_features
+
+
+class GatherLoRALinear(nn.Module):
+    def __init__(self, base, num_slots, rank):
+        super().__init__()
+        self.base = base
+        in_features, out_features = make_features(base)
+        # slot 0 stays zero and serves requests without an adapter
+        self.register_buffer('A', base.weight.new_zeros(num_slots + 1, rank, in_features))
+        self.register_buffer('B', base.weight.new_zeros(num_slots + 1, out_features, rank))
+        self.index = None
+
+    def forward(self, x, *args, **kwargs):
+        y = self.base(x, *args, **kwargs)
+        if self.index is None:
+            return y
+        # every row goes through the low-rank factors of its own adapter
+        index = self.index
+        if x.size(0) != index.size(0):
+            # beam search and sampling expand every request into consecutive rows
+            index = index.repeat_interleave(x.size(0) // index.size(0))
+        A, B = self.A[index], self.B[index]
+        x_ = x.reshape(x.size(0), -1, x.size(-1)).to(A.dtype)
+        delta = torch.bmm(torch.bmm(x_, A.transpose(1, 2)), B.transpose(1, 2))
+        y = y + delta.reshape(*y.size()).to(y.dtype)
+        return y
+
+
+class AdapterPool:
+    def __init__(self, model, num_slots, rank):
+        self.model = model
+        self.num_slots = num_slots
+        self.rank = rank
+        self.layer = {}
+        target_modules = TRANSFORMERS_MODELS_TO_LORA_TARGET_MODULES_MAPPING[model.config.model_type]
+        for name in [k for k, v in model.named_modules() if is_target(k, v, target_modules)]:
+            layer = GatherLoRALinear(model.get_submodule(name), num_slots, rank)
+            parent_name, _, child_name = name.rpartition('.')
+            parent = model.get_submodule(parent_name) if parent_name else model
+            setattr(parent, child_name, layer)
+            self.layer[name] = layer
+        self.head_name = None
+        if cfg['task_name'] == 'sc':
+            # encoders name the head classifier, decoders such as gpt2 and llama name it score
+            head_name = [x for x in ['classifier', 'score'] if hasattr(model, x)]
+            if len(head_name) == 0:
+                raise ValueError('Not valid model for sequence classification serving')
+            self.head_name = head_name[0]
+        self.slot = OrderedDict()
+        self.free = list(range(num_slots, 0, -1))
+        self.head = {}
+        self.num_loads = 0
+        self.num_evictions = 0
+
+    def load(self, adapter, slot):
+        path = os.path.join('output', 'model', adapter, 'best', 'adapter')
+        peft_config = PeftConfig.from_pretrained(path)
+        if peft_config.peft_type != PeftType.LORA or peft_config.r > self.rank:
+            raise ValueError('Not valid adapter for serving')
+        weight = load_peft_weights(path, device='cpu')
+        scaling = peft_config.lora_alpha / peft_config.r
+        with torch.no_grad():
+            for name in self.layer:
+                layer = self.layer[name]
+                layer.A[slot].zero_()
+                layer.B[slot].zero_()
+                key = 'base_model.model.{}'.format(name)
+                if '{}.lora_A.weight'.format(key) not in weight:
+                    continue
+                A = weight['{}.lora_A.weight'.format(key)]
+                B = weight['{}.lora_B.weight'.format(key)] * scaling
+                layer.A[slot, :A.size(0)].copy_(A)
+                layer.B[slot, :, :B.size(1)].copy_(B)
+        if self.head_name is not None:
+            self.head[slot] = self.make_head(weight)
+        return
+
+    def make_head(self, weight):
+        # the classification head is saved with the adapter and its number of labels differs between data sets
+        prefix = 'base_model.model.{}.'.format(self.head_name)
+        state_dict = {k[len(prefix):]: v for k, v in weight.items() if k.startswith(prefix)}
+        head = copy.deepcopy(getattr(self.model, self.head_name))
+        for k, v in state_dict.items():
+            module_name, _, param_name = k.rpartition('.')
+            module = head.get_submodule(module_name) if module_name else head
+            if isinstance(module, nn.Linear) and param_name == 'weight' and module.weight.size() != v.size():
+                module = nn.Linear(v.size(1), v.size(0), bias=module.bias is not None)
+                parent_name, _, child_name = module_name.rpartition('.')
+                setattr(head.get_submodule(parent_name) if parent_name else head, child_name, module)
+        head.load_state_dict(state_dict)
+        head = head.to(next(self.model.parameters()).device).eval()
+        return head
+
+    def acquire(self, adapters):
+        # least recently used adapters are evicted, but never one the current batch needs
+        needed = set(x for x in adapters if x is not None)
+        if len(needed) > self.num_slots:
+            raise ValueError('Not valid number of adapters for one batch')
+        failed = {}
+        for adapter in needed:
+            if adapter in self.slot:
+                self.slot.move_to_end(adapter)
+                continue
+            if len(self.free) == 0:
+                evicted = next(x for x in self.slot if x not in needed)
+                self.free.append(self.slot.pop(evicted))
+                self.head.pop(self.free[-1], None)
+                self.num_evictions += 1
+            # a slot is only taken once its adapter has loaded, a failed load leaves it free
+            try:
+                self.load(adapter, self.free[-1])
+            except Exception as e:
+                failed[adapter] = e
+                continue
+            self.slot[adapter] = self.free.pop()
+            self.num_loads += 1
+        index = [0 if x is None or x in failed else self.slot[x] for x in adapters]
+        return index, failed
+
+    def set_index(self, index):
+        for name in self.layer:
+            self.layer[name].index = index
+        return
+
+    def classify(self, input, index):
+        backbone = getattr(self.model, self.model.base_model_prefix)
+        self.set_index(index)
+        hidden = backbone(input_ids=input['input_ids'], attention_mask=input['attention_mask'])[0]
+        logits = [None for _ in range(len(index))]
+        for slot in torch.unique(index).tolist():
+            rows = torch.nonzero(index == slot).view(-1)
+            head = self.head[slot] if slot in self.head else getattr(self.model, self.head_name)
+            logits_slot = head(hidden[rows])
+            if self.head_name == 'score':
+                # a decoder head scores every token, the last attended token of each row is the prediction
+                mask = input['attention_mask'][rows]
+                last = (mask * torch.arange(mask.size(1), device=mask.device)).argmax(-1)
+                logits_slot = logits_slot[torch.arange(len(rows), device=mask.device), last]
+            for i, row in enumerate(rows.tolist()):
+                logits[row] = logits_slot[i]
+        return logits
+
+    def generate(self, input, index, **kwargs):
+        self.set_index(index)
+        output = self.model.generate(input_ids=input['input_ids'], attention_mask=input['attention_mask'], **kwargs)
+        return output
+
+
+def make_adapter_pool(model, num_slots, rank):
+    pool = AdapterPool(model, num_slots, rank)
+    return pool
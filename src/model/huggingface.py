@@ -2,6 +2,8 @@ import os
 import torch
 import torch.nn as nn
 from config import cfg
+from .mapped import map_pretrained
+from .quantize import quantize_model
 from diffusers import (
     AutoencoderKL,
     DiffusionPipeline,
@@ -54,26 +56,31 @@ def make_hf_model(model_name, sub_model_name=None):
         raise ValueError('Not valid model name')
     cfg['cache_model_path'] = os.path.join('output', 'model', model_name)
     cfg['cache_tokenizer_path'] = os.path.join('output', 'tokenizer', model_name)
+    load_kwargs = {'low_cpu_mem_usage': True, 'use_safetensors': True} if cfg['mmap_model'] == 1 else {}
     if cfg['task_name'] == 'clm':
         if 'llama' in model_name:
             # "Training Llama in float16 is not recommended and known to produce nan, as such the model should be trained in bfloat16.""
             model = LlamaForCausalLM.from_pretrained(cfg['model_name_or_path'], torch_dtype=torch.bfloat16,
-                                                     device_map=cfg['device'], cache_dir=cfg['cache_model_path'])
+                                                     device_map=cfg['device'], cache_dir=cfg['cache_model_path'],
+                                                     **load_kwargs)
         else:
-            model = AutoModelForCausalLM.from_pretrained(cfg['model_name_or_path'], cache_dir=cfg['cache_model_path'])
+            model = AutoModelForCausalLM.from_pretrained(cfg['model_name_or_path'], cache_dir=cfg['cache_model_path'],
+                                                         **load_kwargs)
     elif cfg['task_name'] == 's2s':
-        model = AutoModelForSeq2SeqLM.from_pretrained(cfg['model_name_or_path'], cache_dir=cfg['cache_model_path'])
+        model = AutoModelForSeq2SeqLM.from_pretrained(cfg['model_name_or_path'], cache_dir=cfg['cache_model_path'],
+                                                      **load_kwargs)
     elif cfg['task_name'] == 'sc':
         if cfg['subset_name'] in ['mnli']:
             model = AutoModelForSequenceClassification.from_pretrained(cfg['model_name_or_path'],
                                                                        cache_dir=cfg['cache_model_path'],
-                                                                       num_labels=3)  # "num_labels" is set up in model.config
+                                                                       num_labels=3, **load_kwargs)  # "num_labels" is set up in model.config
         elif cfg['subset_name'] in ['stsb']:
             model = AutoModelForSequenceClassification.from_pretrained(cfg['model_name_or_path'],
-                                                                       cache_dir=cfg['cache_model_path'], num_labels=1)
+                                                                       cache_dir=cfg['cache_model_path'], num_labels=1,
+                                                                       **load_kwargs)
         else:
             model = AutoModelForSequenceClassification.from_pretrained(cfg['model_name_or_path'],
-                                                                       cache_dir=cfg['cache_model_path'])
+                                                                       cache_dir=cfg['cache_model_path'], **load_kwargs)
     elif cfg['task_name'] == 't2i':
         if sub_model_name is None:
             model = DiffusionPipeline.from_pretrained(cfg['model_name_or_path'], safety_checker=None,
@@ -89,6 +96,13 @@ def make_hf_model(model_name, sub_model_name=None):
             )
     else:
         raise ValueError('Not valid task name')
+    if cfg['mmap_model'] == 1 and cfg['task_name'] in ['clm', 's2s', 'sc']:
+        # frozen weights stay backed by the page cache of the checkpoint, which processes on a node share
+        map_pretrained(model, cfg['cache_model_path'])
+    if cfg['quantize_mode'] != 'none' and cfg['task_name'] in ['clm', 's2s', 'sc']:
+        if cfg['ft_name'] == 'full':
+            raise ValueError('Not valid quantize mode for full fine-tuning')
+        quantize_model(model, cfg['quantize_mode'])
     if any(k in cfg['model_name_or_path'] for k in ("gpt", "opt", "bloom", "llama")):
         padding_side = "left"
     else:
@@ -108,6 +122,7 @@ def make_hf_model(model_name, sub_model_name=None):
     if any(k in model_name for k in ("gpt", "llama")):
         model.config.pad_token_id = tokenizer.pad_token_id
     cfg['pad_token_id'] = tokenizer.pad_token_id
+    cfg['padding_side'] = padding_side
     return model, tokenizer
 
 
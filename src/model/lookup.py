@@ -0,0 +1,78 @@
+import torch
+from config import cfg
+from .continuous import ContinuousGenerator, to_legacy_cache, make_decoding, is_greedy
+
+
+class LookupGenerator(ContinuousGenerator):
+    def __init__(self, model, max_new_tokens, eos_token_id, no_repeat_ngram_size=0, num_tokens=10,
+                 max_ngram_size=3):
+        super().__init__(model, 1, max_new_tokens, eos_token_id, no_repeat_ngram_size)
+        self.num_tokens = num_tokens
+        self.max_ngram_size = max_ngram_size
+        self.num_forwards = 0
+        self.num_accepted = 0
+
+    def propose(self, source, generated):
+        # the latest n-gram is looked up in the prompt and the text so far, the tokens following its last
+        # occurrence are the draft
+        sequence = source + generated
+        num_tokens = min(self.num_tokens, self.max_new_tokens - len(generated) - 1)
+        if num_tokens <= 0:
+            return []
+        for ngram_size in range(min(self.max_ngram_size, len(generated)), 0, -1):
+            ngram = sequence[len(sequence) - ngram_size:]
+            for i in range(len(sequence) - ngram_size - 1, -1, -1):
+                if sequence[i:i + ngram_size] == ngram:
+                    return sequence[i + ngram_size:i + ngram_size + num_tokens]
+        return []
+
+    def verify(self, logits, history, generated, draft):
+        # the draft is kept up to the first token greedy decoding would not have picked, plus the corrected token
+        accepted = []
+        for j in range(logits.size(0)):
+            token = int(self.select(logits[j:j + 1], [history], [generated])[0])
+            history.append(token)
+            generated.append(token)
+            accepted.append(token)
+            if token == self.eos_token_id or len(generated) >= self.max_new_tokens:
+                break
+            if j >= len(draft) or token != draft[j]:
+                break
+        return accepted
+
+    def run(self, prompt):
+        output = []
+        for input_ids, split in prompt:
+            state, logits, history = self.prefill([(input_ids, split)])
+            history, generated = history[0], []
+            source = input_ids.tolist()
+            accepted = self.verify(logits, history, generated, [])
+            while accepted[-1] != self.eos_token_id and len(generated) < self.max_new_tokens:
+                draft = self.propose(source, generated)
+                device = state['mask'].device
+                token = torch.tensor([[generated[-1]] + draft], device=device)
+                position = state['position'][:, None] + torch.arange(token.size(1), device=device)
+                mask = torch.cat([state['mask'], torch.ones_like(token)], dim=-1)
+                decode_output = self.decode(token, mask, position, state['past'], state.get('encoder_hidden'),
+                                            state.get('encoder_mask'))
+                logits = decode_output['logits'][0].float()
+                accepted = self.verify(logits, history, generated, draft)
+                self.num_forwards += 1
+                self.num_accepted += len(accepted) - 1
+                # the cache keeps the tokens whose logits were used, the rejected part of the draft is cropped
+                length = state['mask'].size(1) + len(accepted)
+                state['past'] = [[x[:, :, :length] if j < 2 else x for j, x in enumerate(layer)] for layer in
+                                 to_legacy_cache(decode_output['past_key_values'])]
+                state['mask'] = mask[:, :length]
+                state['position'] = state['position'] + len(accepted)
+            output.append(generated)
+        return output
+
+
+def make_lookup_generator(model):
+    # the draft is verified against greedy decoding, which is only the decoding of the batch path for greedy models
+    if not is_greedy(model):
+        raise ValueError('Not valid generation config for prompt lookup')
+    eos_token_id, no_repeat_ngram_size = make_decoding(model)
+    generator = LookupGenerator(model, cfg['max_new_tokens'], eos_token_id, no_repeat_ngram_size)
+    return generator
@@ -0,0 +1,70 @@
+import json
+import os
+import struct
+import torch
+from transformers.utils import cached_file
+
+safetensors_dtype = {'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+                     'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8,
+                     'BOOL': torch.bool}
+
+
+def find_safetensors(name_or_path, cache_dir=None):
+    path = cached_file(name_or_path, 'model.safetensors', cache_dir=cache_dir,
+                       _raise_exceptions_for_missing_entries=False)
+    if path is not None:
+        return [path]
+    index_path = cached_file(name_or_path, 'model.safetensors.index.json', cache_dir=cache_dir,
+                             _raise_exceptions_for_missing_entries=False)
+    if index_path is None:
+        return []
+    with open(index_path, 'r') as f:
+        weight_map = json.load(f)['weight_map']
+    path = [cached_file(name_or_path, filename, cache_dir=cache_dir) for filename in sorted(set(weight_map.values()))]
+    return path
+
+
+def map_safetensors(path):
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    # a private mapping, pages come from the shared page cache and are only copied when written
+    storage = torch.from_file(path, shared=False, size=os.path.getsize(path), dtype=torch.uint8)
+    start = 8 + header_size
+    tensor = {}
+    for k, v in header.items():
+        if k == '__metadata__' or v['dtype'] not in safetensors_dtype:
+            continue
+        dtype = safetensors_dtype[v['dtype']]
+        begin, end = v['data_offsets']
+        if (start + begin) % torch.tensor([], dtype=dtype).element_size() != 0:
+            continue
+        tensor[k] = storage[start + begin:start + end].view(dtype).view(v['shape'])
+    return tensor
+
+
+def find_key(name, tensor, prefix):
+    # checkpoints are stored with or without the prefix of the backbone
+    candidates = [name, '{}.{}'.format(prefix, name)]
+    if name.startswith(prefix + '.'):
+        candidates.append(name[len(prefix) + 1:])
+    for key in candidates:
+        if key in tensor:
+            return key
+    return None
+
+
+def map_pretrained(model, cache_dir=None):
+    tensor = {}
+    for path in find_safetensors(model.config._name_or_path, cache_dir):
+        tensor.update(map_safetensors(path))
+    mapped = []
+    for name, param in model.named_parameters():
+        key = find_key(name, tensor, model.base_model_prefix)
+        if key is None or param.device.type != 'cpu':
+            continue
+        if tensor[key].dtype != param.dtype or tensor[key].size() != param.size():
+            continue
+        param.data = tensor[key]
+        mapped.append(name)
+    return mapped
@@ -0,0 +1,77 @@
+import contextlib
+import torch
+from peft.tuners.lora import LoraLayer
+from .fused import get_base_layer
+from .quantize import is_quantized
+
+
+def get_merge_adapter(module):
+    # a single plain LoRA adapter on a full precision weight is merged, anything else runs unmerged
+    if not isinstance(module, LoraLayer) or module.disable_adapters or module.merged:
+        return None
+    active_adapters = getattr(module, 'active_adapters', [module.active_adapter])
+    if len(active_adapters) != 1 or active_adapters[0] not in module.lora_A:
+        return None
+    adapter_name = active_adapters[0]
+    if getattr(module, 'use_dora', {}).get(adapter_name, False) or \
+            adapter_name in getattr(module, 'lora_variant', {}) or \
+            getattr(module, 'lora_bias', {}).get(adapter_name, False):
+        return None
+    if is_quantized(get_base_layer(module)):
+        return None
+    return adapter_name
+
+
+class MergedLayer:
+    def __init__(self, module, adapter_name):
+        self.module = module
+        self.adapter_name = adapter_name
+        self.residual = None
+        self.index = None
+        self.value = None
+
+    def merge(self):
+        weight = get_base_layer(self.module).weight.data
+        delta_weight = self.module.get_delta_weight(self.adapter_name).to(weight.dtype)
+        merged = weight + delta_weight
+        # the rounding of W + dW - dW is kept as a bfloat16 residual, elements it does not recover are kept as they
+        # are, so unmerging gives back the weight bit for bit
+        unmerged = merged - delta_weight
+        self.residual = (weight - unmerged).to(torch.bfloat16)
+        mismatch = (unmerged + self.residual.to(weight.dtype) != weight).view(-1)
+        self.index = mismatch.nonzero().view(-1)
+        self.value = weight.view(-1)[self.index].clone()
+        weight.copy_(merged)
+        self.module.merged_adapters.append(self.adapter_name)
+        return
+
+    def unmerge(self):
+        weight = get_base_layer(self.module).weight.data
+        delta_weight = self.module.get_delta_weight(self.adapter_name).to(weight.dtype)
+        weight.sub_(delta_weight)
+        weight.add_(self.residual.to(weight.dtype))
+        weight.view(-1)[self.index] = self.value
+        self.module.merged_adapters.remove(self.adapter_name)
+        self.residual = self.index = self.value = None
+        return
+
+
+@contextlib.contextmanager
+def merge_adapter(model):
+    # LoRA deltas are added into the base weights for evaluation, which then runs at the cost of the base model, and
+    # are taken out again on exit
+    merged = []
+    try:
+        with torch.no_grad():
+            for module in model.modules():
+                adapter_name = get_merge_adapter(module)
+                if adapter_name is not None:
+                    layer = MergedLayer(module, adapter_name)
+                    layer.merge()
+                    merged.append(layer)
+        yield model
+    finally:
+        with torch.no_grad():
+            for layer in reversed(merged):
+                layer.unmerge()
+    return
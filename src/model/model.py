@@ -8,6 +8,11 @@ from transformers import get_linear_schedule_with_warmup
 from config import cfg
 from diffusers import DDPMScheduler
 from .huggingface import make_hf_model
+from .cola import make_cola
+from .fused import fuse_lora
+from .prefix import make_layers_to_transform
+from .adam8bit import AdamW8bit
+from .galore import GaLoreAdamW
 from peft import get_peft_model, TaskType, LoraConfig, AdaLoraConfig, IA3Config, PromptTuningInit, \
     PromptTuningConfig, PrefixTuningConfig, PromptEncoderConfig
 
@@ -80,6 +85,12 @@ def make_optimizer(parameters, tag):
     elif cfg[tag]['optimizer_name'] == 'AdamW':
         optimizer = optim.AdamW(parameters, lr=cfg[tag]['lr'], betas=cfg[tag]['betas'],
                                 weight_decay=cfg[tag]['weight_decay'])
+    elif cfg[tag]['optimizer_name'] == 'AdamW8bit':
+        optimizer = AdamW8bit(parameters, lr=cfg[tag]['lr'], betas=cfg[tag]['betas'],
+                              weight_decay=cfg[tag]['weight_decay'])
+    elif cfg[tag]['optimizer_name'] == 'GaLoreAdamW':
+        optimizer = GaLoreAdamW(parameters, lr=cfg[tag]['lr'], betas=cfg[tag]['betas'],
+                                weight_decay=cfg[tag]['weight_decay'], **cfg[tag]['galore'])
     elif cfg[tag]['optimizer_name'] == 'LBFGS':
         optimizer = optim.LBFGS(parameters, lr=cfg[tag]['lr'])
     else:
@@ -145,6 +156,9 @@ def make_noise_scheduler(tag):
 
 
 def make_ft_model(model):
+    if cfg['ft_name'] == 'cola':
+        model = make_cola(model)
+        return model
     if cfg['task_name'] == 'clm':
         peft_config = make_config_clm()
     elif cfg['task_name'] == 's2s':
@@ -157,7 +171,11 @@ def make_ft_model(model):
         peft_config = make_config_ic(model)
     else:
         raise ValueError('Not valid task name')
+    if cfg['num_top_layers'] > 0 and cfg['task_name'] in ['s2s', 'sc', 'clm'] and not peft_config.is_prompt_learning:
+        peft_config.layers_to_transform = make_layers_to_transform(model)
     model = get_peft_model(model, peft_config)
+    if cfg['ft_name'] == 'lora' and cfg['fuse_lora'] == 1:
+        fuse_lora(model)
     return model
 
 
@@ -291,6 +309,8 @@ def make_config_ic(model):
     for k, v in model.named_modules():
         if isinstance(v, (nn.Linear, nn.Conv1d, nn.Conv2d)):
             target_modules.append(k)
+    if cfg['num_top_layers'] > 0:
+        target_modules = target_modules[-cfg['num_top_layers']:]
     if cfg['ft_name'] == 'lora':
         peft_config = LoraConfig(
             target_modules=target_modules,
@@ -0,0 +1,146 @@
+import hashlib
+import os
+import torch
+import torch.nn as nn
+from config import cfg
+from .continuous import unwrap, is_prompt_learning
+
+
+class StopPrefix(Exception):
+    pass
+
+
+class PrefixBlock(nn.Module):
+    def __init__(self, block, cache, index):
+        super().__init__()
+        self.block = block
+        self.cache = cache
+        self.index = index
+
+    def forward(self, hidden_states, *args, **kwargs):
+        cache = self.cache
+        last = self.index == cache.num_prefix_layers - 1
+        if cache.mode == 'replay':
+            # the frozen prefix is skipped, the last block hands over the cached output of the batch
+            hidden_states = cache.read() if last else hidden_states
+            return cache.format(hidden_states)
+        output = self.block(hidden_states, *args, **kwargs)
+        if cache.mode == 'capture' and last:
+            cache.template = output
+            cache.write(output[0] if isinstance(output, tuple) else output)
+            raise StopPrefix
+        return output
+
+
+class PrefixCache:
+    def __init__(self, model, num_prefix_layers, capacity, path):
+        self.model = model
+        self.net = unwrap(model)
+        self.num_prefix_layers = num_prefix_layers
+        self.capacity = capacity
+        self.path = path
+        self.blocks = find_blocks(self.net)
+        for i in range(num_prefix_layers):
+            self.blocks[i] = PrefixBlock(self.blocks[i], self, i)
+        self.slot = {}
+        self.store = None
+        self.template = None
+        self.mode = None
+        self.batch_slot = None
+        # PEFT calls the forward of the task model directly, so the hooks sit on its backbone
+        self.backbone = getattr(self.net, self.net.base_model_prefix)
+        self.backbone.register_forward_pre_hook(self.pre_hook, with_kwargs=True)
+        self.backbone.register_forward_hook(self.hook)
+
+    def key(self, input_ids, attention_mask):
+        row = input_ids.masked_fill(attention_mask == 0, -1).cpu().numpy()
+        key = [hashlib.sha1(row[i].tobytes()).hexdigest() for i in range(row.shape[0])]
+        return key
+
+    def make_store(self, size, dtype):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        numel = self.capacity * size[0] * size[1]
+        with open(self.path, 'wb') as f:
+            f.truncate(numel * torch.tensor([], dtype=dtype).element_size())
+        self.store = torch.from_file(self.path, shared=True, size=numel, dtype=dtype).view(self.capacity, *size)
+        return
+
+    def write(self, hidden_states):
+        if self.store is None:
+            self.make_store(hidden_states.size()[1:], hidden_states.dtype)
+        self.store[self.capture_slot] = hidden_states.detach().to('cpu')
+        return
+
+    def read(self):
+        device = next(self.net.parameters()).device
+        hidden_states = self.store[self.batch_slot].to(device, non_blocking=True)
+        return hidden_states
+
+    def format(self, hidden_states):
+        if isinstance(self.template, tuple):
+            return (hidden_states,) + tuple(None for _ in range(len(self.template) - 1))
+        return hidden_states
+
+    def pre_hook(self, module, args, kwargs):
+        input_ids = kwargs['input_ids'] if 'input_ids' in kwargs else (args[0] if len(args) > 0 else None)
+        attention_mask = kwargs.get('attention_mask')
+        # only training inputs of the stored length are cached, evaluation runs the prefix
+        if not module.training or self.mode is not None or input_ids is None or attention_mask is None or \
+                (self.store is not None and input_ids.size(1) != self.store.size(1)):
+            return
+        key = self.key(input_ids, attention_mask)
+        missing = [i for i in range(len(key)) if key[i] not in self.slot]
+        missing = [i for i in missing if key[i] not in key[:i]]
+        if len(missing) > 0:
+            if len(self.slot) + len(missing) > self.capacity:
+                return
+            # the prefix is computed once without dropout and stopped after its last block
+            self.capture_slot = list(range(len(self.slot), len(self.slot) + len(missing)))
+            self.mode = 'capture'
+            module.train(False)
+            try:
+                with torch.no_grad():
+                    module(input_ids=input_ids[missing], attention_mask=attention_mask[missing])
+            except StopPrefix:
+                pass
+            finally:
+                module.train(True)
+                self.mode = None
+            for i, slot in zip(missing, self.capture_slot):
+                self.slot[key[i]] = slot
+        self.batch_slot = [self.slot[k] for k in key]
+        self.mode = 'replay'
+        return
+
+    def hook(self, module, args, output):
+        if self.mode == 'replay':
+            self.mode = None
+        return
+
+
+def find_blocks(net):
+    num_layers = net.config.num_hidden_layers
+    for name, module in net.named_modules():
+        if isinstance(module, nn.ModuleList) and name.split('.')[-1] in ['h', 'layers', 'layer'] and \
+                len(module) == num_layers:
+            return module
+    raise ValueError('Not valid model for prefix cache')
+
+
+def make_layers_to_transform(model):
+    num_layers = model.config.num_hidden_layers
+    layers_to_transform = list(range(num_layers - cfg['num_top_layers'], num_layers))
+    return layers_to_transform
+
+
+def make_prefix_cache(model):
+    # adapters in the top layers leave the bottom blocks frozen and, for text inputs, deterministic
+    if cfg['num_top_layers'] <= 0 or cfg['prefix_cache'] != 1 or cfg['task_name'] not in ['clm', 'sc'] or \
+            is_prompt_learning(model):
+        return None
+    num_prefix_layers = unwrap(model).config.num_hidden_layers - cfg['num_top_layers']
+    if num_prefix_layers <= 0:
+        return None
+    path = os.path.join('output', 'cache', cfg['model_tag'], 'prefix')
+    cache = PrefixCache(model, num_prefix_layers, cfg['data_size']['train'], path)
+    return cache
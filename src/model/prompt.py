@@ -0,0 +1,67 @@
+import contextlib
+import copy
+import torch
+import torch.nn as nn
+from peft import PeftModel
+
+
+class VirtualTokens(nn.Module):
+    def __init__(self, weight):
+        super().__init__()
+        self.embedding = nn.Embedding.from_pretrained(weight, freeze=True)
+
+    def forward(self, indices):
+        x = self.embedding(indices)
+        return x
+
+
+@contextlib.contextmanager
+def cache_prompt(model):
+    # the virtual tokens do not depend on the input, so the prompt encoder is run once and left out of the eval graph
+    if not isinstance(model, PeftModel) or not model.peft_config[model.active_adapter].is_prompt_learning:
+        yield model
+        return
+    adapter_name = model.active_adapter
+    peft_config = model.peft_config[adapter_name]
+    prompt_encoder = model.prompt_encoder[adapter_name]
+    inference_mode = peft_config.inference_mode
+    device = prompt_encoder.embedding.weight.device
+    with torch.no_grad():
+        weight = model.get_prompt_embedding_to_save(adapter_name).to(device)
+    model.prompt_encoder[adapter_name] = VirtualTokens(weight)
+    peft_config.inference_mode = True
+    get_prompt = model.get_prompt
+    cache = {}
+
+    def get_prompt_cached(batch_size, *args, **kwargs):
+        # prompts and key values are shared between batches of one size, a cache object is extended during decoding,
+        # so every batch gets its own container over the same tensors
+        if batch_size not in cache:
+            cache[batch_size] = get_prompt(batch_size, *args, **kwargs)
+        prompt = cache[batch_size]
+        if not isinstance(prompt, (torch.Tensor, tuple, list)):
+            prompt = copy_cache(prompt)
+        return prompt
+
+    model.get_prompt = get_prompt_cached
+    try:
+        yield model
+    finally:
+        del model.get_prompt
+        model.prompt_encoder[adapter_name] = prompt_encoder
+        peft_config.inference_mode = inference_mode
+    return
+
+
+def copy_cache(cache):
+    # decoding concatenates onto the key values of a layer and replaces them, it does not write into them
+    cache_ = copy.copy(cache)
+    if hasattr(cache, 'self_attention_cache'):
+        cache_.self_attention_cache = copy_cache(cache.self_attention_cache)
+        cache_.cross_attention_cache = copy_cache(cache.cross_attention_cache)
+        cache_.is_updated = dict(cache.is_updated)
+    elif hasattr(cache, 'layers'):
+        cache_.layers = [copy.copy(x) for x in cache.layers]
+    else:
+        cache_.key_cache, cache_.value_cache = list(cache.key_cache), list(cache.value_cache)
+    return cache_
@@ -0,0 +1,114 @@
+import types
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.nn.utils.parametrize as parametrize
+from transformers.pytorch_utils import Conv1D
+
+# normal float 4-bit levels, quantiles of N(0, 1) scaled to [-1, 1]
+nf4_codebook = [-1.0, -0.6961928009986877, -0.5250730514526367, -0.39491748809814453, -0.28444138169288635,
+                -0.18477343022823334, -0.09105003625154495, 0.0, 0.07958029955625534, 0.16093020141124725,
+                0.24611230194568634, 0.33791524171829224, 0.44070982933044434, 0.5626170039176941,
+                0.7229568362236023, 1.0]
+
+
+class QuantizedWeight(nn.Module):
+    def __init__(self, quantize_mode, block_size):
+        super().__init__()
+        if quantize_mode not in ['int8', 'nf4']:
+            raise ValueError('Not valid quantize mode')
+        self.quantize_mode = quantize_mode
+        self.block_size = block_size
+        self.shape = None
+        self.dtype = None
+        codebook = torch.tensor(nf4_codebook)
+        self.register_buffer('codebook', codebook, persistent=False)
+        self.register_buffer('midpoint', (codebook[1:] + codebook[:-1]) / 2, persistent=False)
+
+    def right_inverse(self, weight):
+        # blocks of the flattened weight share one absmax scale
+        self.shape, self.dtype = weight.size(), weight.dtype
+        weight = weight.detach().float().flatten()
+        weight = F.pad(weight, (0, -weight.numel() % self.block_size)).view(-1, self.block_size)
+        absmax = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-12)
+        weight = weight / absmax
+        if self.quantize_mode == 'int8':
+            code = torch.round(weight * 127).to(torch.int8)
+        else:
+            index = torch.bucketize(weight, self.midpoint.to(weight.device)).to(torch.uint8)
+            code = (index[:, 0::2] << 4) | index[:, 1::2]
+        return code, absmax
+
+    def forward(self, code, absmax):
+        if self.quantize_mode == 'int8':
+            weight = code.float() / 127
+        else:
+            index = torch.stack([code >> 4, code & 15], dim=-1).view(code.size(0), -1).long()
+            weight = self.codebook[index]
+        weight = (weight * absmax).flatten()[:self.shape.numel()].view(self.shape).to(self.dtype)
+        return weight
+
+
+class QuantizedLinearFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, bias, module, transpose):
+        weight = module.weight.t() if transpose else module.weight
+        y = F.linear(x, weight, bias)
+        # only the codes are kept, the weight is dequantized again in backward
+        ctx.module, ctx.transpose = module, transpose
+        return y
+
+    @staticmethod
+    def backward(ctx, grad_y):
+        grad_x = grad_bias = None
+        if ctx.needs_input_grad[0]:
+            weight = ctx.module.weight.t() if ctx.transpose else ctx.module.weight
+            grad_x = grad_y.matmul(weight)
+        if ctx.needs_input_grad[1]:
+            grad_bias = grad_y.reshape(-1, grad_y.size(-1)).sum(0)
+        return grad_x, grad_bias, None, None
+
+
+def quantized_forward(self, x):
+    y = QuantizedLinearFunction.apply(x, self.bias, self, isinstance(self, Conv1D))
+    return y
+
+
+def find_quantize_modules(model):
+    backbone = getattr(model, model.base_model_prefix, model)
+    input_embeddings = model.get_input_embeddings()
+    tied = input_embeddings.weight if input_embeddings is not None else None
+    modules = []
+    for module in backbone.modules():
+        if isinstance(module, (nn.Linear, Conv1D)) and module.weight is not tied and \
+                module.weight.is_floating_point():
+            modules.append(module)
+    return modules
+
+
+def quantize_model(model, quantize_mode, block_size=64):
+    # the linear layers of the frozen backbone are stored quantized, heads and adapters stay in full precision
+    modules = find_quantize_modules(model)
+    for module in modules:
+        module.weight.requires_grad_(False)
+        parametrize.register_parametrization(module, 'weight', QuantizedWeight(quantize_mode, block_size))
+        module.forward = types.MethodType(quantized_forward, module)
+    return len(modules)
+
+
+def is_quantized(module):
+    return parametrize.is_parametrized(module, 'weight') and \
+        isinstance(module.parametrizations.weight[0], QuantizedWeight)
+
+
+def dequantize_model(model):
+    # merging writes into the base weights, so they are restored to full precision first
+    # the parametrized class is left intact, unlike remove_parametrizations, so a copy or a restored module keeps it
+    for module in list(model.modules()):
+        if is_quantized(module):
+            weight = module.weight.detach()
+            del module.parametrizations
+            module.__class__ = type(module).__bases__[0]
+            module.weight = nn.Parameter(weight, requires_grad=False)
+            del module.forward
+    return model
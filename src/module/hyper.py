@@ -7,6 +7,15 @@ def process_control():
     cfg['batch_size'] = int(cfg['control']['batch_size'])
     ft_name_list = cfg['control']['ft_name'].split('-')
     cfg['ft_name'] = ft_name_list[0]
+    if cfg['ft_name'] == 'cola':
+        # cola-<aux model>-<update interval>-<merge>-<dist>
+        cfg['cola'] = {'model_name': ft_name_list[1], 'interval': int(ft_name_list[2]) if len(ft_name_list) > 2 else 1,
+                       'merge': int(ft_name_list[3]) if len(ft_name_list) > 3 else 0,
+                       'dist': int(ft_name_list[4]) if len(ft_name_list) > 4 else 0,
+                       'rank': 8, 'hidden_size': 128, 'num_workers': 4}
+    elif cfg['ft_name'] == 'full':
+        # full-<optimizer>
+        cfg['full'] = {'optimizer_name': ft_name_list[1] if len(ft_name_list) > 1 else 'AdamW'}
     make_data_name()
     if cfg['task_name'] in ['s2s', 'sc', 'clm', 't2i']:
         cfg['collate_mode'] = 'transformer'
@@ -35,7 +44,8 @@ def process_control():
         cfg[model_name] = {}
     cfg[model_name]['shuffle'] = {'train': True, 'test': False}
     if cfg['task_name'] in ['s2s', 'sc', 'clm']:
-        cfg[model_name]['optimizer_name'] = 'AdamW'
+        cfg[model_name]['optimizer_name'] = cfg['full']['optimizer_name'] if cfg['ft_name'] == 'full' else 'AdamW'
+        cfg[model_name]['galore'] = {'rank': 128, 'update_proj_gap': 200, 'scale': 0.25}
         if cfg['ft_name'] == 'full':
             cfg[model_name]['lr'] = 5e-6
         else:
@@ -45,7 +55,9 @@ def process_control():
         cfg[model_name]['weight_decay'] = 5e-4
         cfg[model_name]['nesterov'] = True
         cfg[model_name]['num_epochs'] = 40
-        cfg[model_name]['batch_size'] = {'train': cfg['batch_size'], 'test': cfg['batch_size']}
+        # evaluation keeps no activations for backward, so a few training batches fit wherever training does
+        cfg[model_name]['batch_size'] = {'train': cfg['batch_size'], 'test': cfg['batch_size'],
+                                         'eval': cfg['batch_size'] * cfg['eval_batch_scale']}
         cfg[model_name]['scheduler_name'] = 'LinearAnnealingLR'
         cfg[model_name]['warmup_ratio'] = 0.05
     elif cfg['task_name'] in ['ic']:
@@ -56,7 +68,8 @@ def process_control():
         cfg[model_name]['weight_decay'] = 5e-4
         cfg[model_name]['nesterov'] = True
         cfg[model_name]['num_epochs'] = 400
-        cfg[model_name]['batch_size'] = {'train': cfg['batch_size'], 'test': cfg['batch_size']}
+        cfg[model_name]['batch_size'] = {'train': cfg['batch_size'], 'test': cfg['batch_size'],
+                                         'eval': cfg['batch_size'] * cfg['eval_batch_scale']}
         cfg[model_name]['scheduler_name'] = 'CosineAnnealingLR'
     elif cfg['task_name'] in ['t2i']:
         cfg['collate_mode'] = 'dreambooth'
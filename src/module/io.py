@@ -1,4 +1,5 @@
 import errno
+import hashlib
 import numpy as np
 import os
 import pickle
@@ -25,14 +26,20 @@ def makedir_exist_ok(path):
 def save(input, path, mode='pickle'):
     dirname = os.path.dirname(path)
     makedir_exist_ok(dirname)
+    # write to a temporary file and rename, so a path hardlinked into the blob store is replaced, not truncated
+    tmp_path = '{}.tmp'.format(path)
     if mode == 'torch':
-        torch.save(input, path)
+        torch.save(input, tmp_path)
     elif mode == 'np':
-        np.save(path, input, allow_pickle=True)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, input, allow_pickle=True)
+        path = path if path.endswith('.npy') else '{}.npy'.format(path)
     elif mode == 'pickle':
-        pickle.dump(input, open(path, 'wb'))
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(input, f)
     else:
         raise ValueError('Not valid save mode')
+    os.replace(tmp_path, path)
     return
 
 
@@ -48,6 +55,84 @@ def load(path, mode='pickle'):
     return
 
 
+def hash_file(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def list_files(path):
+    if os.path.isfile(path):
+        return ['']
+    files = []
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            files.append(os.path.relpath(os.path.join(root, filename), path))
+    return sorted(files)
+
+
+def save_blob(path, blob_path):
+    makedir_exist_ok(blob_path)
+    for file in list_files(path):
+        file_path = os.path.join(path, file) if file else path
+        # a file still linked to its blob is unchanged, only rewritten files are hashed
+        if os.stat(file_path).st_nlink > 1:
+            continue
+        blob_file_path = os.path.join(blob_path, hash_file(file_path))
+        if os.path.exists(blob_file_path):
+            os.remove(file_path)
+        else:
+            os.replace(file_path, blob_file_path)
+        os.link(blob_file_path, file_path)
+    return
+
+
+def link_blob(src, dst):
+    files = list_files(src)
+    # files of an earlier promotion that src no longer has are removed, other entries of dst such as a compact
+    # adapter are kept
+    if os.path.isdir(dst):
+        names = set(file.split(os.sep)[0] for file in files)
+        for file in set(list_files(dst)) - set(files):
+            if file.split(os.sep)[0] in names:
+                os.remove(os.path.join(dst, file))
+    for file in files:
+        src_file_path = os.path.join(src, file) if file else src
+        dst_file_path = os.path.join(dst, file) if file else dst
+        # renaming onto a hardlink of the same file does nothing and would leave the temporary link behind
+        if os.path.exists(dst_file_path) and os.path.samefile(src_file_path, dst_file_path):
+            continue
+        makedir_exist_ok(os.path.dirname(dst_file_path))
+        tmp_path = '{}.tmp'.format(dst_file_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        os.link(src_file_path, tmp_path)
+        os.replace(tmp_path, dst_file_path)
+    return
+
+
+def release_blob(path):
+    if not os.path.exists(path):
+        return
+    for file in list_files(path):
+        file_path = os.path.join(path, file) if file else path
+        if os.stat(file_path).st_nlink > 1:
+            os.remove(file_path)
+    return
+
+
+def clean_blob(blob_path):
+    if not os.path.exists(blob_path):
+        return
+    for filename in os.listdir(blob_path):
+        blob_file_path = os.path.join(blob_path, filename)
+        if os.stat(blob_file_path).st_nlink == 1:
+            os.remove(blob_file_path)
+    return
+
+
 def save_img(img, path, nrow=10, padding=1, pad_value=0, value_range=None):
     makedir_exist_ok(os.path.dirname(path))
     normalize = False if range is None else True
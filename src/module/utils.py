@@ -1,5 +1,7 @@
+import ctypes
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 from collections.abc import Iterable, Sequence, Mapping
 from itertools import repeat
 
@@ -31,3 +33,48 @@ def recur(fn, input, *args):
     else:
         raise ValueError('Not valid input type')
     return output
+
+
+def get_memory(optimizer):
+    # memory of the optimizer states and, on a gpu, the peak memory since the last call, both in GB
+    state = sum(v.numel() * v.element_size() for state in optimizer.state.values() for v in state.values()
+                if isinstance(v, torch.Tensor))
+    memory = {'StateMemory': state / 2 ** 30}
+    if torch.cuda.is_available():
+        memory['Memory'] = torch.cuda.max_memory_allocated() / 2 ** 30
+        torch.cuda.reset_peak_memory_stats()
+    return memory
+
+
+def read_memory(path='/proc/self/status', keys=('VmRSS', 'RssAnon')):
+    # memory freed by the allocator is handed back first, so only live memory is counted, in MB
+    ctypes.CDLL('libc.so.6').malloc_trim(0)
+    memory = {}
+    with open(path, 'r') as f:
+        for line in f:
+            k = line.split(':')[0]
+            if k in keys:
+                memory[k] = int(line.split()[1]) / 2 ** 10
+    return memory
+
+
+def run_target(target, args, queue):
+    # the parent always gets a result, an exception of the run is raised there
+    try:
+        queue.put(target(*args))
+    except Exception as e:
+        queue.put(e)
+    return
+
+
+def run_process(target, *args):
+    # a fresh process per run, so the resident memory belongs to that run
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_target, args=(target, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
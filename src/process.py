@@ -58,6 +58,11 @@ def make_all_controls(mode, task_name):
             batch_size = ['32']
         control_name = [[data_names, model_names, [task_name], ['full'], batch_size]]
         controls = make_controls(control_name)
+    elif mode == 'full_optimizer':
+        ft_name = ['full-AdamW8bit', 'full-GaLoreAdamW'] if task_name != 'ic' else []
+        batch_size = ['32']
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
+        controls = make_controls(control_name)
     elif mode == 'peft':
         if task_name == 'ic':
             ft_name = ['lora']
@@ -70,13 +75,46 @@ def make_all_controls(mode, task_name):
                 batch_size = ['32']
         control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
         controls = make_controls(control_name)
+    elif mode == 'cola':
+        ft_name = ['cola-lowrank-1', 'cola-linear-1', 'cola-mlp-1']
+        if task_name == 'ic':
+            batch_size = ['256']
+        elif model_names[0] == 'llama-2':
+            batch_size = ['8']
+        else:
+            batch_size = ['32']
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
+        controls = make_controls(control_name)
+    elif mode == 'cola_step':
+        ft_name = ['cola-lowrank-1', 'cola-lowrank-2', 'cola-lowrank-4', 'cola-lowrank-8']
+        batch_size = ['8', '64']
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
+        controls = make_controls(control_name)
+    elif mode == 'cola_dist':
+        # one base model with an adapter per split, only for data sets with a split column
+        data_names = [x for x in data_names if x in ['dolly-15k']]
+        ft_name = ['cola-lowrank-1-0-1', 'cola-linear-1-0-1', 'cola-mlp-1-0-1']
+        batch_size = ['8'] if model_names[0] == 'llama-2' else ['32']
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
+        controls = make_controls(control_name)
+    elif mode == 'cola_merge':
+        # the adapter is folded into the base model and restarted every epoch
+        ft_name = ['cola-lowrank-1-1', 'cola-linear-1-1']
+        if task_name == 'ic':
+            batch_size = ['256']
+        elif model_names[0] == 'llama-2':
+            batch_size = ['8']
+        else:
+            batch_size = ['32']
+        control_name = [[data_names, model_names, [task_name], ft_name, batch_size]]
+        controls = make_controls(control_name)
     else:
         raise ValueError('Not valid mode')
     return controls
 
 
 def main():
-    modes = ['full', 'peft', 'cola', 'cola_step', 'cola_dist', 'cola_merge', 'cola_dist_merge']
+    modes = ['full', 'full_optimizer', 'peft', 'cola', 'cola_step', 'cola_dist', 'cola_merge']
     task_names = ['s2s', 'sc', 'clm', 'ic']
     controls = []
     for mode in modes:
@@ -129,13 +167,18 @@ def gather_result(control, model_tag, processed_result):
 
 def summarize_result(key, value):
     if key in ['mean', 'history']:
-        value['summary']['value'] = np.stack(list(value.values()), axis=0)
-        value['summary']['mean'] = np.mean(value['summary']['value'], axis=0)
-        value['summary']['std'] = np.std(value['summary']['value'], axis=0)
-        value['summary']['max'] = np.max(value['summary']['value'], axis=0)
-        value['summary']['min'] = np.min(value['summary']['value'], axis=0)
-        value['summary']['argmax'] = np.argmax(value['summary']['value'], axis=0)
-        value['summary']['argmin'] = np.argmin(value['summary']['value'], axis=0)
+        value_ = [np.asarray(x, dtype=np.float64) for x in value.values()]
+        if key == 'history':
+            # histories are aligned by epoch, epochs a run did not log or did not reach are nan
+            length = max(len(x) for x in value_)
+            value_ = [np.concatenate([x, np.full((length - len(x), *x.shape[1:]), np.nan)]) for x in value_]
+        value['summary']['value'] = np.stack(value_, axis=0)
+        value['summary']['mean'] = np.nanmean(value['summary']['value'], axis=0)
+        value['summary']['std'] = np.nanstd(value['summary']['value'], axis=0)
+        value['summary']['max'] = np.nanmax(value['summary']['value'], axis=0)
+        value['summary']['min'] = np.nanmin(value['summary']['value'], axis=0)
+        value['summary']['argmax'] = np.argmax(np.nan_to_num(value['summary']['value'], nan=-np.inf), axis=0)
+        value['summary']['argmin'] = np.argmin(np.nan_to_num(value['summary']['value'], nan=np.inf), axis=0)
         value['summary']['value'] = value['summary']['value'].tolist()
     else:
         for k, v in value.items():
@@ -151,6 +194,10 @@ def extract_result(extracted_processed_result, processed_result, control):
             if metric_name in ['test/Rouge', 'test/ROUGE', 'test/GLUE', 'test/Accuracy']:
                 if mode == 'history':
                     output = True
+            # memory per epoch, to compare full fine-tuning optimizers with the adapters
+            if metric_name in ['train/Memory', 'train/StateMemory']:
+                if mode == 'history':
+                    output = True
         elif split == 'test':
             if metric_name in ['test/Rouge', 'test/ROUGE', 'test/GLUE', 'test/Accuracy']:
                 if mode == 'mean':
@@ -201,20 +248,23 @@ def make_vis_method(df_history):
     label_dict = {'full': 'FT', 'lora': 'LoRA', 'adalora': 'AdaLoRA', 'ia3': 'IA3', 'promptune': 'Promp Tuning',
                   'prefixtune': 'Prefix Tuning', 'ptune': 'P-Tuning', 'cola-lowrank': 'ColA (Low Rank, unmerged)',
                   'cola-linear': 'ColA (Linear, unmerged)', 'cola-mlp': 'ColA (MLP, unmerged)',
-                  'cola-lowrank-1': 'ColA (Low Rank, merged)', 'cola-linear-1': 'ColA (Linear, merged)'}
+                  'cola-lowrank-1': 'ColA (Low Rank, merged)', 'cola-linear-1': 'ColA (Linear, merged)',
+                  'full-AdamW8bit': 'FT (8-bit AdamW)', 'full-GaLoreAdamW': 'FT (GaLore)'}
     color_dict = {'full': 'black', 'lora': 'red', 'adalora': 'orange', 'ia3': 'green', 'promptune': 'blue',
                   'prefixtune': 'dodgerblue', 'ptune': 'lightblue', 'cola-lowrank': 'gold',
                   'cola-linear': 'silver', 'cola-mlp': 'purple', 'cola-lowrank-1': 'goldenrod',
-                  'cola-linear-1': 'gray'}
+                  'cola-linear-1': 'gray', 'full-AdamW8bit': 'dimgray', 'full-GaLoreAdamW': 'brown'}
     linestyle_dict = {'full': '-', 'lora': (0, (5, 5)), 'adalora': (0, (1, 1)), 'ia3': (0, (3, 5, 1, 5)),
                       'promptune': (0, (5, 1)), 'prefixtune': (0, (1, 5)), 'ptune': (0, (5, 5, 1, 1)),
                       'cola-lowrank': (0, (5, 1, 1, 1)), 'cola-linear': (0, (10, 5)), 'cola-mlp': (0, (10, 10)),
-                      'cola-lowrank-1': (0, (5, 5, 5, 1)), 'cola-linear-1': (0, (5, 10))}
+                      'cola-lowrank-1': (0, (5, 5, 5, 1)), 'cola-linear-1': (0, (5, 10)),
+                      'full-AdamW8bit': (0, (3, 1, 1, 1)), 'full-GaLoreAdamW': (0, (3, 1))}
     marker_dict = {'full': 'D', 'lora': 's', 'adalora': 'p', 'ia3': 'd', 'promptune': 'd',
                    'prefixtune': 'p', 'ptune': 's', 'cola-lowrank': 'o',
                    'cola-linear': 'o', 'cola-mlp': 'o', 'cola-lowrank-1': 'o',
-                   'cola-linear-1': 'o', 'cola-mlp-1': 'o'}
-    loc_dict = {'ROUGE': 'lower right', 'GLUE': 'lower right', 'Accuracy': 'lower right'}
+                   'cola-linear-1': 'o', 'cola-mlp-1': 'o', 'full-AdamW8bit': 'D', 'full-GaLoreAdamW': 'D'}
+    loc_dict = {'ROUGE': 'lower right', 'GLUE': 'lower right', 'Accuracy': 'lower right', 'Memory': 'upper right',
+                'StateMemory': 'upper right'}
     fontsize_dict = {'legend': 10, 'label': 16, 'ticks': 16}
     figsize = (5, 4)
     fig = {}
@@ -0,0 +1,220 @@
+import argparse
+import asyncio
+import collections
+import json
+import time
+import numpy as np
+import torch
+from config import cfg, process_args
+from model import make_model, make_adapter_pool
+from module import to_device, process_control
+
+parser = argparse.ArgumentParser(description='cfg')
+for k in cfg:
+    exec('parser.add_argument(\'--{0}\', default=cfg[\'{0}\'], type=type(cfg[\'{0}\']))'.format(k))
+parser.add_argument('--control_name', default=None, type=str)
+parser.add_argument('--host', default='127.0.0.1', type=str)
+parser.add_argument('--port', default=8000, type=int)
+parser.add_argument('--socket', default=None, type=str)
+parser.add_argument('--num_slots', default=8, type=int)
+parser.add_argument('--rank', default=8, type=int)
+parser.add_argument('--max_batch_size', default=32, type=int)
+parser.add_argument('--max_wait', default=0.005, type=float)
+parser.add_argument('--max_new_tokens', default=128, type=int)
+args = vars(parser.parse_args())
+process_args(args)
+
+
+class Stats:
+    def __init__(self, window=1000):
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_tokens = 0
+        self.latency = collections.deque(maxlen=window)
+
+    def append(self, latency, num_tokens):
+        self.num_requests += len(latency)
+        self.num_batches += 1
+        self.num_tokens += num_tokens
+        self.latency.extend(latency)
+        return
+
+    def state_dict(self, pool):
+        elapsed = time.time() - self.start_time
+        latency = np.asarray(self.latency) if len(self.latency) > 0 else np.zeros(1)
+        return {'num_requests': self.num_requests, 'num_batches': self.num_batches,
+                'batch_size': self.num_requests / max(self.num_batches, 1),
+                'throughput': self.num_requests / elapsed, 'token_throughput': self.num_tokens / elapsed,
+                'latency': {'mean': float(latency.mean()), 'p50': float(np.percentile(latency, 50)),
+                            'p90': float(np.percentile(latency, 90)), 'p99': float(np.percentile(latency, 99))},
+                'num_loads': pool.num_loads, 'num_evictions': pool.num_evictions, 'resident': list(pool.slot.keys())}
+
+
+class Server:
+    def __init__(self, pool, tokenizer):
+        self.pool = pool
+        self.tokenizer = tokenizer
+        self.queue = None
+        self.stats = Stats()
+
+    def run(self, batch):
+        request = [x[0] for x in batch]
+        index, failed = self.pool.acquire([x.get('adapter') for x in request])
+        # requests for an adapter that failed to load get its error, the rest of the batch is served
+        served = [i for i in range(len(request)) if request[i].get('adapter') not in failed]
+        output = [failed.get(x.get('adapter')) for x in request]
+        num_tokens = 0
+        if len(served) > 0:
+            index = torch.tensor([index[i] for i in served], device=cfg['device'])
+            output_served, num_tokens = self.predict([request[i] for i in served], index)
+            for i, output_i in zip(served, output_served):
+                output[i] = output_i
+        return output, num_tokens
+
+    def predict(self, request, index):
+        text = [x['text'] for x in request]
+        max_length = cfg[cfg['model_name']]['max_length']
+        with torch.no_grad():
+            if cfg['task_name'] == 'sc':
+                # sentence pairs come as a list of two texts
+                if isinstance(text[0], list):
+                    input = self.tokenizer([x[0] for x in text], [x[1] for x in text], padding=True,
+                                           truncation=True, max_length=max_length, return_tensors='pt')
+                else:
+                    input = self.tokenizer(text, padding=True, truncation=True, max_length=max_length,
+                                           return_tensors='pt')
+                input = to_device(dict(input), cfg['device'])
+                logits = self.pool.classify(input, index)
+                output = [{'logits': x.float().cpu().tolist(), 'label': int(x.argmax(-1))} for x in logits]
+                num_tokens = 0
+            elif cfg['task_name'] in ['s2s', 'clm']:
+                input = self.tokenizer(text, padding=True, truncation=True, max_length=max_length,
+                                       return_tensors='pt')
+                input = to_device(dict(input), cfg['device'])
+                max_new_tokens = [x.get('max_new_tokens', args['max_new_tokens']) for x in request]
+                if cfg['task_name'] == 's2s':
+                    generate = self.pool.generate(input, index, max_new_tokens=max(max_new_tokens))
+                else:
+                    generate = self.pool.generate(input, index, max_new_tokens=max(max_new_tokens),
+                                                  eos_token_id=cfg['pad_token_id'], no_repeat_ngram_size=2)
+                    generate = generate[:, input['input_ids'].size(1):]
+                output = []
+                num_tokens = 0
+                for i in range(len(request)):
+                    generate_i = generate[i, :max_new_tokens[i]]
+                    generate_i = generate_i[generate_i != cfg['pad_token_id']]
+                    num_tokens += generate_i.numel()
+                    output.append({'text': self.tokenizer.decode(generate_i, skip_special_tokens=True)})
+            else:
+                raise ValueError('Not valid task name')
+        return output, num_tokens
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + args['max_wait']
+            while len(batch) < args['max_batch_size']:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # a batch holds at most as many distinct adapters as there are slots, the rest waits for the next one
+            adapters, admitted, deferred = set(), [], []
+            for x in batch:
+                adapter = x[0].get('adapter')
+                if adapter is not None and adapter not in adapters and len(adapters) >= self.pool.num_slots:
+                    deferred.append(x)
+                    continue
+                if adapter is not None:
+                    adapters.add(adapter)
+                admitted.append(x)
+            for x in deferred:
+                self.queue.put_nowait(x)
+            try:
+                output, num_tokens = await loop.run_in_executor(None, self.run, admitted)
+            except Exception as e:
+                for x in admitted:
+                    x[1].set_exception(e)
+                continue
+            end_time = time.time()
+            served = []
+            for x, output_i in zip(admitted, output):
+                if isinstance(output_i, Exception):
+                    x[1].set_exception(output_i)
+                    continue
+                output_i['latency'] = end_time - x[2]
+                x[1].set_result(output_i)
+                served.append(x)
+            self.stats.append([end_time - x[2] for x in served], num_tokens)
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b'\r\n', b'\n', b'']:
+                        break
+                    k, v = line.decode().split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if method == 'POST' and path == '/predict':
+                    future = loop.create_future()
+                    await self.queue.put((json.loads(body), future, time.time()))
+                    try:
+                        status, response = 200, await future
+                    except Exception as e:
+                        status, response = 400, {'error': str(e)}
+                elif method == 'GET' and path == '/stats':
+                    status, response = 200, self.stats.state_dict(self.pool)
+                else:
+                    status, response = 404, {'error': 'Not valid path'}
+                response = json.dumps(response).encode()
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                    status, 'OK' if status == 200 else 'Error', len(response)).encode() + response)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        writer.close()
+        return
+
+    async def serve(self):
+        self.queue = asyncio.Queue()
+        asyncio.get_running_loop().create_task(self.batcher())
+        if args['socket'] is not None:
+            server = await asyncio.start_unix_server(self.handle, path=args['socket'])
+        else:
+            server = await asyncio.start_server(self.handle, args['host'], args['port'])
+        print('Serving {} on {}'.format(cfg['model_name'], args['socket'] or '{}:{}'.format(args['host'],
+                                                                                          args['port'])))
+        async with server:
+            await server.serve_forever()
+        return
+
+
+def main():
+    process_control()
+    torch.manual_seed(cfg['init_seed'])
+    model, tokenizer = make_model(cfg['model_name'])
+    pool = make_adapter_pool(model, args['num_slots'], args['rank'])
+    model = model.to(cfg['device'])
+    model.train(False)
+    server = Server(pool, tokenizer)
+    asyncio.run(server.serve())
+    return
+
+
+if __name__ == "__main__":
+    main()
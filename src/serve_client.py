@@ -0,0 +1,89 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import numpy as np
+
+parser = argparse.ArgumentParser(description='serve client')
+parser.add_argument('--host', default='127.0.0.1', type=str)
+parser.add_argument('--port', default=8000, type=int)
+parser.add_argument('--socket', default=None, type=str)
+parser.add_argument('--adapters', default=None, type=str)
+parser.add_argument('--text', default='The company reported a rise in quarterly profit.', type=str)
+parser.add_argument('--max_new_tokens', default=None, type=int)
+parser.add_argument('--num_requests', default=1000, type=int)
+parser.add_argument('--concurrency', default=32, type=int)
+parser.add_argument('--seed', default=0, type=int)
+args = vars(parser.parse_args())
+
+
+async def connect():
+    if args['socket'] is not None:
+        return await asyncio.open_unix_connection(args['socket'])
+    return await asyncio.open_connection(args['host'], args['port'])
+
+
+async def request(reader, writer, method, path, body=None):
+    body = b'' if body is None else json.dumps(body).encode()
+    writer.write('{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+        method, path, args['host'], len(body)).encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).decode().split(' ')[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [b'\r\n', b'\n', b'']:
+            break
+        k, v = line.decode().split(':', 1)
+        headers[k.strip().lower()] = v.strip()
+    response = json.loads(await reader.readexactly(int(headers['content-length'])))
+    return status, response
+
+
+async def worker(queue, latency, error):
+    reader, writer = await connect()
+    while not queue.empty():
+        body = queue.get_nowait()
+        start_time = time.time()
+        status, _ = await request(reader, writer, 'POST', '/predict', body)
+        if status == 200:
+            latency.append(time.time() - start_time)
+        else:
+            error.append(status)
+    writer.close()
+    return
+
+
+async def run():
+    random.seed(args['seed'])
+    adapters = args['adapters'].split(',') if args['adapters'] is not None else [None]
+    queue = asyncio.Queue()
+    for _ in range(args['num_requests']):
+        body = {'adapter': random.choice(adapters), 'text': args['text']}
+        if args['max_new_tokens'] is not None:
+            body['max_new_tokens'] = args['max_new_tokens']
+        queue.put_nowait(body)
+    latency, error = [], []
+    start_time = time.time()
+    await asyncio.gather(*[worker(queue, latency, error) for _ in range(args['concurrency'])])
+    elapsed = time.time() - start_time
+    latency = np.asarray(latency) if len(latency) > 0 else np.zeros(1)
+    print('Requests: {}, Errors: {}, Elapsed: {:.2f}s, Throughput: {:.2f} req/s'.format(
+        args['num_requests'], len(error), elapsed, (args['num_requests'] - len(error)) / elapsed))
+    print('Latency: mean {:.4f}s, p50 {:.4f}s, p90 {:.4f}s, p99 {:.4f}s'.format(
+        latency.mean(), np.percentile(latency, 50), np.percentile(latency, 90), np.percentile(latency, 99)))
+    reader, writer = await connect()
+    _, stats = await request(reader, writer, 'GET', '/stats')
+    writer.close()
+    print('Server: {}'.format(json.dumps(stats)))
+    return
+
+
+def main():
+    asyncio.run(run())
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import itertools
+import math
+import os
+import subprocess
+import time
+from config import cfg, make_control
+from module import save, load, process_control
+from make import make_control_name
+
+parser = argparse.ArgumentParser(description='sweep')
+parser.add_argument('--init_gpu', default=0, type=int)
+parser.add_argument('--num_gpu', default=4, type=int)
+parser.add_argument('--world_size', default=1, type=int)
+parser.add_argument('--init_seed', default=0, type=int)
+parser.add_argument('--num_experiment', default=1, type=int)
+parser.add_argument('--mode', default=None, type=str)
+parser.add_argument('--task_name', default=None, type=str)
+parser.add_argument('--rungs', default=None, type=str)
+parser.add_argument('--eta', default=3, type=int)
+parser.add_argument('--poll', default=10, type=int)
+args = vars(parser.parse_args())
+
+
+def make_controls(mode, task_name):
+    # the modes are the ones of make.py, scripts without stop_epoch can not be stopped at a rung
+    if mode in ['full_dreambooth', 'peft_dreambooth']:
+        raise ValueError('Not valid mode for sweep')
+    script_name, control_name = make_control_name('train', mode, task_name)
+    control_names = ['_'.join(x) for i in range(len(control_name)) for x in itertools.product(*control_name[i])]
+    return script_name, control_names
+
+
+def make_rungs(num_epochs, eta):
+    if args['rungs'] is not None:
+        rungs = sorted(set(int(x) for x in args['rungs'].split(',')) | {num_epochs})
+    else:
+        rungs = [num_epochs]
+        while rungs[0] // eta >= 1:
+            rungs.insert(0, rungs[0] // eta)
+    return rungs
+
+
+def group_name(control_name):
+    # methods compete within the same data, model, task and batch size
+    control = make_control(cfg['control'], control_name)
+    control = {k: control[k] for k in control if k != 'ft_name'}
+    return '_'.join(control.values())
+
+
+def run_jobs(jobs, gpu_ids, poll):
+    queue = list(jobs)
+    running = {}
+    while len(queue) > 0 or len(running) > 0:
+        for gpu_id in gpu_ids:
+            if gpu_id not in running and len(queue) > 0:
+                command = queue.pop(0)
+                env = {**os.environ, 'CUDA_VISIBLE_DEVICES': gpu_id}
+                print(' '.join(command))
+                running[gpu_id] = subprocess.Popen(command, env=env)
+        for gpu_id in list(running.keys()):
+            if running[gpu_id].poll() is not None:
+                if running[gpu_id].returncode != 0:
+                    print('Failed: {}'.format(' '.join(running[gpu_id].args)))
+                del running[gpu_id]
+        time.sleep(poll)
+    return
+
+
+def read_pivot(model_tag):
+    path = os.path.join('output', 'model', model_tag, 'checkpoint', 'model')
+    if not os.path.exists(path):
+        return None
+    result = load(path)
+    metric_state_dict = result['metric_state_dict']
+    # the pivot is the best full evaluation so far, kept in the same direction as the logger history
+    history = result['logger_state_dict']['history']['test/{}'.format(metric_state_dict['pivot_name'])]
+    if len(history) == 0:
+        return None
+    return metric_state_dict['pivot'], metric_state_dict['pivot_direction']
+
+
+def prune(control_names, seeds, eta):
+    group = {}
+    for control_name in control_names:
+        pivot = [read_pivot('{}_{}'.format(seed, control_name)) for seed in seeds]
+        pivot = [x for x in pivot if x is not None]
+        if len(pivot) == 0:
+            continue
+        direction = pivot[0][1]
+        score = sum(x[0] for x in pivot) / len(pivot)
+        score = score if direction == 'up' else -score
+        group.setdefault(group_name(control_name), []).append((score, control_name))
+    survivor = []
+    record = {}
+    for name in group:
+        ranked = sorted(group[name], key=lambda x: x[0], reverse=True)
+        num_survivor = max(int(math.ceil(len(ranked) / eta)), 1)
+        survivor.extend([x[1] for x in ranked[:num_survivor]])
+        record[name] = ranked
+    return survivor, record
+
+
+def main():
+    script_name, control_names = make_controls(args['mode'], args['task_name'])
+    cfg['control'] = make_control(cfg['control'], control_names[0])
+    process_control()
+    num_epochs = cfg[cfg['model_name']]['num_epochs']
+    rungs = make_rungs(num_epochs, args['eta'])
+    seeds = list(range(args['init_seed'], args['init_seed'] + args['num_experiment']))
+    gpu_ids = [','.join(str(i) for i in range(x, x + args['world_size'])) for x in
+               range(args['init_gpu'], args['init_gpu'] + args['num_gpu'], args['world_size'])]
+    survivor = control_names
+    record = {'rungs': rungs, 'rung': {}}
+    for rung in rungs:
+        print('Rung {}: {} controls'.format(rung, len(survivor)))
+        jobs = [['python', script_name, '--init_seed', str(seed), '--world_size', str(args['world_size']),
+                 '--num_experiments', '1', '--resume_mode', '1', '--stop_epoch', str(rung), '--control_name',
+                 control_name] for control_name in survivor for seed in seeds]
+        run_jobs(jobs, gpu_ids, args['poll'])
+        if rung < num_epochs:
+            survivor, record['rung'][rung] = prune(survivor, seeds, args['eta'])
+        record['survivor'] = survivor
+        save(record, os.path.join('output', 'sweep', '{}_{}'.format(args['mode'], args['task_name'])))
+    # every control, pruned or not, is tested on its best checkpoint so process.py finds a result for it
+    test_script_name = script_name.replace('train', 'test')
+    jobs = [['python', test_script_name, '--init_seed', str(seed), '--world_size', str(args['world_size']),
+             '--num_experiments', '1', '--resume_mode', '1', '--control_name', control_name]
+            for control_name in control_names for seed in seeds]
+    run_jobs(jobs, gpu_ids, args['poll'])
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import numpy as np
+import os
+import torch
+import torch.backends.cudnn as cudnn
+from config import cfg, process_args
+from experiment import Experiment
+from dataset import make_data_loader, make_eval_data_loader
+from metric import make_metric, make_logger
+from model import make_ft_model, make_engine, dequantize_model
+from module import save, load, process_control, resume
+
+cudnn.benchmark = True
+parser = argparse.ArgumentParser(description='cfg')
+for k in cfg:
+    exec('parser.add_argument(\'--{0}\', default=cfg[\'{0}\'], type=type(cfg[\'{0}\']))'.format(k))
+parser.add_argument('--control_name', default=None, type=str)
+args = vars(parser.parse_args())
+process_args(args)
+
+
+def main():
+    process_control()
+    seeds = list(range(cfg['init_seed'], cfg['init_seed'] + cfg['num_experiments']))
+    experiment = Experiment()
+    for i in range(cfg['num_experiments']):
+        model_tag_list = [str(seeds[i]), cfg['control_name']]
+        cfg['model_tag'] = '_'.join([x for x in model_tag_list if x])
+        print('Experiment: {}'.format(cfg['model_tag']))
+        runExperiment(experiment)
+    return
+
+
+def runExperiment(experiment):
+    cfg['seed'] = int(cfg['model_tag'].split('_')[0])
+    torch.manual_seed(cfg['seed'])
+    torch.cuda.manual_seed(cfg['seed'])
+    model_path = os.path.join('output', 'model')
+    result_path = os.path.join('output', 'result')
+    model_tag_path = os.path.join(model_path, cfg['model_tag'])
+    checkpoint_path = os.path.join(model_tag_path, 'checkpoint')
+    best_path = os.path.join(model_tag_path, 'best')
+    model, tokenizer = experiment.make_model()
+    dataset = experiment.make_dataset()
+    data_loader = make_data_loader(dataset, tokenizer, cfg['model_name'])
+    data_loader['eval'] = make_eval_data_loader(dataset['test'], tokenizer, cfg['model_name'])
+    metric = make_metric({'train': ['Loss'], 'test': ['Loss']}, tokenizer)
+    result = resume(os.path.join(best_path, 'model'))
+    model = make_ft_model(model)
+    model.load_cola_state_dict([load(os.path.join(best_path, 'adapter', str(i))) for i in range(model.num_adapters)])
+    model = model.to(cfg['device'])
+    cfg['epoch'] = result['epoch']
+    test_logger = make_logger(os.path.join('output', 'runs', 'test_{}'.format(cfg['model_tag'])))
+    test_merge_logger = make_logger(os.path.join('output', 'runs', 'test_merge_{}'.format(cfg['model_tag'])))
+    test(data_loader['eval'], model, metric, test_logger)
+    logger_state_dict = {}
+    if model.num_adapters > 1:
+        # every adapter is also reported on its own split, with its own logger
+        split = np.asarray(dataset['test']['split'])
+        for i in range(model.num_adapters):
+            indices = np.nonzero(split == i)[0].tolist()
+            if len(indices) == 0:
+                continue
+            test_split_logger = make_logger(os.path.join('output', 'runs', 'test_{}_{}'.format(cfg['model_tag'], i)))
+            test(make_eval_data_loader(dataset['test'], tokenizer, cfg['model_name'], indices), model, metric,
+                 test_split_logger)
+            logger_state_dict['test_{}'.format(i)] = test_split_logger.state_dict()
+    elif cfg['cola']['model_name'] in ['lowrank', 'linear']:
+        model = dequantize_model(model).merge_and_unload()
+        test(data_loader['eval'], model, metric, test_merge_logger)
+    result = resume(os.path.join(checkpoint_path, 'model'))
+    result = {'cfg': cfg, 'epoch': cfg['epoch'], 'logger_state_dict': {'train': result['logger_state_dict'],
+                                                                       'test': test_logger.state_dict(),
+                                                                       'test_merge': test_merge_logger.state_dict(),
+                                                                       **logger_state_dict}}
+    save(result, os.path.join(result_path, cfg['model_tag']))
+    return
+
+
+def test(data_loader, model, metric, logger):
+    with torch.no_grad():
+        model.train(False)
+        engine = make_engine(model, metric, logger)
+        engine.run(data_loader)
+        evaluation = metric.evaluate('test', 'full')
+        logger.append(evaluation, 'test')
+        info = {'info': ['Model: {}'.format(cfg['model_tag']), 'Test Epoch: {}({:.0f}%)'.format(cfg['epoch'], 100.)]}
+        logger.append(info, 'test')
+        print(logger.write('test', engine.metric_name['test']))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,11 @@ import os
 import torch
 import torch.backends.cudnn as cudnn
 from config import cfg, process_args
-from dataset import make_dataset, make_data_loader, process_dataset, collate
+from experiment import Experiment
+from dataset import make_data_loader, make_eval_data_loader
 from metric import make_metric, make_logger
-from model import make_model
-from module import save, to_device, process_control, resume
+from model import cache_prompt, make_engine, dequantize_model, merge_adapter
+from module import save, process_control, resume
 from peft import PeftModel
 
 cudnn.benchmark = True
@@ -21,15 +22,16 @@ process_args(args)
 def main():
     process_control()
     seeds = list(range(cfg['init_seed'], cfg['init_seed'] + cfg['num_experiments']))
+    experiment = Experiment()
     for i in range(cfg['num_experiments']):
         model_tag_list = [str(seeds[i]), cfg['control_name']]
         cfg['model_tag'] = '_'.join([x for x in model_tag_list if x])
         print('Experiment: {}'.format(cfg['model_tag']))
-        runExperiment()
+        runExperiment(experiment)
     return
 
 
-def runExperiment():
+def runExperiment(experiment):
     cfg['seed'] = int(cfg['model_tag'].split('_')[0])
     torch.manual_seed(cfg['seed'])
     torch.cuda.manual_seed(cfg['seed'])
@@ -38,66 +40,42 @@ def runExperiment():
     model_tag_path = os.path.join(model_path, cfg['model_tag'])
     checkpoint_path = os.path.join(model_tag_path, 'checkpoint')
     best_path = os.path.join(model_tag_path, 'best')
-    dataset = make_dataset(cfg['data_name'], cfg['subset_name'])
-    model, tokenizer = make_model(cfg['model_name'])
-    dataset = process_dataset(dataset, tokenizer)
+    model, tokenizer = experiment.make_model()
+    dataset = experiment.make_dataset()
     data_loader = make_data_loader(dataset, tokenizer, cfg['model_name'])
+    data_loader['eval'] = make_eval_data_loader(dataset['test'], tokenizer, cfg['model_name'])
     metric = make_metric({'train': ['Loss'], 'test': ['Loss']}, tokenizer)
     result = resume(os.path.join(best_path, 'model'))
-    model = PeftModel.from_pretrained(model, os.path.join(best_path, 'adapter'))
+    # another adapter of the run, such as the one written by compact_peft, is tested with its own result
+    model = PeftModel.from_pretrained(model, os.path.join(best_path, cfg['test_adapter']))
     model = model.to(cfg['device'])
     cfg['epoch'] = result['epoch']
     test_logger = make_logger(os.path.join('output', 'runs', 'test_{}'.format(cfg['model_tag'])))
     test_merge_logger = make_logger(os.path.join('output', 'runs', 'test_merge_{}'.format(cfg['model_tag'])))
-    test(data_loader['test'], model, metric, test_logger)
+    test(data_loader['eval'], model, metric, test_logger)
     if cfg['ft_name'] in ['lora']:
-        model = model.merge_and_unload()
-        test(data_loader['test'], model, metric, test_merge_logger)
+        with merge_adapter(dequantize_model(model)):
+            test(data_loader['eval'], model, metric, test_merge_logger)
     result = resume(os.path.join(checkpoint_path, 'model'))
     result = {'cfg': cfg, 'epoch': cfg['epoch'], 'logger_state_dict': {'train': result['logger_state_dict'],
                                                                        'test': test_logger.state_dict(),
                                                                        'test_merge': test_merge_logger.state_dict()}}
-    save(result, os.path.join(result_path, cfg['model_tag']))
+    result_name = cfg['model_tag'] if cfg['test_adapter'] == 'adapter' else '{}_{}'.format(cfg['model_tag'],
+                                                                                            cfg['test_adapter'])
+    save(result, os.path.join(result_path, result_name))
     return
 
 
 def test(data_loader, model, metric, logger):
-    with torch.no_grad():
+    with torch.no_grad(), cache_prompt(model):
         model.train(False)
-        for i, input in enumerate(data_loader):
-            if cfg['task_name'] in ['s2s', 'sc', 'clm']:
-                input_size = input['labels'].size(0)
-                input = {'input_ids': input['input_ids'], 'attention_mask': input['attention_mask'],
-                         'labels': input['labels']}
-                input = to_device(input, cfg['device'])
-                output = model(**input)
-                input_ = {'target': input['labels']}
-                output_ = {'target': output['logits'], 'loss': output['loss']}
-            else:
-                input = collate(input)
-                input_size = input['data'].size(0)
-                input = to_device(input, cfg['device'])
-                output = model(**input)
-                input_ = {'target': input['target']}
-                output_ = {'target': output['target'], 'loss': output['loss']}
-            if cfg['task_name'] == 's2s':
-                output_['generate'] = model.generate(input_ids=input["input_ids"],
-                                                     max_new_tokens=cfg['max_new_tokens'])
-            elif cfg['task_name'] == 'clm':
-                if cfg['data_name'] in ['dolly']:
-                    output_['generate'] = model.generate(input_ids=input["input_ids"],
-                                                         attention_mask=input["attention_mask"],
-                                                         max_new_tokens=cfg['max_new_tokens'],
-                                                         eos_token_id=cfg['pad_token_id'],
-                                                         no_repeat_ngram_size=2)
-            metric.add('test', input_, output_)
-            evaluation = metric.evaluate('test', 'batch', input_, output_)
-            logger.append(evaluation, 'test', input_size)
+        engine = make_engine(model, metric, logger)
+        engine.run(data_loader)
         evaluation = metric.evaluate('test', 'full')
         logger.append(evaluation, 'test')
         info = {'info': ['Model: {}'.format(cfg['model_tag']), 'Test Epoch: {}({:.0f}%)'.format(cfg['epoch'], 100.)]}
         logger.append(info, 'test')
-        print(logger.write('test', metric.metric_name['test']))
+        print(logger.write('test', engine.metric_name['test']))
     return
 
 
@@ -0,0 +1,172 @@
+import argparse
+import datetime
+import os
+import time
+import torch
+import torch.backends.cudnn as cudnn
+from config import cfg, process_args
+from experiment import Experiment
+from dataset import make_data_loader, make_eval_data_loader, collate
+from metric import make_metric, make_logger, make_policy, Accumulator
+from model import make_optimizer, make_scheduler, make_ft_model, make_engine, lm_forward
+from module import save, load, to_device, process_control, resume, save_blob, link_blob, clean_blob
+
+cudnn.benchmark = True
+parser = argparse.ArgumentParser(description='cfg')
+for k in cfg:
+    exec('parser.add_argument(\'--{0}\', default=cfg[\'{0}\'], type=type(cfg[\'{0}\']))'.format(k))
+parser.add_argument('--control_name', default=None, type=str)
+args = vars(parser.parse_args())
+process_args(args)
+
+
+def main():
+    process_control()
+    seeds = list(range(cfg['init_seed'], cfg['init_seed'] + cfg['num_experiments']))
+    experiment = Experiment()
+    for i in range(cfg['num_experiments']):
+        model_tag_list = [str(seeds[i]), cfg['control_name']]
+        cfg['model_tag'] = '_'.join([x for x in model_tag_list if x])
+        print('Experiment: {}'.format(cfg['model_tag']))
+        runExperiment(experiment)
+    return
+
+
+def runExperiment(experiment):
+    cfg['seed'] = int(cfg['model_tag'].split('_')[0])
+    torch.manual_seed(cfg['seed'])
+    torch.cuda.manual_seed(cfg['seed'])
+    model_path = os.path.join('output', 'model')
+    model_tag_path = os.path.join(model_path, cfg['model_tag'])
+    checkpoint_path = os.path.join(model_tag_path, 'checkpoint')
+    best_path = os.path.join(model_tag_path, 'best')
+    blob_path = os.path.join(model_tag_path, 'blob')
+    model, tokenizer = experiment.make_model()
+    dataset = experiment.make_dataset()
+    data_loader = make_data_loader(dataset, tokenizer, cfg['model_name'])
+    data_loader['eval'] = make_eval_data_loader(dataset['test'], tokenizer, cfg['model_name'])
+    policy = make_policy(dataset['test'])
+    if policy.indices is not None:
+        data_loader['eval_subset'] = make_eval_data_loader(dataset['test'], tokenizer, cfg['model_name'],
+                                                           policy.indices)
+    result = resume(os.path.join(checkpoint_path, 'model'), resume_mode=cfg['resume_mode'])
+    metric = make_metric({'train': ['Loss'], 'test': ['Loss']}, tokenizer)
+    logger = make_logger(os.path.join('output', 'runs', 'train_{}'.format(cfg['model_tag'])))
+    model = make_ft_model(model)
+    model.start()
+    if result is not None:
+        model.load_cola_state_dict([load(os.path.join(checkpoint_path, 'adapter', str(i)))
+                                    for i in range(model.num_adapters)])
+    model = model.to(cfg['device'])
+    model.print_trainable_parameters()
+    optimizer = make_optimizer(model.parameters_to_optimize(), cfg['model_name'])
+    scheduler = make_scheduler(optimizer, cfg['model_name'])
+    if result is None:
+        cfg['epoch'] = 1
+    else:
+        cfg['epoch'] = result['epoch']
+        optimizer.load_state_dict(result['optimizer_state_dict'])
+        scheduler.load_state_dict(result['scheduler_state_dict'])
+        metric.load_state_dict(result['metric_state_dict'])
+        logger.load_state_dict(result['logger_state_dict'])
+    num_epochs = cfg[cfg['model_name']]['num_epochs']
+    stop_epoch = num_epochs if cfg['stop_epoch'] == 0 else min(cfg['stop_epoch'], num_epochs)
+    for epoch in range(cfg['epoch'], stop_epoch + 1):
+        cfg['epoch'] = epoch
+        train(data_loader['train'], model, optimizer, scheduler, metric, logger)
+        if cfg['cola']['merge'] > 0 and epoch % cfg['cola']['merge'] == 0:
+            model.merge()
+        evaluated = False
+        if policy.is_eval(epoch):
+            if policy.is_full(epoch):
+                test(data_loader['eval'], model, metric, logger)
+                evaluated = True
+            else:
+                test(data_loader['eval_subset'], model, metric, logger, 'test_subset')
+                if metric.compare(logger.mean['test_subset/{}'.format(metric.pivot_name)], policy.margin(metric)):
+                    test(data_loader['eval'], model, metric, logger)
+                    evaluated = True
+        logger.save(True)
+        result = {'cfg': cfg, 'epoch': cfg['epoch'] + 1,
+                  'optimizer_state_dict': optimizer.state_dict(), 'scheduler_state_dict': scheduler.state_dict(),
+                  'metric_state_dict': metric.state_dict(), 'logger_state_dict': logger.state_dict()}
+        save(result, os.path.join(checkpoint_path, 'model'))
+        cola_state_dict = model.cola_state_dict()
+        for i in range(model.num_adapters):
+            save(cola_state_dict[i], os.path.join(checkpoint_path, 'adapter', str(i)))
+        save_blob(checkpoint_path, blob_path)
+        if evaluated and metric.compare(logger.mean['test/{}'.format(metric.pivot_name)]):
+            metric.update(logger.mean['test/{}'.format(metric.pivot_name)])
+            link_blob(checkpoint_path, best_path)
+        clean_blob(blob_path)
+        logger.reset()
+    model.close()
+    return
+
+
+def train(data_loader, model, optimizer, scheduler, metric, logger):
+    model.train(True)
+    accumulator = Accumulator()
+    start_time = time.time()
+    for i, input in enumerate(data_loader):
+        if cfg['task_name'] in ['s2s', 'sc', 'clm']:
+            input_size = input['labels'].size(0)
+            split = input['split'] if model.num_adapters > 1 else None
+            input = {'input_ids': input['input_ids'], 'attention_mask': input['attention_mask'],
+                     'labels': input['labels']}
+            if split is not None:
+                input['split'] = split
+            input = to_device(input, cfg['device'])
+            output = lm_forward(model, input)
+            input_ = {'target': input['labels']}
+            output_ = {'target': output['logits'], 'loss': output['loss']}
+            output['loss'].backward()
+        else:
+            input = collate(input)
+            input_size = input['data'].size(0)
+            input = to_device(input, cfg['device'])
+            output = model(**input)
+            input_ = {'target': input['target']}
+            output_ = {'target': output['target'], 'loss': output['loss']}
+            output['loss'].backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
+        # hand this step's adapter inputs and output gradients to the workers before the learning rate moves on
+        model.step(optimizer.param_groups[0]['lr'])
+        optimizer.step()
+        scheduler.step()
+        optimizer.zero_grad()
+        evaluation = metric.evaluate('train', 'batch', input_, output_, sync=False)
+        accumulator.append(evaluation, n=input_size)
+        if i % int((len(data_loader) * cfg['log_interval']) + 1) == 0:
+            accumulator.flush(logger, 'train')
+            batch_time = (time.time() - start_time) / (i + 1)
+            lr = optimizer.param_groups[0]['lr']
+            epoch_finished_time = datetime.timedelta(seconds=round(batch_time * (len(data_loader) - i - 1)))
+            exp_finished_time = epoch_finished_time + datetime.timedelta(
+                seconds=round((cfg[cfg['model_name']]['num_epochs'] - cfg['epoch']) * batch_time * len(data_loader)))
+            info = {'info': ['Model: {}'.format(cfg['model_tag']),
+                             'Train Epoch: {}({:.0f}%)'.format(cfg['epoch'], 100. * i / len(data_loader)),
+                             'Learning rate: {:.6f}'.format(lr), 'Epoch Finished Time: {}'.format(epoch_finished_time),
+                             'Experiment Finished Time: {}'.format(exp_finished_time)]}
+            logger.append(info, 'train')
+            print(logger.write('train', metric.metric_name['train']))
+    accumulator.flush(logger, 'train')
+    model.flush(optimizer.param_groups[0]['lr'])
+    return
+
+
+def test(data_loader, model, metric, logger, tag='test'):
+    with torch.no_grad():
+        model.train(False)
+        engine = make_engine(model, metric, logger, tag=tag)
+        engine.run(data_loader)
+        evaluation = metric.evaluate('test', 'full')
+        logger.append(evaluation, tag)
+        info = {'info': ['Model: {}'.format(cfg['model_tag']), 'Test Epoch: {}({:.0f}%)'.format(cfg['epoch'], 100.)]}
+        logger.append(info, tag)
+        print(logger.write(tag, engine.metric_name['test']))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,16 @@
 import argparse
 import datetime
 import os
-import shutil
 import time
 import torch
 import torch.backends.cudnn as cudnn
 from config import cfg, process_args
-from dataset import make_dataset, make_data_loader, process_dataset, collate
-from metric import make_metric, make_logger
-from model import make_model, make_optimizer, make_scheduler, make_ft_model
-from module import save, to_device, process_control, resume, makedir_exist_ok
+from experiment import Experiment
+from dataset import make_data_loader, make_eval_data_loader, collate
+from metric import make_metric, make_logger, make_policy, Accumulator
+from model import cache_prompt, merge_adapter, make_prefix_cache, make_flat_parameters, make_optimizer, \
+    make_scheduler, make_ft_model, make_engine, lm_forward
+from module import save, to_device, process_control, resume, save_blob, link_blob, release_blob, clean_blob, get_memory
 from peft import PeftModel
 
 cudnn.benchmark = True
@@ -24,15 +25,16 @@ process_args(args)
 def main():
     process_control()
     seeds = list(range(cfg['init_seed'], cfg['init_seed'] + cfg['num_experiments']))
+    experiment = Experiment()
     for i in range(cfg['num_experiments']):
         model_tag_list = [str(seeds[i]), cfg['control_name']]
         cfg['model_tag'] = '_'.join([x for x in model_tag_list if x])
         print('Experiment: {}'.format(cfg['model_tag']))
-        runExperiment()
+        runExperiment(experiment)
     return
 
 
-def runExperiment():
+def runExperiment(experiment):
     cfg['seed'] = int(cfg['model_tag'].split('_')[0])
     torch.manual_seed(cfg['seed'])
     torch.cuda.manual_seed(cfg['seed'])
@@ -40,10 +42,15 @@ def runExperiment():
     model_tag_path = os.path.join(model_path, cfg['model_tag'])
     checkpoint_path = os.path.join(model_tag_path, 'checkpoint')
     best_path = os.path.join(model_tag_path, 'best')
-    dataset = make_dataset(cfg['data_name'], cfg['subset_name'])
-    model, tokenizer = make_model(cfg['model_name'])
-    dataset = process_dataset(dataset, tokenizer)
+    blob_path = os.path.join(model_tag_path, 'blob')
+    model, tokenizer = experiment.make_model()
+    dataset = experiment.make_dataset()
     data_loader = make_data_loader(dataset, tokenizer, cfg['model_name'])
+    data_loader['eval'] = make_eval_data_loader(dataset['test'], tokenizer, cfg['model_name'])
+    policy = make_policy(dataset['test'])
+    if policy.indices is not None:
+        data_loader['eval_subset'] = make_eval_data_loader(dataset['test'], tokenizer, cfg['model_name'],
+                                                           policy.indices)
     result = resume(os.path.join(checkpoint_path, 'model'), resume_mode=cfg['resume_mode'])
     metric = make_metric({'train': ['Loss'], 'test': ['Loss']}, tokenizer)
     logger = make_logger(os.path.join('output', 'runs', 'train_{}'.format(cfg['model_tag'])))
@@ -52,41 +59,55 @@ def runExperiment():
         model = make_ft_model(model)
         model = model.to(cfg['device'])
         model.print_trainable_parameters()
-        optimizer = make_optimizer(model.parameters(), cfg['model_name'])
+        optimizer = make_optimizer(make_flat_parameters(model.parameters()), cfg['model_name'])
         scheduler = make_scheduler(optimizer, cfg['model_name'])
     else:
         cfg['epoch'] = result['epoch']
         model = PeftModel.from_pretrained(model, os.path.join(checkpoint_path, 'adapter'), is_trainable=True)
         model = model.to(cfg['device'])
         model.print_trainable_parameters()
-        optimizer = make_optimizer(model.parameters(), cfg['model_name'])
+        optimizer = make_optimizer(make_flat_parameters(model.parameters()), cfg['model_name'])
         if cfg['ft_name'] not in ['adalora']:
             optimizer.load_state_dict(result['optimizer_state_dict'])
         scheduler = make_scheduler(optimizer, cfg['model_name'])
         scheduler.load_state_dict(result['scheduler_state_dict'])
         metric.load_state_dict(result['metric_state_dict'])
         logger.load_state_dict(result['logger_state_dict'])
-    for epoch in range(cfg['epoch'], cfg[cfg['model_name']]['num_epochs'] + 1):
+    make_prefix_cache(model)
+    num_epochs = cfg[cfg['model_name']]['num_epochs']
+    stop_epoch = num_epochs if cfg['stop_epoch'] == 0 else min(cfg['stop_epoch'], num_epochs)
+    for epoch in range(cfg['epoch'], stop_epoch + 1):
         cfg['epoch'] = epoch
         train(data_loader['train'], model, optimizer, scheduler, metric, logger)
-        test(data_loader['test'], model, metric, logger)
+        evaluated = False
+        if policy.is_eval(epoch):
+            if policy.is_full(epoch):
+                test(data_loader['eval'], model, metric, logger)
+                evaluated = True
+            else:
+                test(data_loader['eval_subset'], model, metric, logger, 'test_subset')
+                if metric.compare(logger.mean['test_subset/{}'.format(metric.pivot_name)], policy.margin(metric)):
+                    test(data_loader['eval'], model, metric, logger)
+                    evaluated = True
+        logger.save(True)
         result = {'cfg': cfg, 'epoch': cfg['epoch'] + 1,
                   'optimizer_state_dict': optimizer.state_dict(), 'scheduler_state_dict': scheduler.state_dict(),
                   'metric_state_dict': metric.state_dict(), 'logger_state_dict': logger.state_dict()}
         save(result, os.path.join(checkpoint_path, 'model'))
+        release_blob(os.path.join(checkpoint_path, 'adapter'))
         model.save_pretrained(os.path.join(checkpoint_path, 'adapter'))
-        if metric.compare(logger.mean['test/{}'.format(metric.pivot_name)]):
+        save_blob(checkpoint_path, blob_path)
+        if evaluated and metric.compare(logger.mean['test/{}'.format(metric.pivot_name)]):
             metric.update(logger.mean['test/{}'.format(metric.pivot_name)])
-            makedir_exist_ok(best_path)
-            shutil.copy(os.path.join(checkpoint_path, 'model'), os.path.join(best_path, 'model'))
-            shutil.copytree(os.path.join(checkpoint_path, 'adapter'), os.path.join(best_path, 'adapter'),
-                            dirs_exist_ok=True)
+            link_blob(checkpoint_path, best_path)
+        clean_blob(blob_path)
         logger.reset()
     return
 
 
 def train(data_loader, model, optimizer, scheduler, metric, logger):
     model.train(True)
+    accumulator = Accumulator()
     start_time = time.time()
     for i, input in enumerate(data_loader):
         if cfg['task_name'] in ['s2s', 'sc', 'clm']:
@@ -94,7 +115,7 @@ def train(data_loader, model, optimizer, scheduler, metric, logger):
             input = {'input_ids': input['input_ids'], 'attention_mask': input['attention_mask'],
                      'labels': input['labels']}
             input = to_device(input, cfg['device'])
-            output = model(**input)
+            output = lm_forward(model, input)
             input_ = {'target': input['labels']}
             output_ = {'target': output['logits'], 'loss': output['loss']}
             output['loss'].backward()
@@ -106,13 +127,14 @@ def train(data_loader, model, optimizer, scheduler, metric, logger):
             input_ = {'target': input['target']}
             output_ = {'target': output['target'], 'loss': output['loss']}
             output['loss'].backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1)
+            torch.nn.utils.clip_grad_norm_([p for group in optimizer.param_groups for p in group['params']], 1)
         optimizer.step()
         scheduler.step()
-        optimizer.zero_grad()
-        evaluation = metric.evaluate('train', 'batch', input_, output_)
-        logger.append(evaluation, 'train', n=input_size)
+        optimizer.zero_grad(set_to_none=not cfg['flat_param'])
+        evaluation = metric.evaluate('train', 'batch', input_, output_, sync=False)
+        accumulator.append(evaluation, n=input_size)
         if i % int((len(data_loader) * cfg['log_interval']) + 1) == 0:
+            accumulator.flush(logger, 'train')
             batch_time = (time.time() - start_time) / (i + 1)
             lr = optimizer.param_groups[0]['lr']
             epoch_finished_time = datetime.timedelta(seconds=round(batch_time * (len(data_loader) - i - 1)))
@@ -124,47 +146,21 @@ def train(data_loader, model, optimizer, scheduler, metric, logger):
                              'Experiment Finished Time: {}'.format(exp_finished_time)]}
             logger.append(info, 'train')
             print(logger.write('train', metric.metric_name['train']))
+    accumulator.flush(logger, 'train')
+    logger.append(get_memory(optimizer), 'train')
     return
 
 
-def test(data_loader, model, metric, logger):
-    with torch.no_grad():
+def test(data_loader, model, metric, logger, tag='test'):
+    with torch.no_grad(), cache_prompt(model), merge_adapter(model):
         model.train(False)
-        for i, input in enumerate(data_loader):
-            if cfg['task_name'] in ['s2s', 'sc', 'clm']:
-                input_size = input['labels'].size(0)
-                input = {'input_ids': input['input_ids'], 'attention_mask': input['attention_mask'],
-                         'labels': input['labels']}
-                input = to_device(input, cfg['device'])
-                output = model(**input)
-                input_ = {'target': input['labels']}
-                output_ = {'target': output['logits'], 'loss': output['loss']}
-            else:
-                input = collate(input)
-                input_size = input['data'].size(0)
-                input = to_device(input, cfg['device'])
-                output = model(**input)
-                input_ = {'target': input['target']}
-                output_ = {'target': output['target'], 'loss': output['loss']}
-            if cfg['task_name'] == 's2s':
-                output_['generate'] = model.generate(input_ids=input["input_ids"],
-                                                     max_new_tokens=cfg['max_new_tokens'])
-            elif cfg['task_name'] == 'clm':
-                if cfg['data_name'] in ['dolly']:
-                    output_['generate'] = model.generate(input_ids=input["input_ids"],
-                                                         attention_mask=input["attention_mask"],
-                                                         max_new_tokens=cfg['max_new_tokens'],
-                                                         eos_token_id=cfg['pad_token_id'],
-                                                         no_repeat_ngram_size=2)
-            metric.add('test', input_, output_)
-            evaluation = metric.evaluate('test', 'batch', input_, output_)
-            logger.append(evaluation, 'test', input_size)
+        engine = make_engine(model, metric, logger, tag=tag)
+        engine.run(data_loader)
         evaluation = metric.evaluate('test', 'full')
-        logger.append(evaluation, 'test')
+        logger.append(evaluation, tag)
         info = {'info': ['Model: {}'.format(cfg['model_tag']), 'Test Epoch: {}({:.0f}%)'.format(cfg['epoch'], 100.)]}
-        logger.append(info, 'test')
-        print(logger.write('test', metric.metric_name['test']))
-        logger.save(True)
+        logger.append(info, tag)
+        print(logger.write(tag, engine.metric_name['test']))
     return
 
 
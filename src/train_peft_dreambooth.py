@@ -2,16 +2,15 @@ import argparse
 import datetime
 import numpy as np
 import os
-import shutil
 import time
 import torch
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 from config import cfg, process_args
 from dataset import make_dataset, make_data_loader, process_dataset
-from metric import make_metric, make_logger
-from model import make_model, make_optimizer, make_scheduler, make_noise_scheduler, make_ft_model
-from module import save, to_device, process_control, resume, makedir_exist_ok
+from metric import make_metric, make_logger, Accumulator
+from model import make_model, make_flat_parameters, make_optimizer, make_scheduler, make_noise_scheduler, make_ft_model
+from module import save, to_device, process_control, resume, save_blob, link_blob, release_blob, clean_blob
 from peft import PeftModel
 
 cudnn.benchmark = True
@@ -42,6 +41,7 @@ def runExperiment():
     model_tag_path = os.path.join(model_path, cfg['model_tag'])
     checkpoint_path = os.path.join(model_tag_path, 'checkpoint')
     best_path = os.path.join(model_tag_path, 'best')
+    blob_path = os.path.join(model_tag_path, 'blob')
     dataset = make_dataset(cfg['data_name'], cfg['subset_name'])
     model, tokenizer = make_model(cfg['model_name'], 'unet')
     dataset = process_dataset(dataset, tokenizer)
@@ -54,14 +54,14 @@ def runExperiment():
         model = make_ft_model(model)
         model = model.to(cfg['device'])
         model.print_trainable_parameters()
-        optimizer = make_optimizer(model.parameters(), cfg['model_name'])
+        optimizer = make_optimizer(make_flat_parameters(model.parameters()), cfg['model_name'])
         scheduler = make_scheduler(optimizer, cfg['model_name'])
     else:
         cfg['epoch'] = result['epoch']
         model = PeftModel.from_pretrained(model, os.path.join(checkpoint_path, 'adapter'), is_trainable=True)
         model = model.to(cfg['device'])
         model.print_trainable_parameters()
-        optimizer = make_optimizer(model.parameters(), cfg['model_name'])
+        optimizer = make_optimizer(make_flat_parameters(model.parameters()), cfg['model_name'])
         if cfg['ft_name'] not in ['adalora']:
             optimizer.load_state_dict(result['optimizer_state_dict'])
         scheduler = make_scheduler(optimizer, cfg['model_name'])
@@ -80,13 +80,13 @@ def runExperiment():
                   'optimizer_state_dict': optimizer.state_dict(), 'scheduler_state_dict': scheduler.state_dict(),
                   'metric_state_dict': metric.state_dict(), 'logger_state_dict': logger.state_dict()}
         save(result, os.path.join(checkpoint_path, 'model'))
+        release_blob(os.path.join(checkpoint_path, 'adapter'))
         model.save_pretrained(os.path.join(checkpoint_path, 'adapter'))
+        save_blob(checkpoint_path, blob_path)
         if metric.compare(logger.mean['train/{}'.format(metric.pivot_name)]):
             metric.update(logger.mean['train/{}'.format(metric.pivot_name)])
-            makedir_exist_ok(best_path)
-            shutil.copy(os.path.join(checkpoint_path, 'model'), os.path.join(best_path, 'model'))
-            shutil.copytree(os.path.join(checkpoint_path, 'adapter'), os.path.join(best_path, 'adapter'),
-                            dirs_exist_ok=True)
+            link_blob(checkpoint_path, best_path)
+        clean_blob(blob_path)
         logger.reset()
     return
 
@@ -95,6 +95,7 @@ def train(data_loader, unet, vae, text_encoder, optimizer, scheduler, noise_sche
     unet.train(True)
     vae.train(False)
     text_encoder.train(False)
+    accumulator = Accumulator()
     start_time = time.time()
     for i, input in enumerate(data_loader):
         input = to_device(input, cfg['device'])
@@ -147,13 +148,14 @@ def train(data_loader, unet, vae, text_encoder, optimizer, scheduler, noise_sche
 
         output_ = {'loss': loss}
         input_size = input['input_ids'].size(0) / 2
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=not cfg['flat_param'])
         output_['loss'].backward()
         optimizer.step()
         scheduler.step()
-        evaluation = metric.evaluate('train', 'batch', None, output_)
-        logger.append(evaluation, 'train', n=input_size)
+        evaluation = metric.evaluate('train', 'batch', None, output_, sync=False)
+        accumulator.append(evaluation, n=input_size)
         if i % int((len(data_loader) * cfg['log_interval']) + 1) == 0:
+            accumulator.flush(logger, 'train')
             batch_time = (time.time() - start_time) / (i + 1)
             lr = optimizer.param_groups[0]['lr']
             epoch_finished_time = datetime.timedelta(seconds=round(batch_time * (len(data_loader) - i - 1)))
@@ -165,6 +167,7 @@ def train(data_loader, unet, vae, text_encoder, optimizer, scheduler, noise_sche
                              'Experiment Finished Time: {}'.format(exp_finished_time)]}
             logger.append(info, 'train')
             print(logger.write('train', metric.metric_name['train']), flush=True)
+    accumulator.flush(logger, 'train')
     logger.save(True)
     return
 